@@ -8,59 +8,66 @@
 - Task2 (知识点识别) 准确率
 """
 
+import mmap
 import os
 import re
 
 
+# 报告按 UTF-8 字节直接匹配（配合 mmap，无需把整个文件解码成 str）
+
+# TUTORING ONLY 部分：从标题开始，到下一个模式/汇总标题（或文件末尾）为止
+_TUTORING_SECTION_RE = re.compile(r'🟡 TUTORING ONLY.*?(?=🔵|🟢|📊|$)'.encode('utf-8'), re.DOTALL)
+
+# 一次扫描同时匹配任务标题和各项指标，指标归属于它之前最近的任务标题
+_METRICS_RE = re.compile((
+    r'Task(?P<task>[124])'
+    r'|准确率[^\n]*?(?P<acc>\d+\.\d+)%'
+    r'|F1-Score[^\n]*?(?P<f1>\d+\.\d+)'
+    r'|交叉熵[^\n]*?(?P<ce>\d+\.\d+)'
+).encode('utf-8'))
+
+# 需要提取的 (任务, 指标) → metrics 中的键
+_METRIC_KEYS = {
+    (b'1', 'acc'): 'task1_acc',
+    (b'1', 'f1'): 'task1_f1',
+    (b'1', 'ce'): 'task1_ce',
+    (b'4', 'acc'): 'task4_acc',
+    (b'4', 'f1'): 'task4_f1',
+    (b'2', 'acc'): 'task2_acc',
+}
+
+
 def extract_metrics_from_report(report_path):
     """从报告文件中提取指标"""
     if not os.path.exists(report_path):
         print(f"❌ 报告文件不存在: {report_path}")
         return None
     
-    with open(report_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # 查找 TUTORING ONLY 部分
-    tutoring_section = re.search(
-        r'🟡 TUTORING ONLY.*?(?=🔵|🟢|📊|$)',
-        content,
-        re.DOTALL
-    )
-    
-    if not tutoring_section:
+    if os.path.getsize(report_path) == 0:  # 空文件无法 mmap
         print("❌ 未找到 TUTORING ONLY 部分")
         return None
     
-    section_text = tutoring_section.group(0)
-    
-    # 提取指标
-    metrics = {}
-    
-    # Task1 指标
-    task1_acc = re.search(r'Task1.*?准确率.*?(\d+\.\d+)%', section_text, re.DOTALL)
-    task1_f1 = re.search(r'Task1.*?F1-Score.*?(\d+\.\d+)', section_text, re.DOTALL)
-    task1_ce = re.search(r'Task1.*?交叉熵.*?(\d+\.\d+)', section_text, re.DOTALL)
-    
-    # Task4 指标
-    task4_acc = re.search(r'Task4.*?准确率.*?(\d+\.\d+)%', section_text, re.DOTALL)
-    task4_f1 = re.search(r'Task4.*?F1-Score.*?(\d+\.\d+)', section_text, re.DOTALL)
-    
-    # Task2 指标
-    task2_acc = re.search(r'Task2.*?准确率.*?(\d+\.\d+)%', section_text, re.DOTALL)
-    
-    if task1_acc:
-        metrics['task1_acc'] = float(task1_acc.group(1))
-    if task1_f1:
-        metrics['task1_f1'] = float(task1_f1.group(1))
-    if task1_ce:
-        metrics['task1_ce'] = float(task1_ce.group(1))
-    if task4_acc:
-        metrics['task4_acc'] = float(task4_acc.group(1))
-    if task4_f1:
-        metrics['task4_f1'] = float(task4_f1.group(1))
-    if task2_acc:
-        metrics['task2_acc'] = float(task2_acc.group(1))
+    with open(report_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        # 查找 TUTORING ONLY 部分
+        tutoring_section = _TUTORING_SECTION_RE.search(content)
+        
+        if not tutoring_section:
+            print("❌ 未找到 TUTORING ONLY 部分")
+            return None
+        
+        # 提取指标（在映射上按区间单次扫描，每项指标取该任务下第一次出现的值）
+        metrics = {}
+        current_task = None
+        for match in _METRICS_RE.finditer(content, tutoring_section.start(), tutoring_section.end()):
+            if match.group('task'):
+                current_task = match.group('task')
+                continue
+            metric = match.lastgroup
+            key = _METRIC_KEYS.get((current_task, metric))
+            if key and key not in metrics:
+                metrics[key] = float(match.group(metric))
+                if len(metrics) == len(_METRIC_KEYS):
+                    break
     
     return metrics
 
@@ -1,14 +1,27 @@
 import pandas as pd
 import numpy as np
+import ast
 import json
+import hashlib
+import io
+import logging
 import random
 import math
 import os
+import pickle
+import re
 import sys
 import asyncio
 import argparse
+import sqlite3
 import subprocess
-from collections import defaultdict
+import time
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from dataclasses import dataclass
+from functools import lru_cache
 
 # --- 0. 动态安装缺失的依赖 (如果需要) ---
 try:
@@ -31,9 +44,24 @@ except ImportError:
 
 from tqdm import tqdm
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay, f1_score, classification_report, log_loss
+from sklearn.metrics import ConfusionMatrixDisplay, f1_score, classification_report, log_loss
 from rouge_score import rouge_scorer
 import matplotlib.pyplot as plt
+import orjson
+import zstandard
+
+
+logger = logging.getLogger(__name__)
+
+# 启用 pandas Copy-on-Write：切片、浅拷贝和 assign 共享底层数据，只有真正写入时才复制，
+# 评估阶段不必为了追加几列派生结果而整表复制（结果表含完整提示词与原始响应）
+pd.set_option('mode.copy_on_write', True)
+
+
+def _emit_lines(lines):
+    """把一段报告的所有行拼成一次 sys.stdout.write 输出并 flush，而不是每行一次 print（每次都是一次 write 系统调用）"""
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
 
 
 # --- Agent Model Config ---
@@ -172,24 +200,27 @@ def load_mastery_assessment_results(results_path, target_student_ids=None):
     return mastery_lookup
 
 
-def load_tutoring_content_results(results_path, target_student_ids=None):
+def load_tutoring_content_results(results_path, target_student_ids=None, tutoring_df=None):
     """
     加载辅导内容结果，并根据目标学生筛选。
     返回结构: {student_id: {kc_name: {"tutoring_content": str, "example_question_ids": list}}}
+    
+    tutoring_df: 已从 results_path 读入的辅导内容表（如完整性检查时加载的），提供时不再重复读文件
     """
-    if not results_path or not os.path.exists(results_path):
-        print("未找到辅导内容结果文件，将跳过辅导内容增强实验。")
-        return {}
+    if tutoring_df is None:
+        if not results_path or not os.path.exists(results_path):
+            print("未找到辅导内容结果文件，将跳过辅导内容增强实验。")
+            return {}
 
-    try:
-        # 根据文件扩展名选择读取方式
-        if results_path.endswith('.pkl'):
-            tutoring_df = pd.read_pickle(results_path)
-        else:
-            tutoring_df = pd.read_csv(results_path)
-    except Exception as e:
-        print(f"加载辅导内容结果失败: {e}")
-        return {}
+        try:
+            # 根据文件扩展名选择读取方式
+            if results_path.endswith('.pkl'):
+                tutoring_df = pd.read_pickle(results_path)
+            else:
+                tutoring_df = pd.read_csv(results_path)
+        except Exception as e:
+            print(f"加载辅导内容结果失败: {e}")
+            return {}
 
     if 'student_id' not in tutoring_df.columns or 'kc_name' not in tutoring_df.columns:
         print("辅导内容结果缺少必要列 (student_id, kc_name)，将跳过辅导内容增强实验。")
@@ -198,6 +229,11 @@ def load_tutoring_content_results(results_path, target_student_ids=None):
     if target_student_ids is not None:
         tutoring_df = tutoring_df[tutoring_df['student_id'].isin(target_student_ids)]
 
+    # 加载时一次性向量化清洗辅导内容：NaN/None 转为空字符串，其余统一转为字符串
+    if 'tutoring_content' in tutoring_df.columns:
+        content = tutoring_df['tutoring_content']
+        tutoring_df = tutoring_df.assign(tutoring_content=content.where(content.notna(), '').astype(str))
+
     tutoring_lookup = defaultdict(dict)
     for _, row in tutoring_df.iterrows():
         sid = row['student_id']
@@ -225,7 +261,48 @@ def load_tutoring_content_results(results_path, target_student_ids=None):
     return tutoring_lookup
 
 
-def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_lookup=None, enable_test_kcs_optimization=True):
+def build_tutoring_content_map(tutoring_lookup):
+    """
+    将 load_tutoring_content_results 的结果压平为 {student_id: {kc_name: tutoring_content}}，
+    构建提示词时按学生一次取出，不再逐个知识点提取辅导文本。
+    """
+    if not tutoring_lookup:
+        return {}
+    return {
+        student_id: {kc_name: kc_data.get('tutoring_content', '') for kc_name, kc_data in per_kc.items()}
+        for student_id, per_kc in tutoring_lookup.items()
+    }
+
+
+def build_split_cache(student_ids, all_student_records):
+    """
+    一次性计算每个学生的训练/测试集划分（test_size=0.1, random_state=42），只缓存行位置数组。
+    
+    划分结果只取决于记录条数和随机种子，因此对行号 np.arange(n) 做同样的 train_test_split 即可复现，
+    各处使用时按位置切片，不必重复打乱和复制整张 DataFrame。
+    
+    Returns:
+        dict: {student_id: (train_positions, test_positions)}
+    """
+    split_cache = {}
+    for student_id in student_ids:
+        if student_id not in all_student_records:
+            continue
+        positions = np.arange(len(all_student_records[student_id]))
+        split_cache[student_id] = tuple(train_test_split(positions, test_size=0.1, random_state=42, shuffle=True))
+    return split_cache
+
+
+def split_student_records(student_records_df, split_positions=None):
+    """返回学生的 (train_df, test_df)；传入 build_split_cache 的缓存位置时直接切片，否则现场划分"""
+    if split_positions is not None:
+        train_pos, test_pos = split_positions
+        if len(train_pos) + len(test_pos) == len(student_records_df):
+            return student_records_df.iloc[train_pos], student_records_df.iloc[test_pos]
+    return train_test_split(student_records_df, test_size=0.1, random_state=42, shuffle=True)
+
+
+def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_lookup=None, enable_test_kcs_optimization=True, split_cache=None):
     """
     计算每个学生应该生成辅导内容的知识点列表。
     
@@ -234,6 +311,7 @@ def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_
         all_student_records: 所有学生的做题记录 {student_id: DataFrame}
         mastery_lookup: 掌握度评估数据 {student_id: {kc_name: {...}}}
         enable_test_kcs_optimization: 是否启用测试集优化（只为测试集涉及的知识点生成辅导）
+        split_cache: build_split_cache 生成的划分缓存（可选）
     
     Returns:
         dict: {
@@ -241,8 +319,6 @@ def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_
             'student_weak_kcs': {student_id: [kc_names]}
         }
     """
-    from sklearn.model_selection import train_test_split
-    
     expected_pairs = set()
     student_weak_kcs = {}
     
@@ -254,11 +330,9 @@ def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_
         
         # 数据划分（与 generate_tutoring_content.py 保持一致）
         if len(student_records_df) > 10:
-            train_df, test_df = train_test_split(
-                student_records_df, 
-                test_size=0.1, 
-                random_state=42, 
-                shuffle=True
+            train_df, test_df = split_student_records(
+                student_records_df,
+                split_cache.get(student_id) if split_cache else None
             )
         else:
             train_df = student_records_df
@@ -304,6 +378,125 @@ def calculate_expected_tutoring_pairs(student_ids, all_student_records, mastery_
     }
 
 
+def tutoring_check_cache_key(tutoring_path, student_ids, expected_pairs):
+    """辅导内容完整性检查的缓存键：由辅导内容文件的修改时间和大小、学生ID、期望辅导对共同决定"""
+    stat = os.stat(tutoring_path)
+    payload = '|'.join([
+        str(stat.st_mtime_ns),
+        str(stat.st_size),
+        ','.join(map(str, sorted(int(sid) for sid in student_ids))),
+        ';'.join(f"{sid}:{kc}" for sid, kc in sorted(expected_pairs)),
+    ])
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _load_tutoring_check_cache(cache_path, key):
+    """读取与 key 匹配的完整性检查结论，不存在或已失效时返回 None"""
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_tutoring_check_cache(cache_path, key, result):
+    """保存本次完整性检查结论（只保留最新一条，输入变化后旧结论不会再命中）"""
+    try:
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump({key: result}, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"⚠️  保存辅导内容检查缓存失败: {e}")
+
+
+# 期望辅导对不少于该数量时，扫描前先按 (学生, 知识点) 对做向量化预过滤；更少时直接按位集合并更快
+_PAIR_PREFILTER_MIN_PAIRS = 1000
+
+
+def check_tutoring_completeness(tutoring_df, expected_pairs, chunksize=100_000):
+    """
+    对比期望的辅导对与已生成的辅导内容，找出缺失的 (student_id, kc_name) 对。
+    
+    期望集合通常远小于辅导内容表，因此以期望集合为准：先向量化过滤出期望中的学生和知识点，
+    再把每个学生的期望/已有知识点集合表示为整数位集（每个知识点占一位），
+    缺失 = expected_bits & ~existing_bits，每个学生一次按位运算。
+    
+    辅导内容表按 chunksize 行分批扫描（不大于 0 或 None 表示一次扫描全部），
+    过滤用的中间结果只保留一批，峰值内存与表的大小无关。
+    
+    期望辅导对较多时（不少于 _PAIR_PREFILTER_MIN_PAIRS），分别按学生和知识点过滤会留下大量
+    "学生与知识点都在期望中、但组合不在"的行；此时额外用 (学生序号, 知识点序号) 的布尔矩阵
+    逐行查表，只保留真正期望的辅导对，之后去重和合并位集的行数随之减少。
+    
+    Returns:
+        dict: {
+            'existing_count': 期望辅导对中已生成的数量,
+            'missing_pairs': set of (student_id, kc_name),
+            'missing_by_student': {student_id: [缺失的 kc_name]}（按学生ID排序）
+        }
+    """
+    # 知识点 → 位序号（只需覆盖期望集合中出现的知识点）
+    kc_to_bit = {}
+    expected_bits = defaultdict(int)
+    for sid, kc in expected_pairs:
+        bit = kc_to_bit.setdefault(kc, len(kc_to_bit))
+        expected_bits[sid] |= 1 << bit
+    bit_to_kc = list(kc_to_bit)
+    
+    expected_sids = list(expected_bits)
+    existing_bits = defaultdict(int)
+    step = chunksize if chunksize and chunksize > 0 else max(len(tutoring_df), 1)
+    
+    if len(expected_pairs) >= _PAIR_PREFILTER_MIN_PAIRS:
+        sid_index = pd.Index(expected_sids)
+        kc_index = pd.Index(bit_to_kc)
+        expected_matrix = np.zeros((len(sid_index), len(kc_index)), dtype=bool)
+        expected_matrix[
+            sid_index.get_indexer([sid for sid, _ in expected_pairs]),
+            [kc_to_bit[kc] for _, kc in expected_pairs],
+        ] = True
+        for start in range(0, len(tutoring_df), step):
+            chunk = tutoring_df.iloc[start:start + step]
+            sid_pos = sid_index.get_indexer(chunk['student_id'])
+            kc_pos = kc_index.get_indexer(chunk['kc_name'])
+            in_range = (sid_pos >= 0) & (kc_pos >= 0)
+            sid_pos, kc_pos = sid_pos[in_range], kc_pos[in_range]
+            hit = expected_matrix[sid_pos, kc_pos]
+            codes = np.unique(sid_pos[hit].astype(np.int64) * len(kc_index) + kc_pos[hit])
+            for s_pos, bit in zip(*np.divmod(codes, len(kc_index))):
+                existing_bits[expected_sids[s_pos]] |= 1 << int(bit)
+    else:
+        for start in range(0, len(tutoring_df), step):
+            chunk = tutoring_df.iloc[start:start + step]
+            candidate_df = chunk.loc[
+                chunk['student_id'].isin(expected_sids) & chunk['kc_name'].isin(bit_to_kc),
+                ['student_id', 'kc_name']
+            ].drop_duplicates()
+            for sid, bit in zip(candidate_df['student_id'].tolist(), candidate_df['kc_name'].map(kc_to_bit).tolist()):
+                existing_bits[sid] |= 1 << bit
+    
+    existing_count = 0
+    missing_pairs = set()
+    missing_by_student = {}
+    for sid in sorted(expected_bits):
+        expected = expected_bits[sid]
+        existing_count += (expected & existing_bits.get(sid, 0)).bit_count()
+        missing = expected & ~existing_bits.get(sid, 0)
+        missing_kcs = []
+        while missing:
+            lowest = missing & -missing
+            missing_kcs.append(bit_to_kc[lowest.bit_length() - 1])
+            missing ^= lowest
+        if missing_kcs:
+            missing_by_student[sid] = missing_kcs
+            missing_pairs.update((sid, kc) for kc in missing_kcs)
+    
+    return {
+        'existing_count': existing_count,
+        'missing_pairs': missing_pairs,
+        'missing_by_student': missing_by_student
+    }
+
+
 def build_related_kc_map(all_kc_names, kcg_edges):
     """根据知识点关系构建邻接映射。"""
     related_map = {kc: {kc} for kc in all_kc_names}
@@ -475,7 +668,6 @@ def parse_tutoring_by_kc(llm_response, weak_kc_list):
         return {}
     
     parsed = {}
-    import re
     
     # 策略1：精确匹配（支持 Markdown 加粗标记 **）
     for kc_name in weak_kc_list:
@@ -524,8 +716,7 @@ def parse_tutoring_by_kc(llm_response, weak_kc_list):
                 
                 # 记录警告：LLM返回的名称与期望不符
                 if first_line.lower() != kc_name.lower():
-                    import logging
-                    logging.warning(f"知识点名称不匹配 - 期望: '{kc_name}', LLM返回: '{first_line}' (已使用顺序分配)")
+                    logger.warning(f"知识点名称不匹配 - 期望: '{kc_name}', LLM返回: '{first_line}' (已使用顺序分配)")
     
     return parsed
 
@@ -834,6 +1025,7 @@ async def run_mastery_assessment_pipeline(concurrency, student_ids=None, student
         else:
             cmd.extend(['--students', str(student_count)])
 
+        sys.stdout.flush()  # 子进程直接写同一个 stdout，先把本进程缓冲的输出写出以保持顺序
         proc = await asyncio.create_subprocess_exec(*cmd)
         await proc.wait()
         if proc.returncode != 0:
@@ -889,35 +1081,44 @@ class Profile:
         self.preference = df['know_name'].mode().iloc[0] if not df.empty else "N/A"
 
     def build_prompt(self):
-        # 将活跃度转换为更自然的描述
-        activity_desc = {
-            'high': 'You practice frequently and stay engaged with learning',
-            'medium': 'You practice occasionally when needed',
-            'low': 'You practice rarely and prefer familiar topics'
-        }.get(self.activity, f'Your activity level is {self.activity}')
-        
-        # 将知识多样性转换为更自然的描述
-        diversity_desc = {
-            'high': 'You explore many different topics and concepts',
-            'medium': 'You focus on select topics that interest you',
-            'low': 'You stick to familiar topics you feel comfortable with'
-        }.get(self.diversity, f'Your knowledge diversity is {self.diversity}')
-        
-        return (
-            f"You ARE a student with these learning characteristics:\n\n"
-            f"📚 Your Learning Profile:\n"
-            f"  • Activity Level: {self.activity} - {activity_desc}\n"
-            f"  • Knowledge Breadth: {self.diversity} - {diversity_desc}\n"
-            f"  • Typical Success Rate: {self.success_rate}\n"
-            f"  • Problem-Solving Ability: {self.ability}\n"
-            f"  • Most Comfortable Topic: {self.preference}\n\n"
-            f"🎯 How to Respond:\n"
-            f"1. Think and answer as THIS student would - based on YOUR actual abilities and experiences\n"
-            f"2. Be honest about your confidence level - don't overestimate or underestimate yourself\n"
-            f"3. When predicting performance, reflect on YOUR past experiences with similar problems\n"
-            f"4. If you're unsure or haven't mastered a concept, it's okay to predict 'No' - be realistic\n"
-            f"5. Your responses should reflect your genuine thought process as this student\n"
-        )
+        return _render_profile_prompt(self.activity, self.diversity, self.success_rate, self.ability, self.preference)
+
+
+@lru_cache(maxsize=4096)
+def _render_profile_prompt(activity, diversity, success_rate, ability, preference):
+    """
+    按学生画像取值渲染系统提示词（措辞与 PAPER.md、agent_prompts_documentation.md 中记录的实验提示词一致）。
+    画像取值组合有限，画像相同的学生直接复用同一个字符串，不再重复拼接。
+    """
+    # 将活跃度转换为更自然的描述
+    activity_desc = {
+        'high': 'You practice frequently and stay engaged with learning',
+        'medium': 'You practice occasionally when needed',
+        'low': 'You practice rarely and prefer familiar topics'
+    }.get(activity, f'Your activity level is {activity}')
+    
+    # 将知识多样性转换为更自然的描述
+    diversity_desc = {
+        'high': 'You explore many different topics and concepts',
+        'medium': 'You focus on select topics that interest you',
+        'low': 'You stick to familiar topics you feel comfortable with'
+    }.get(diversity, f'Your knowledge diversity is {diversity}')
+    
+    return (
+        f"You ARE a student with these learning characteristics:\n\n"
+        f"📚 Your Learning Profile:\n"
+        f"  • Activity Level: {activity} - {activity_desc}\n"
+        f"  • Knowledge Breadth: {diversity} - {diversity_desc}\n"
+        f"  • Typical Success Rate: {success_rate}\n"
+        f"  • Problem-Solving Ability: {ability}\n"
+        f"  • Most Comfortable Topic: {preference}\n\n"
+        f"🎯 How to Respond:\n"
+        f"1. Think and answer as THIS student would - based on YOUR actual abilities and experiences\n"
+        f"2. Be honest about your confidence level - don't overestimate or underestimate yourself\n"
+        f"3. When predicting performance, reflect on YOUR past experiences with similar problems\n"
+        f"4. If you're unsure or haven't mastered a concept, it's okay to predict 'No' - be realistic\n"
+        f"5. Your responses should reflect your genuine thought process as this student\n"
+    )
 
 # --- 3.5 Agent 行为函数 (替代 AgentAction 类) ---
 
@@ -938,7 +1139,109 @@ def get_question_choices(question_id, question_choices_df):
         for _, row in choices.iterrows()
     ]
 
-def _build_agent_prompt(practice, all_kc_names, question_choices, mastery_summary=None, tutoring_dict=None):
+def build_choice_ids_by_question(question_choices_df):
+    """
+    加载数据后一次性构建 {question_id: [choice_id, ...]}，顺序与 get_question_choices 展示给模型的选项一致，
+    评估时按题目 ID 直接取选项，不再解析结果中的 question_choices 字符串。
+    """
+    if question_choices_df is None:
+        return {}
+    return {
+        question_id: choice_ids.tolist()
+        for question_id, choice_ids in question_choices_df.groupby('question_id', sort=False)['id']
+    }
+
+# --- Agent 提示词模板 ---
+# 按 (has_tutoring, has_choices) 预先生成 4 个完整模板，构建提示词时只需一次查表 + 一次 format_map
+
+_MASTERY_BLOCK_TEMPLATE = (
+    "=== 🧠 Your Long-term Knowledge of This Topic ===\n"
+    "Based on your accumulated learning experience:\n"
+    "{summary}\n"
+    "💭 Keep this self-awareness in mind as you work through this question.\n\n"
+)
+
+_TUTORING_BLOCK_TEMPLATE = (
+    "=== 📚 What You Just Reviewed (Short-term Memory) ===\n"
+    "You recently reviewed this specific topic:\n"
+    "{content}\n\n"
+    # 添加明确的应用引导
+    "💡 **How to Use This Review:**\n"
+    "• This review is specifically about '{topic}' - exactly what this question tests!\n"
+    "• Apply the key points and methods you just studied directly to this problem.\n"
+    "• Check if this question is similar to the example problems you reviewed.\n"
+    "• Recall the common mistakes and solution strategies you learned.\n\n"
+)
+
+
+def _compose_prompt_template(has_tutoring, has_choices):
+    """拼出一种 (has_tutoring, has_choices) 组合下的完整提示词模板（仅在模块加载时调用）"""
+    template = "=== 📝 The Question in Front of You ===\n"
+    template += "Question: {question}\n"
+    
+    # 展示答案选项
+    if has_choices:
+        template += "\nAnswer Choices:\n{choices_block}\n"
+    
+    template += "Topic: {topic}\n\n"
+    template += "{mastery_block}{tutoring_block}"
+    template += "=== 🤔 Now, Think Through This Question as This Student ===\n\n"
+    
+    # Task 1: 自我预测
+    template += "Task 1: Honestly predict - will you get this right?\n"
+    template += "        (Based on your knowledge and confidence about '{topic}')\n"
+    template += "        Think to yourself:\n"
+    if has_tutoring:
+        template += "          • Did I just review this topic? If so, I should feel more confident!\n"
+        template += "          • Do the example problems I studied help me understand this question?\n"
+        template += "          • Am I confident I can apply what I just learned?\n"
+    else:
+        template += "          • Do I understand this concept well?\n"
+        template += "          • Am I confident I can solve this correctly?\n"
+    template += "        Your honest prediction (Yes/No):\n\n"
+    
+    # Task 2: 知识点识别（原Task2保持）
+    template += "Task 2: What topic does this question test?\n"
+    template += "        (Based on what you see, which concept is this about?)\n"
+    template += "        Options: {kc_options}\n"
+    template += "        Your identification:\n\n"
+    
+    # Task 3: 解题过程
+    template += "Task 3: How would you approach and solve this?\n"
+    if has_tutoring:
+        template += "        (Think about what you just reviewed - can you apply any of those concepts or methods here?)\n"
+        template += "        (If this is similar to the example problems, follow that solving approach)\n"
+    else:
+        template += "        (Write your thought process and reasoning as you naturally would)\n"
+    template += "        Your work:\n\n"
+    
+    # Task 4: 最终答案选择（新设计）
+    if has_choices:
+        template += "Task 4: What is your final answer choice?\n"
+        template += "        (Select the option you believe is correct)\n"
+        template += "        Available options: {choice_letters}\n"
+        template += "        Your choice:\n\n"
+    else:
+        # 如果没有选项，保持原有的Yes/No预测
+        template += "Task 4: Based on your work above, do you think your answer is correct?\n"
+        template += "        Your confidence (Yes/No):\n\n"
+
+    template += "Output format:\n"
+    template += "Task1: <Answer>\n"
+    template += "Task2: <Answer>\n"
+    template += "Task3: <Answer>\n"
+    template += "Task4: <Answer>"
+    return template
+
+
+_PROMPT_TEMPLATES = {
+    (has_tutoring, has_choices): _compose_prompt_template(has_tutoring, has_choices)
+    for has_tutoring in (True, False)
+    for has_choices in (True, False)
+}
+
+
+def _build_agent_prompt(practice, all_kc_names, question_choices, mastery_summary=None, tutoring_dict=None, rng=random):
     """
     构建用于 LLM 的用户提示词 - 以学生第一人称视角。
     
@@ -946,24 +1249,13 @@ def _build_agent_prompt(practice, all_kc_names, question_choices, mastery_summar
     - mastery_summary: 掌握度信息（长期记忆），仅 Mastery Only 模式有
     - tutoring_dict: 辅导内容字典（按知识点组织），仅 Tutoring Only 模式有
     - Baseline 模式：两者都没有，只有题目本身
+    - rng: 生成知识点选项用的随机数生成器（默认使用全局 random）
     """
-    prompt = f"=== 📝 The Question in Front of You ===\n"
-    prompt += f"Question: {practice['exer_content']}\n"
-    
-    # 展示答案选项
-    if question_choices is not None and len(question_choices) > 0:
-        prompt += f"\nAnswer Choices:\n"
-        for idx, choice in enumerate(question_choices):
-            choice_letter = chr(65 + idx)  # A, B, C, D...
-            prompt += f"  {choice_letter}. {choice['choice_text']}\n"
-        prompt += "\n"
-    
-    prompt += f"Topic: {practice['know_name']}\n\n"
-    
+    has_choices = question_choices is not None and len(question_choices) > 0
+
     # 长期记忆：掌握度信息（仅 Mastery Only 模式）
+    mastery_block = ""
     if mastery_summary:
-        prompt += "=== 🧠 Your Long-term Knowledge of This Topic ===\n"
-        prompt += "Based on your accumulated learning experience:\n"
         # 将客观描述转化为第一人称认知
         personalized_summary = mastery_summary.replace(
             "Target Concept:", "You're looking at:"
@@ -976,126 +1268,535 @@ def _build_agent_prompt(practice, all_kc_names, question_choices, mastery_summar
         ).replace(
             "Related Concepts:", "Related topics you've worked on:"
         )
-        prompt += personalized_summary + "\n"
-        prompt += "💭 Keep this self-awareness in mind as you work through this question.\n\n"
-    
+        mastery_block = _MASTERY_BLOCK_TEMPLATE.format(summary=personalized_summary)
+
     # 短期记忆：辅导内容（仅 Tutoring Only 模式）
     # 重要改进：只使用与当前题目知识点相关的辅导内容！
+    tutoring_block = ""
     if tutoring_dict:
         current_kc = practice['know_name']
         relevant_tutoring = tutoring_dict.get(current_kc, None)
         
         # 🔥 类型检查和数据清洗：确保 relevant_tutoring 是字符串
-        if relevant_tutoring is not None:
-            # 处理 NaN 或其他非字符串类型
-            if not isinstance(relevant_tutoring, str):
-                try:
-                    # 尝试转换为字符串
-                    if pd.isna(relevant_tutoring):
-                        relevant_tutoring = None  # NaN 视为无辅导内容
-                    else:
-                        relevant_tutoring = str(relevant_tutoring)
-                except Exception as e:
-                    # 记录类型错误到日志
-                    import logging
-                    logging.error(f"辅导内容类型转换失败 - 学生: {practice.get('student_id', 'Unknown')}, 知识点: {current_kc}, 类型: {type(relevant_tutoring)}, 值: {relevant_tutoring}, 错误: {e}")
-                    relevant_tutoring = None
+        # 值只可能是 str / None / float NaN，用 x != x 直接判断 NaN，避免每次调用 pd.isna
+        if relevant_tutoring is None or isinstance(relevant_tutoring, str):
+            pass
+        elif isinstance(relevant_tutoring, float) and relevant_tutoring != relevant_tutoring:
+            relevant_tutoring = None  # NaN 视为无辅导内容
+        else:
+            relevant_tutoring = str(relevant_tutoring)
         
         if relevant_tutoring and len(str(relevant_tutoring).strip()) > 0:
             # 只有当前知识点有有效辅导内容时才显示
-            prompt += "=== 📚 What You Just Reviewed (Short-term Memory) ===\n"
-            prompt += "You recently reviewed this specific topic:\n"
-            prompt += str(relevant_tutoring) + "\n\n"  # 确保是字符串
-            
-            # 添加明确的应用引导
-            prompt += "💡 **How to Use This Review:**\n"
-            prompt += f"• This review is specifically about '{current_kc}' - exactly what this question tests!\n"
-            prompt += "• Apply the key points and methods you just studied directly to this problem.\n"
-            prompt += "• Check if this question is similar to the example problems you reviewed.\n"
-            prompt += "• Recall the common mistakes and solution strategies you learned.\n\n"
+            tutoring_block = _TUTORING_BLOCK_TEMPLATE.format(content=str(relevant_tutoring), topic=current_kc)
         # 如果没有相关辅导内容，不显示辅导部分（类似baseline）
 
     # 动态生成知识点选项
     correct_kc = practice['know_name']
     wrong_kcs = [kc for kc in all_kc_names if kc != correct_kc]
-    kc_options = [correct_kc] + random.sample(wrong_kcs, min(2, len(wrong_kcs)))
-    random.shuffle(kc_options)
+    kc_options = [correct_kc] + rng.sample(wrong_kcs, min(2, len(wrong_kcs)))
+    rng.shuffle(kc_options)
 
-    prompt += "=== 🤔 Now, Think Through This Question as This Student ===\n\n"
-    
-    # Task 1: 自我预测
-    prompt += f"Task 1: Honestly predict - will you get this right?\n"
-    prompt += f"        (Based on your knowledge and confidence about '{practice['know_name']}')\n"
     # 检查是否有辅导内容（根据tutoring_dict是否为dict且有当前KC）
-    has_tutoring = tutoring_dict and isinstance(tutoring_dict, dict) and practice['know_name'] in tutoring_dict
-    if has_tutoring:
-        prompt += f"        Think to yourself:\n"
-        prompt += f"          • Did I just review this topic? If so, I should feel more confident!\n"
-        prompt += f"          • Do the example problems I studied help me understand this question?\n"
-        prompt += f"          • Am I confident I can apply what I just learned?\n"
-    else:
-        prompt += f"        Think to yourself:\n"
-        prompt += f"          • Do I understand this concept well?\n"
-        prompt += f"          • Am I confident I can solve this correctly?\n"
-    prompt += f"        Your honest prediction (Yes/No):\n\n"
-    
-    # Task 2: 知识点识别（原Task2保持）
-    prompt += f"Task 2: What topic does this question test?\n"
-    prompt += f"        (Based on what you see, which concept is this about?)\n"
-    prompt += f"        Options: {', '.join(kc_options)}\n"
-    prompt += f"        Your identification:\n\n"
-    
-    # Task 3: 解题过程
-    prompt += f"Task 3: How would you approach and solve this?\n"
-    if has_tutoring:
-        prompt += f"        (Think about what you just reviewed - can you apply any of those concepts or methods here?)\n"
-        prompt += f"        (If this is similar to the example problems, follow that solving approach)\n"
-    else:
-        prompt += f"        (Write your thought process and reasoning as you naturally would)\n"
-    prompt += f"        Your work:\n\n"
-    
-    # Task 4: 最终答案选择（新设计）
-    if question_choices is not None and len(question_choices) > 0:
-        choice_letters = [chr(65 + i) for i in range(len(question_choices))]
-        prompt += f"Task 4: What is your final answer choice?\n"
-        prompt += f"        (Select the option you believe is correct)\n"
-        prompt += f"        Available options: {', '.join(choice_letters)}\n"
-        prompt += f"        Your choice:\n\n"
+    has_tutoring = bool(tutoring_dict and isinstance(tutoring_dict, dict) and practice['know_name'] in tutoring_dict)
+
+    if has_choices:
+        choices_block = "".join(
+            f"  {chr(65 + idx)}. {choice['choice_text']}\n"  # A, B, C, D...
+            for idx, choice in enumerate(question_choices)
+        )
+        choice_letters = ", ".join(chr(65 + i) for i in range(len(question_choices)))
     else:
-        # 如果没有选项，保持原有的Yes/No预测
-        prompt += f"Task 4: Based on your work above, do you think your answer is correct?\n"
-        prompt += f"        Your confidence (Yes/No):\n\n"
+        choices_block = ""
+        choice_letters = ""
+
+    return _PROMPT_TEMPLATES[(has_tutoring, has_choices)].format_map({
+        'question': practice['exer_content'],
+        'choices_block': choices_block,
+        'topic': practice['know_name'],
+        'mastery_block': mastery_block,
+        'tutoring_block': tutoring_block,
+        'kc_options': ', '.join(kc_options),
+        'choice_letters': choice_letters,
+    })
+
+
+# 一次扫描提取 "TaskN: <Answer>" 行（N=1..4），后出现的同名任务覆盖先出现的
+_TASK_LINE_RE = re.compile(r'^[^\S\n]*task([1-4])[^\S\n]*:[^\S\n]*(.*?)\s*$', re.IGNORECASE | re.MULTILINE)
 
-    prompt += "Output format:\n"
-    prompt += "Task1: <Answer>\n"
-    prompt += "Task2: <Answer>\n"
-    prompt += "Task3: <Answer>\n"
-    prompt += "Task4: <Answer>"
-    
-    return prompt
 
 def _parse_llm_response(text):
     """从 LLM 的原始文本输出中解析出四个任务的结果。"""
     ans = {f'task{i}': 'N/A' for i in range(1, 5)}
     if not isinstance(text, str):
         return ans
-        
-    for line in text.strip().split('\n'):
-        if ':' in line:
-            try:
-                key, value = line.split(':', 1)
-                key = key.strip().lower()
-                if key in ans: 
-                    ans[key] = value.strip()
-            except ValueError:
-                continue # 忽略格式不正确的行
+
+    for match in _TASK_LINE_RE.finditer(text):
+        ans[f'task{match.group(1)}'] = match.group(2)
     return ans
 
 # run_agent_step 函数已移除，逻辑合并到 run_simulation_for_student 中
 
 
+@dataclass(slots=True)
+class LLMRequest:
+    """统一请求池中的单个 LLM 请求（slots 版本，属性访问更快、内存占用更小）"""
+    system_prompt: str
+    user_prompt: str
+    model_name: str
+    practice_data: dict
+    student_id: object = 'Unknown'
+    mastery_summary: object = None
+    tutoring_summary: object = None
+    question_choices: object = None
+
+
+# run_experiment 结果表的列（按列收集结果，最后一次性构建 DataFrame）
+_RESULT_COLUMNS = (
+    'student_id', 'question_id', 'true_know_name', 'true_score',
+    'true_answer_choice_id', 'true_answer_text',
+    'predicted_task1_selfpredict', 'predicted_task2_know_name',
+    'predicted_task3_reasoning', 'predicted_task4_answer_choice',
+    'llm_raw_response', 'prompt_system', 'prompt_user',
+    'mastery_summary', 'tutoring_summary', 'experiment_type', 'question_choices',
+)
+
+# 有增量回调时 run_experiment 返回值中不保留的大文本列（完整数据已通过回调交给调用方）
+_BULKY_RESULT_COLUMNS = ('llm_raw_response', 'prompt_system', 'prompt_user')
+
+# experiment_mode 列的类别（所有结果表共用同一组类别，pd.concat 后仍保持 category 类型）
+_EXPERIMENT_MODE_DTYPE = pd.CategoricalDtype(['baseline', 'mastery_only', 'tutoring_only', 'both'])
+
+# 各实验模式的配置: (使用掌握度, 使用辅导, 配置说明, 图标)
+_EXPERIMENT_MODE_CONFIGS = {
+    'baseline': (False, False, "BASELINE (无掌握度 + 无辅导)", "🔵"),
+    'mastery_only': (True, False, "MASTERY ONLY (有掌握度 + 无辅导)", "🟢"),
+    'tutoring_only': (False, True, "TUTORING ONLY (无掌握度 + 有辅导)", "🟡"),
+    'both': (True, True, "BOTH (有掌握度 + 有辅导)", "🟣"),
+}
+
+# Both 模式降级后的配置说明与图标（按实际运行的模式）
+_BOTH_DOWNGRADE_LABELS = {
+    'baseline': ("BOTH (降级为 Baseline - 无掌握度 + 无辅导)", "🔵⬅️🟣"),
+    'mastery_only': ("BOTH (降级为 Mastery Only - 有掌握度 + 无辅导)", "🟢⬅️🟣"),
+    # 理论上不应该出现（辅导依赖掌握度），但仍处理
+    'tutoring_only': ("BOTH (降级为 Tutoring Only - 无掌握度 + 有辅导)", "🟡⬅️🟣"),
+}
+
+
+def _downgrade(exp_mode, has_mastery, has_tutoring):
+    """Both 模式按实际加载到的掌握度/辅导数据降级为可运行的模式，其他模式原样返回"""
+    if exp_mode != 'both':
+        return exp_mode
+    if has_mastery and has_tutoring:
+        return 'both'
+    if has_mastery:
+        return 'mastery_only'
+    if has_tutoring:
+        return 'tutoring_only'
+    return 'baseline'
+
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _results_file_is_zstd(results_path):
+    """根据文件头的魔数判断结果文件是否为 zstd 压缩格式"""
+    with open(results_path, 'rb') as f:
+        return f.read(len(_ZSTD_MAGIC)) == _ZSTD_MAGIC
+
+
+def append_results_pickle(results_path, frames, truncate=False):
+    """
+    把一批结果 DataFrame 作为一条 pickle 记录追加到追加日志（结果文件旁的 .journal）末尾。
+    
+    追加日志是若干条 pickle 记录首尾相接的流，每次增量保存只写新增的学生，
+    而不是整表重写（写入量随学生数线性增长）；truncate=True 时先清空文件。
+    最终保存时由 compact_results_pickle 合并为单个未压缩 DataFrame 的结果文件。
+    追加日志只由本模块读写，每条记录压缩为一个独立的 zstd 帧。
+    """
+    batch = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+    payload = zstandard.ZstdCompressor(level=3).compress(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL))
+    with open(results_path, 'wb' if truncate else 'ab') as f:
+        f.write(payload)
+
+
+def _read_zstd_records(results_path):
+    """逐帧解压 zstd 结果文件，返回 (DataFrame 列表, 不完整末尾记录的起始偏移或 None)"""
+    with open(results_path, 'rb') as f:
+        buf = f.read()
+    frames = []
+    dctx = zstandard.ZstdDecompressor()
+    pos = 0
+    while pos < len(buf):
+        try:
+            dobj = dctx.decompressobj()
+            data = dobj.decompress(buf[pos:])
+            if not dobj.eof:
+                raise EOFError("zstd 帧不完整")
+            frames.append(pickle.loads(data))
+        except Exception as e:
+            if not frames:
+                raise
+            logger.warning("结果文件 %s 末尾记录不完整，已忽略: %s", results_path, e)
+            return frames, pos
+        pos = len(buf) - len(dobj.unused_data)
+    return frames, None
+
+
+def _read_pickle_records(results_path):
+    """逐条读取未压缩的 pickle 结果文件，返回 (DataFrame 列表, 不完整末尾记录的起始偏移或 None)"""
+    frames = []
+    with open(results_path, 'rb') as f:
+        while True:
+            record_start = f.tell()
+            if not f.read(1):
+                break
+            f.seek(record_start)
+            try:
+                frames.append(pickle.load(f))
+            except Exception as e:
+                if not frames:
+                    raise
+                logger.warning("结果文件 %s 末尾记录不完整，已忽略: %s", results_path, e)
+                return frames, record_start
+    return frames, None
+
+
+def read_results_pickle(results_path, repair=False):
+    """
+    读取 append_results_pickle 写出的追加日志（或单个 DataFrame 的结果文件），合并所有记录为一个 DataFrame。
+    
+    按文件头魔数区分 zstd 压缩（追加日志）与未压缩格式（结果文件），兼容旧的多条记录结果文件；
+    末尾一条记录不完整（写入时被中断）时只保留之前完整的记录，
+    repair=True 时同时把文件截断到最后一条完整记录，之后才能继续安全追加。
+    """
+    if _results_file_is_zstd(results_path):
+        frames, partial_tail_at = _read_zstd_records(results_path)
+    else:
+        frames, partial_tail_at = _read_pickle_records(results_path)
+    if repair and partial_tail_at is not None:
+        with open(results_path, 'r+b') as f:
+            f.truncate(partial_tail_at)
+    if not frames:
+        raise EOFError(f"结果文件为空: {results_path}")
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def compact_results_pickle(results_path, journal_path, df):
+    """
+    把完整结果表写成单个 DataFrame 的 pickle（先写临时文件再原子替换），随后删除追加日志。
+    
+    结果文件不压缩，因此始终可以直接用 pd.read_pickle 读取（results/ 下的分析 notebook 即如此读取）。
+    """
+    tmp_path = results_path + '.tmp'
+    df.to_pickle(tmp_path, compression=None, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, results_path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+
+def load_results_with_journal(results_path, journal_path):
+    """
+    断点续跑时读取已有结果：结果文件（上次最终保存的合并结果）+ 追加日志（之后的增量保存）。
+    
+    追加日志末尾不完整的记录会被截断；合并完成但删除追加日志前被中断时，
+    追加日志中的学生已在结果文件里，按学生去重（同一学生的结果总在同一条记录中）。
+    两者都不存在或为空时返回 None。
+    """
+    frames = []
+    if os.path.exists(results_path) and os.path.getsize(results_path) > 0:
+        frames.append(read_results_pickle(results_path))
+    if os.path.exists(journal_path) and os.path.getsize(journal_path) > 0:
+        journal_df = read_results_pickle(journal_path, repair=True)
+        if frames:
+            journal_df = journal_df[~journal_df['student_id'].isin(frames[0]['student_id'])]
+        frames.append(journal_df)
+    if not frames:
+        return None
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def _write_csv(df, csv_path, append=False):
+    """
+    把 DataFrame 写成 CSV（不含索引）；append=True 时追加到已有文件末尾且不写表头。
+    
+    统一使用 pandas 的 to_csv，保证各模式分批追加的内容格式一致，输出不随运行环境变化。
+    """
+    df.to_csv(csv_path, mode='a' if append else 'w', header=not append, index=False)
+
+
+def _file_sizes(paths):
+    """各文件的大小，不存在的文件记为 -1"""
+    return [os.path.getsize(path) if os.path.exists(path) else -1 for path in paths]
+
+
+def write_completed_students(sidecar_path, results_paths, student_ids):
+    """
+    在结果文件旁写入已完成学生ID列表，断点续跑时不必对整个结果表做 unique()。
+    
+    同时记录写入时各结果文件（结果文件与追加日志）的大小，读取时据此确认两者仍然一致。
+    """
+    payload = {
+        'results_sizes': _file_sizes(results_paths),
+        'student_ids': sorted(int(sid) for sid in student_ids),
+    }
+    with open(sidecar_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f)
+
+
+def read_completed_students(sidecar_path, results_paths):
+    """读取已完成学生ID集合；文件缺失、损坏或与结果文件不一致（如追加日志末尾被截断）时返回 None"""
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            payload = json.load(f)
+        if payload['results_sizes'] != _file_sizes(results_paths):
+            return None
+        return set(payload['student_ids'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+# orjson 原生序列化 numpy 标量/数组（C 实现），非字符串键按字符串输出
+_ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+# orjson 无法直接序列化的类型 → 转换函数（按 type 精确查表，一次字典查找完成分派）
+_ORJSON_FALLBACKS = {
+    type(pd.NA): lambda obj: None,
+    type(pd.NaT): lambda obj: None,
+    pd.Timestamp: lambda obj: obj.isoformat(),
+    set: list,
+    frozenset: list,
+}
+
+
+def _orjson_default(obj):
+    """orjson 的 default 钩子：缺失值（pd.NA / NaT）写为 null，集合转为列表，其余未知类型转为字符串"""
+    converter = _ORJSON_FALLBACKS.get(type(obj))
+    if converter is not None:
+        return converter(obj)
+    return str(obj)
+
+
+def _serialize_question_choices(question_choices):
+    """把选项列表序列化为 JSON 字符串（结果中的 question_choices 列），无选项时为 None"""
+    if not question_choices:
+        return None
+    return orjson.dumps(question_choices, option=_ORJSON_OPTIONS, default=_orjson_default).decode('utf-8')
+
+
 # --- 4. 实验主循环 ---
-async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_duration=0):
+def _format_prompt_log_entry(student_id, question_id, experiment_label, system_prompt, user_prompt, raw_resp):
+    """格式化单条提示词日志"""
+    return (
+        f"--- PROMPT FOR STUDENT {student_id}, QUESTION {question_id} ({experiment_label}) ---\n"
+        "--- SYSTEM PROMPT ---\n" + system_prompt + "\n\n"
+        "--- USER PROMPT ---\n" + user_prompt + "\n\n"
+        "--- LLM RESPONSE ---\n" + str(raw_resp) + "\n" + "="*80 + "\n\n"
+    )
+
+
+class AsyncLogWriter:
+    """
+    异步批量日志写入器：调用方用 write() 把文本放入 asyncio.Queue（非阻塞），
+    由单个后台协程攒批（最多 max_batch_bytes 字节或 max_delay 秒）后在线程池中一次 write，
+    不阻塞事件循环。文件在第一次写入时才以追加模式打开，close() 发送哨兵并等待全部写完。
+    写入失败（如磁盘已满）只记录警告并丢弃该批，后台协程继续消费队列，不影响实验本身。
+    """
+    
+    def __init__(self, log_path, max_batch_bytes=64 * 1024, max_delay=0.5):
+        self.log_path = log_path
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay = max_delay
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._fh = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+    
+    def write(self, text):
+        self._queue.put_nowait(text)
+    
+    def _write_batch(self, text):
+        if self._fh is None:
+            self._fh = open(self.log_path, "a", encoding="utf-8")
+        self._fh.write(text)
+        self._fh.flush()
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch, batch_bytes, deadline = [], 0, None
+        stopping = False
+        while not stopping:
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            try:
+                items = [await asyncio.wait_for(self._queue.get(), timeout)]
+            except asyncio.TimeoutError:
+                items = []
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+            
+            for item in items:
+                if item is None:  # 哨兵：写完剩余内容后退出
+                    stopping = True
+                    break
+                batch.append(item)
+                batch_bytes += len(item)
+            if batch and deadline is None:
+                deadline = loop.time() + self.max_delay
+            
+            if batch and (stopping or batch_bytes >= self.max_batch_bytes or loop.time() >= deadline):
+                try:
+                    await loop.run_in_executor(None, self._write_batch, "".join(batch))
+                except Exception as e:
+                    logger.warning("写入日志 %s 失败，已丢弃 %d 字节: %s", self.log_path, batch_bytes, e)
+                batch, batch_bytes, deadline = [], 0, None
+    
+    async def close(self):
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        try:
+            await self._task
+        finally:
+            self._task = None
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+
+def _rate_limit_hints(exc):
+    """
+    从 LLM 调用异常中提取限流信号，返回 (是否限流/过载, 建议暂停秒数或 None)。
+    兼容 OpenAI 风格 SDK 的异常（status_code / response.headers），其他异常退化为按错误信息判断。
+    """
+    response = getattr(exc, 'response', None)
+    status = getattr(exc, 'status_code', None) or getattr(response, 'status_code', None)
+    message = str(exc).lower()
+    throttled = (
+        isinstance(exc, asyncio.TimeoutError)
+        or status == 429
+        or (isinstance(status, int) and status >= 500)
+        or '429' in message
+        or 'rate limit' in message
+        or 'timeout' in message
+        or 'timed out' in message
+    )
+    
+    pause = None
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            pause = float(retry_after)
+        elif str(headers.get('x-ratelimit-remaining-requests', '')).strip() == '0':
+            pause = 1.0
+    except (AttributeError, TypeError, ValueError):
+        pass
+    return throttled, pause
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD（加性增、乘性减）自适应并发控制器，借鉴 TCP 拥塞控制逼近服务端的真实限流上限。
+    
+    - 每完成 window 个请求统计一次平均延迟：不超过 latency_target 时并发上限 +1（不超过 max_limit）；
+      超过目标延迟，或窗口内出现 429/5xx/超时，则并发上限减半（不低于 min_limit）
+    - 限流错误带 Retry-After（或 x-ratelimit-remaining-requests 为 0）时，暂停新请求的准入直到期满
+    - rpm_limit > 0 时用最近 60 秒的请求时间戳（滑动窗口）限制每分钟请求数
+    
+    adaptive=False 时并发上限固定为 max_limit，只保留 Retry-After 暂停与 RPM 限制。
+    """
+    
+    def __init__(self, max_limit, initial_limit=None, min_limit=1, latency_target=20.0, window=32, rpm_limit=0, adaptive=True):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = min(self.max_limit, max(self.min_limit, int(initial_limit or self.max_limit)))
+        self.latency_target = latency_target
+        self.window = max(1, int(window))
+        self.rpm_limit = rpm_limit or 0
+        self.adaptive = adaptive
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+        self._window_latencies = []
+        self._window_throttled = False
+        self._request_times = deque()
+        self._paused_until = 0.0
+    
+    def _admission_delay(self, now):
+        """距离允许发出下一个请求还需等待的秒数（<= 0 表示可以立即发出）"""
+        delay = self._paused_until - now
+        if self.rpm_limit > 0:
+            while self._request_times and now - self._request_times[0] >= 60:
+                self._request_times.popleft()
+            if len(self._request_times) >= self.rpm_limit:
+                delay = max(delay, 60 - (now - self._request_times[0]))
+        return delay
+    
+    async def _acquire(self):
+        async with self._cond:
+            while True:
+                await self._cond.wait_for(lambda: self._in_flight < self.limit)
+                delay = self._admission_delay(time.monotonic())
+                if delay <= 0:
+                    break
+                # 等待期间释放锁，让完成的请求可以归还名额
+                self._cond.release()
+                try:
+                    await asyncio.sleep(delay)
+                finally:
+                    await self._cond.acquire()
+            self._in_flight += 1
+            if self.rpm_limit > 0:
+                self._request_times.append(time.monotonic())
+    
+    async def _release(self, latency, throttled, pause):
+        async with self._cond:
+            self._in_flight -= 1
+            if pause:
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            
+            if not self.adaptive:
+                self._cond.notify_all()
+                return
+            
+            self._window_latencies.append(latency)
+            self._window_throttled = self._window_throttled or throttled
+            if len(self._window_latencies) >= self.window:
+                mean_latency = sum(self._window_latencies) / len(self._window_latencies)
+                previous_limit = self.limit
+                if self._window_throttled or (self.latency_target and mean_latency > self.latency_target):
+                    self.limit = max(self.min_limit, self.limit // 2)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1)
+                if self.limit != previous_limit:
+                    logger.info(
+                        "自适应并发上限 %d -> %d（窗口平均延迟 %.2fs，限流: %s）",
+                        previous_limit, self.limit, mean_latency, self._window_throttled
+                    )
+                self._window_latencies = []
+                self._window_throttled = False
+            
+            self._cond.notify_all()
+    
+    async def run(self, call):
+        """在并发名额内执行一次调用：call 为无参协程函数，异常原样抛出并计入限流统计"""
+        await self._acquire()
+        started = time.monotonic()
+        throttled, pause = False, None
+        try:
+            return await call()
+        except Exception as e:
+            throttled, pause = _rate_limit_hints(e)
+            raise
+        finally:
+            await self._release(time.monotonic() - started, throttled, pause)
+
+
+async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_duration=0, limiter=None):
     """
     统一并发执行所有LLM请求
     
@@ -1108,9 +1809,12 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
         requests: 请求列表（包含所有学生的所有题目）
         concurrency_limit: 最大并发API请求数
         spread_duration: 将所有请求分散到指定秒数内（0表示禁用）
+        limiter: AdaptiveConcurrencyLimiter 实例，在信号量之内再按 AIMD 动态收紧实际并发；None 表示不启用
     """
     print(f"   📊 请求统计: {len(requests)} 个")
     print(f"   ⚡ 并发控制: 最多 {concurrency_limit} 个同时进行")
+    if limiter is not None:
+        print(f"   🎚️  自适应并发: 当前上限 {limiter.limit}/{limiter.max_limit}")
     
     if spread_duration > 0:
         delay_per_request = spread_duration / len(requests)
@@ -1122,6 +1826,20 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
     # 创建信号量控制并发
     semaphore = asyncio.Semaphore(concurrency_limit)
     
+    async def call_model(req):
+        """单次 API 调用（启用自适应并发时经 limiter 准入并统计延迟/限流）"""
+        if limiter is None:
+            return await user_sys_call_with_model(
+                user_prompt=req.user_prompt,
+                system_prompt=req.system_prompt,
+                model_name=req.model_name
+            )
+        return await limiter.run(lambda: user_sys_call_with_model(
+            user_prompt=req.user_prompt,
+            system_prompt=req.system_prompt,
+            model_name=req.model_name
+        ))
+    
     async def execute_single_request(req, index, start_delay):
         """执行单个请求（带信号量控制和重试）"""
         # 削峰填谷延迟
@@ -1130,8 +1848,8 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
         
         # 信号量控制并发
         async with semaphore:
-            student_id = req.get('student_id', 'Unknown')
-            question_id = req.get('practice_data', {}).get('question_id', index)
+            student_id = req.student_id
+            question_id = req.practice_data.get('question_id', index)
             
             # 重试机制
             retry_delays = [5, 10, 30]
@@ -1141,11 +1859,7 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
                 try:
                     if attempt == 0:
                         # 首次尝试
-                        result = await user_sys_call_with_model(
-                            user_prompt=req.get('user_prompt', ''),
-                            system_prompt=req.get('system_prompt', ''),
-                            model_name=req.get('model_name', MODEL_NAME)
-                        )
+                        result = await call_model(req)
                         # 成功
                         return {"index": index, "result": result, "error": None}
                     else:
@@ -1154,11 +1868,7 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
                         print(f"   🔄 [{index+1}] 重试 {attempt}/{len(retry_delays)} - 等待{retry_delay}秒")
                         await asyncio.sleep(retry_delay)
                         
-                        result = await user_sys_call_with_model(
-                            user_prompt=req.get('user_prompt', ''),
-                            system_prompt=req.get('system_prompt', ''),
-                            model_name=req.get('model_name', MODEL_NAME)
-                        )
+                        result = await call_model(req)
                         print(f"   ✅ [{index+1}] 重试成功")
                         return {"index": index, "result": result, "error": None}
                         
@@ -1225,12 +1935,233 @@ async def create_concurrent_llm_requests(requests, concurrency_limit=30, spread_
     print(f"   失败: {fail_count}/{len(processed_results)}")
     if fail_count > 0:
         print(f"   ⚠️  失败率: {fail_count/len(processed_results):.1%}")
+    if limiter is not None:
+        print(f"   🎚️  自适应并发上限: {limiter.limit}/{limiter.max_limit}")
     
     return processed_results
 
+class LLMResponseCache:
+    """
+    基于 SQLite 的 LLM 响应持久化缓存。
+    
+    key = sha256(system_prompt + '\\x00' + user_prompt + '\\x00' + model_name)，只缓存成功的响应；
+    ttl_seconds 为 None 或 0 时永不过期，否则超过有效期的记录视为未命中；
+    read_enabled=False 时只写不读（如 --no-resume 重新采样时仍刷新缓存，但不复用旧响应）。
+    """
+    
+    _LOOKUP_BATCH = 500  # 单条 SELECT 的 IN 参数个数上限（低于 SQLite 默认变量上限）
+    
+    def __init__(self, db_path, ttl_seconds=None, read_enabled=True):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.read_enabled = read_enabled
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (hash TEXT PRIMARY KEY, response TEXT, ts INTEGER)"
+        )
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(system_prompt, user_prompt, model_name):
+        payload = f"{system_prompt}\x00{user_prompt}\x00{model_name}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get_many(self, keys):
+        """批量查询，返回 {key: response}（仅包含未过期的命中项）"""
+        if not self.read_enabled:
+            return {}
+        keys = list(keys)
+        min_ts = int(time.time() - self.ttl_seconds) if self.ttl_seconds else None
+        hits = {}
+        for i in range(0, len(keys), self._LOOKUP_BATCH):
+            batch = keys[i:i + self._LOOKUP_BATCH]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT hash, response, ts FROM llm_cache WHERE hash IN ({placeholders})", batch
+            )
+            for key, response, ts in rows:
+                if min_ts is None or ts >= min_ts:
+                    hits[key] = response
+        return hits
+    
+    def put_many(self, items):
+        """批量写入 [(key, response), ...]"""
+        now = int(time.time())
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO llm_cache (hash, response, ts) VALUES (?, ?, ?)",
+            [(key, response, now) for key, response in items]
+        )
+        self._conn.commit()
+    
+    def close(self):
+        self._conn.close()
+
+
+class SemanticResponseCache:
+    """
+    基于句向量的近似响应缓存（可选功能，依赖 sentence-transformers 与 faiss，未安装时构造会抛出 ImportError）。
+    
+    对 user_prompt 做归一化嵌入，在 faiss 内积索引中查找最近邻，余弦相似度不低于 threshold 时复用其响应。
+    为避免"字面相近但含义不同"的误命中，还要求词面约束 guard_key 完全一致：
+    模型、系统提示词（学生画像）、题目 ID、知识点、知识点选项以及掌握度/辅导内容本身都必须相同。
+    （掌握度与辅导内容位于用户提示词末尾，常超出编码器的 256 词元截断长度，嵌入向量区分不了它们，
+    而它们正是实验要对比的变量，因此按内容哈希精确匹配。）
+    索引与响应列表持久化在 cache_dir 下。
+    """
+    
+    def __init__(self, cache_dir, threshold=0.97, model_name='sentence-transformers/all-MiniLM-L6-v2', top_k=8, read_enabled=True):
+        import faiss
+        from sentence_transformers import SentenceTransformer
+        
+        self._faiss = faiss
+        self.threshold = threshold
+        self.read_enabled = read_enabled  # False 时只写不读，与 LLMResponseCache 相同
+        self.top_k = top_k
+        self._encoder = SentenceTransformer(model_name)
+        self._index_path = os.path.join(cache_dir, 'semantic_cache.faiss')
+        self._entries_path = os.path.join(cache_dir, 'semantic_cache_entries.json')
+        if os.path.exists(self._index_path) and os.path.exists(self._entries_path):
+            self._index = faiss.read_index(self._index_path)
+            with open(self._entries_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)  # [{'guard': ..., 'response': ...}]，与索引中的向量一一对应
+        else:
+            self._index = faiss.IndexFlatIP(self._encoder.get_sentence_embedding_dimension())
+            self._entries = []
+    
+    _KC_OPTIONS_RE = re.compile(r'^[^\S\n]*Options: (.*)$', re.MULTILINE)
+    
+    @staticmethod
+    def _content_hash(value):
+        """掌握度/辅导内容等上下文的哈希；为空时返回空串"""
+        if value is None or (isinstance(value, float) and math.isnan(value)) or value == '':
+            return ''
+        return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+    
+    @classmethod
+    def guard_key(cls, req):
+        practice_data = req.practice_data
+        kc_options = cls._KC_OPTIONS_RE.search(req.user_prompt)
+        return "\x00".join([
+            str(req.model_name),
+            hashlib.sha256(req.system_prompt.encode('utf-8')).hexdigest(),
+            str(practice_data.get('question_id')),
+            str(practice_data.get('know_name')),
+            cls._content_hash(kc_options.group(1) if kc_options else None),
+            cls._content_hash(req.mastery_summary),
+            cls._content_hash(req.tutoring_summary),
+        ])
+    
+    def encode(self, requests):
+        embeddings = self._encoder.encode(
+            [req.user_prompt for req in requests], normalize_embeddings=True, convert_to_numpy=True
+        )
+        return np.ascontiguousarray(embeddings, dtype='float32')
+    
+    def lookup(self, requests, embeddings):
+        """返回 {请求下标: 缓存响应}"""
+        hits = {}
+        if not self.read_enabled or self._index.ntotal == 0 or not requests:
+            return hits
+        scores, entry_ids = self._index.search(embeddings, min(self.top_k, self._index.ntotal))
+        for i, req in enumerate(requests):
+            guard = self.guard_key(req)
+            for score, entry_id in zip(scores[i], entry_ids[i]):
+                if entry_id < 0 or score < self.threshold:
+                    break  # 结果按相似度降序排列
+                entry = self._entries[entry_id]
+                if entry['guard'] == guard:
+                    hits[i] = entry['response']
+                    break
+        return hits
+    
+    def add(self, requests, embeddings, responses):
+        self._index.add(embeddings)
+        self._entries.extend(
+            {'guard': self.guard_key(req), 'response': response}
+            for req, response in zip(requests, responses)
+        )
+    
+    def save(self):
+        self._faiss.write_index(self._index, self._index_path)
+        with open(self._entries_path, 'w', encoding='utf-8') as f:
+            json.dump(self._entries, f, ensure_ascii=False)
+
+
+async def dispatch_llm_requests(requests, concurrency_limit=30, spread_duration=0, response_cache=None, semantic_cache=None, limiter=None):
+    """
+    带响应缓存的请求分发：先查精确缓存，再查语义缓存（如果启用），只把未命中的请求交给
+    create_concurrent_llm_requests，再按原始下标合并结果，并把新的成功响应写回缓存。
+    返回值格式与 create_concurrent_llm_requests 一致；来自缓存的结果额外带 "from_cache": True。
+    """
+    if response_cache is None and semantic_cache is None:
+        return await create_concurrent_llm_requests(requests, concurrency_limit, spread_duration, limiter=limiter)
+    
+    results = [None] * len(requests)
+    pending_indices = list(range(len(requests)))
+    
+    keys = None
+    if response_cache is not None:
+        keys = [
+            LLMResponseCache.make_key(req.system_prompt, req.user_prompt, req.model_name)
+            for req in requests
+        ]
+        cached = response_cache.get_many(set(keys))
+        
+        pending_indices = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                results[i] = {"index": i, "result": cached[key], "error": None, "from_cache": True}
+            else:
+                pending_indices.append(i)
+        
+        print(f"   💾 响应缓存: 命中 {len(requests) - len(pending_indices)}/{len(requests)}，需请求 {len(pending_indices)} 个")
+    
+    pending_embeddings = None
+    if semantic_cache is not None and pending_indices:
+        pending_embeddings = semantic_cache.encode([requests[i] for i in pending_indices])
+        semantic_hits = semantic_cache.lookup([requests[i] for i in pending_indices], pending_embeddings)
+        if semantic_hits:
+            for j, response in semantic_hits.items():
+                i = pending_indices[j]
+                results[i] = {"index": i, "result": response, "error": None, "from_cache": True}
+            remaining = [j for j in range(len(pending_indices)) if j not in semantic_hits]
+            pending_indices = [pending_indices[j] for j in remaining]
+            pending_embeddings = pending_embeddings[remaining]
+        print(f"   🧭 语义缓存: 命中 {len(semantic_hits)} 个，需请求 {len(pending_indices)} 个")
+    
+    if not pending_indices:
+        return results
+    
+    pending_results = await create_concurrent_llm_requests(
+        [requests[i] for i in pending_indices],
+        concurrency_limit=concurrency_limit,
+        spread_duration=spread_duration,
+        limiter=limiter
+    )
+    
+    succeeded = []  # pending 列表中成功请求的位置
+    for j, (i, result) in enumerate(zip(pending_indices, pending_results)):
+        result["index"] = i
+        results[i] = result
+        if result.get('error') is None and isinstance(result.get('result'), str):
+            succeeded.append(j)
+    
+    if succeeded and response_cache is not None:
+        response_cache.put_many([
+            (keys[pending_indices[j]], results[pending_indices[j]]['result']) for j in succeeded
+        ])
+    if succeeded and semantic_cache is not None:
+        semantic_cache.add(
+            [requests[pending_indices[j]] for j in succeeded],
+            pending_embeddings[succeeded],
+            [results[pending_indices[j]]['result'] for j in succeeded]
+        )
+        semantic_cache.save()
+    return results
+
 # 注意：run_simulation_for_student 函数已废弃，新架构使用统一请求池
 # 保留此函数仅为向后兼容，实际已不再使用
-async def run_simulation_for_student_DEPRECATED(student_id, student_records_df, semaphore, prompt_log_path, position, all_kc_names, overall_pbar, mastery_lookup=None, related_kc_map=None, kc_to_questions_map=None, question_text_map=None, recommendation_log_path=None, kc_descriptions=None, question_choices_df=None, use_mastery=True, use_tutoring=True, spread_duration=0):
+async def run_simulation_for_student_DEPRECATED(student_id, student_records_df, semaphore, prompt_log_path, position, all_kc_names, overall_pbar, mastery_lookup=None, related_kc_map=None, kc_to_questions_map=None, question_text_map=None, recommendation_log_path=None, kc_descriptions=None, question_choices_df=None, use_mastery=True, use_tutoring=True, spread_duration=0, split_cache=None):
     """
     对单个学生运行完整模拟实验
     
@@ -1247,7 +2178,7 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
         print(f"🎓 学生 {student_id} - 准备请求")
         print(f"{'='*60}")
         
-        train_df, test_df = train_test_split(student_records_df, test_size=0.1, random_state=42, shuffle=True)
+        train_df, test_df = split_student_records(student_records_df, split_cache.get(student_id) if split_cache else None)
         
         # 提取测试集题目ID（每个学生的测试集不同）
         test_question_ids = set(test_df['question_id'].tolist()) if not test_df.empty else set()
@@ -1284,6 +2215,8 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
             - tutoring_content_dict: 辅导内容字典（按知识点组织）
             """
             requests = []
+            # 同一学生所有题目共用一份系统提示词（intern 后所有请求共享同一字符串对象）
+            system_prompt = sys.intern(profile.build_prompt())
             for _, practice in test_df.iterrows():
                 # 长期记忆：掌握度信息（仅 Mastery Only 模式）
                 mastery_summary = None
@@ -1300,7 +2233,6 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
                 question_choices = get_question_choices(practice['question_id'], question_choices_df)
                 
                 # 构建Prompt（传入辅导字典，内部会自动匹配相关知识点）
-                system_prompt = profile.build_prompt()
                 user_prompt = _build_agent_prompt(
                     practice,
                     all_kc_names,
@@ -1314,15 +2246,16 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
                 if tutoring_content_dict:
                     actual_tutoring_used = tutoring_content_dict.get(practice['know_name'], None)
                 
-                request = {
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "model_name": MODEL_NAME,
-                    "practice_data": practice.to_dict(),
-                    "mastery_summary": mastery_summary,
-                    "tutoring_summary": actual_tutoring_used,  # 记录实际使用的辅导内容
-                    "question_choices": question_choices
-                }
+                request = LLMRequest(
+                    system_prompt=system_prompt,
+                    user_prompt=user_prompt,
+                    model_name=MODEL_NAME,
+                    student_id=student_id,
+                    practice_data=practice.to_dict(),
+                    mastery_summary=mastery_summary,
+                    tutoring_summary=actual_tutoring_used,  # 记录实际使用的辅导内容
+                    question_choices=question_choices
+                )
                 requests.append(request)
             return requests
         
@@ -1355,18 +2288,19 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
                     pass
 
             # llm_results 已经是按索引排序的
+            prompt_log = AsyncLogWriter(prompt_log_path).start()
 
             for i, result in enumerate(llm_results):
                 raw_resp = result.get('result')
                 error = result.get('error')
                 if error:
                     raw_resp = f"LLM_CALL_FAILED: {error}"
-                    question_id = llm_requests[i]['practice_data'].get('question_id', 'Unknown')
+                    question_id = llm_requests[i].practice_data.get('question_id', 'Unknown')
                     print(f"   ⚠️  题目 {question_id} 请求失败: {str(error)[:80]}")
 
                 ans = _parse_llm_response(raw_resp)
-                practice_data = llm_requests[i]['practice_data']
-                question_choices = llm_requests[i].get('question_choices')
+                practice_data = llm_requests[i].practice_data
+                question_choices = llm_requests[i].question_choices
                 
                 # 获取正确答案的choice_id
                 correct_choice_id = None
@@ -1376,11 +2310,10 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
                             correct_choice_id = choice.get('choice_id')
                             break
 
-                with open(prompt_log_path, "a", encoding="utf-8") as f:
-                    f.write(f"--- PROMPT FOR STUDENT {student_id}, QUESTION {practice_data['question_id']} ({experiment_label or 'baseline'}) ---\n")
-                    f.write("--- SYSTEM PROMPT ---\n" + llm_requests[i]['system_prompt'] + "\n\n")
-                    f.write("--- USER PROMPT ---\n" + llm_requests[i]['user_prompt'] + "\n\n")
-                    f.write("--- LLM RESPONSE ---\n" + str(raw_resp) + "\n" + "="*80 + "\n\n")
+                prompt_log.write(_format_prompt_log_entry(
+                    student_id, practice_data['question_id'], experiment_label or 'baseline',
+                    llm_requests[i].system_prompt, llm_requests[i].user_prompt, raw_resp
+                ))
 
                 student_results.append({
                     'student_id': student_id,
@@ -1394,16 +2327,18 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
                     'predicted_task3_reasoning': ans.get('task3'),
                     'predicted_task4_answer_choice': ans.get('task4'),
                     'llm_raw_response': raw_resp,
-                    'prompt_system': llm_requests[i].get('system_prompt', ''),
-                    'prompt_user': llm_requests[i].get('user_prompt', ''),
-                    'mastery_summary': llm_requests[i].get('mastery_summary'),
-                    'tutoring_summary': llm_requests[i].get('tutoring_summary'),
+                    'prompt_system': llm_requests[i].system_prompt,
+                    'prompt_user': llm_requests[i].user_prompt,
+                    'mastery_summary': llm_requests[i].mastery_summary,
+                    'tutoring_summary': llm_requests[i].tutoring_summary,
                     'experiment_type': experiment_label or 'baseline',
-                    'question_choices': str(question_choices) if question_choices else None
+                    'question_choices': _serialize_question_choices(question_choices)
                 })
                 if overall_pbar:
                     overall_pbar.update(1)
 
+            await prompt_log.close()
+
         # 根据实验模式执行不同的请求构建
         if mastery_lookup and related_kc_map and use_mastery:
             # Mastery Only模式：有掌握度（长期记忆），无辅导（短期记忆）
@@ -1422,7 +2357,200 @@ async def run_simulation_for_student_DEPRECATED(student_id, student_records_df,
         
         return student_results
 
-async def run_experiment(student_ids, all_student_records, concurrency_limit, prompt_log_path, all_kc_names, mastery_lookup=None, related_kc_map=None, kc_to_questions_map=None, question_text_map=None, recommendation_log_path=None, kc_descriptions=None, question_choices_df=None, use_mastery=True, use_tutoring=True, tutoring_lookup=None, spread_duration=0, on_student_complete=None):
+# 学生数少于该值时直接串行准备请求（进程池启动和数据传输的开销不划算）
+_PARALLEL_PREP_MIN_STUDENTS = 16
+
+# 请求准备阶段各子进程共享的只读输入（由进程池 initializer 设置）
+_PREP_CTX = None
+
+
+def _process_pool(max_workers, **kwargs):
+    """
+    创建 ProcessPoolExecutor，子进程用 forkserver（不支持的平台用 spawn）启动。
+    
+    调用时事件循环中通常已有其他线程（日志写入用的默认线程池、tqdm 的监控线程等），
+    在多线程进程里直接 fork 可能因子进程继承到被占用的锁而死锁。
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method), **kwargs)
+
+
+def _init_prep_worker(prep_ctx):
+    global _PREP_CTX
+    _PREP_CTX = prep_ctx
+
+
+def _prepare_student_requests(student_id, student_records_df, prep_ctx, split_positions=None):
+    """
+    为单个学生构建所有测试题的 LLMRequest（纯 CPU 工作，可在子进程中运行）。
+    
+    返回一个字典：requests / messages（需在主进程打印的提示）/ incomplete_tutoring（辅导数据不完整）/
+    error、traceback、tutoring_debug（准备失败时的错误信息，由主进程写入失败日志）
+    """
+    prepared = {
+        'student_id': student_id,
+        'requests': [],
+        'messages': [],
+        'incomplete_tutoring': False,
+        'error': None,
+        'traceback': '',
+        'tutoring_debug': '',
+    }
+    all_kc_names = prep_ctx['all_kc_names']
+    use_mastery = prep_ctx['use_mastery']
+    use_tutoring = prep_ctx['use_tutoring']
+    mastery_lookup = prep_ctx['mastery_lookup']
+    related_kc_map = prep_ctx['related_kc_map']
+    tutoring_content_map = prep_ctx['tutoring_content_map']
+    tutoring_dict = None
+    try:
+        train_df, test_df = split_student_records(student_records_df, split_positions)
+        rng = random.Random(f"{prep_ctx['seed']}:{student_id}")
+        
+        # 构建 Profile
+        profile = Profile(student_id, train_df, len(all_kc_names))
+        
+        # 准备辅导内容（如果启用）
+        if use_tutoring:
+            # 🔥 只使用预加载的辅导内容，不支持实时生成
+            if tutoring_content_map and student_id in tutoring_content_map:
+                # 预加载的辅导内容（已在 load_tutoring_content_results 中清洗为字符串，只读共享）
+                tutoring_dict = tutoring_content_map[student_id]
+                
+                # 🔥 改进：检查测试集KC的完整性
+                test_kcs = set(test_df['know_name'].dropna().unique()) if not test_df.empty else set()
+                available_kcs = set(tutoring_dict.keys())
+                missing_kcs = test_kcs - available_kcs
+                
+                if len(tutoring_dict) > 0:
+                    if missing_kcs:
+                        # 部分KC缺失
+                        prepared['messages'].append(f"   ⚠️  学生 {student_id}: 已加载 {len(tutoring_dict)} 个KC辅导，但缺少 {len(missing_kcs)} 个测试集KC: {list(missing_kcs)[:3]}...")
+                        prepared['incomplete_tutoring'] = True  # 记录为不完整
+                    else:
+                        # 所有测试集KC都有辅导
+                        prepared['messages'].append(f"   ✅ 学生 {student_id}: 已加载 {len(tutoring_dict)} 个知识点的辅导内容（测试集完整覆盖）")
+                else:
+                    # 有学生记录但没有任何辅导内容
+                    prepared['messages'].append(f"   ⚠️  学生 {student_id}: 辅导内容为空")
+                    prepared['incomplete_tutoring'] = True
+            else:
+                # 🔥 如果没有预加载数据，使用空字典（退化为 baseline）
+                tutoring_dict = {}  # 空字典，不会添加辅导内容到 Prompt
+                prepared['messages'].append(f"   ⚠️  学生 {student_id}: 未找到预加载的辅导内容，使用空辅导（退化为 baseline 模式）")
+                prepared['incomplete_tutoring'] = True  # 仍然记录，便于后续补充数据
+        
+        # 为该学生的每道测试题构建请求
+        # 同一学生所有题目共用一份系统提示词（intern 后所有请求共享同一字符串对象）
+        system_prompt = sys.intern(profile.build_prompt())
+        for _, practice in test_df.iterrows():
+            # 构建掌握度摘要（如果启用）
+            mastery_summary = None
+            if use_mastery and mastery_lookup and related_kc_map:
+                mastery_summary = build_mastery_summary(
+                    student_id, practice['know_name'],
+                    related_kc_map, mastery_lookup, prep_ctx['kc_descriptions']
+                )
+            
+            # 获取题目选项
+            question_choices = get_question_choices(practice['question_id'], prep_ctx['question_choices_df'])
+            
+            # 构建 Prompt
+            user_prompt = _build_agent_prompt(
+                practice, all_kc_names, question_choices,
+                mastery_summary=mastery_summary,
+                tutoring_dict=tutoring_dict,
+                rng=rng
+            )
+            
+            # 获取实际使用的辅导内容
+            actual_tutoring_used = tutoring_dict.get(practice['know_name'], None) if tutoring_dict else None
+            
+            prepared['requests'].append(LLMRequest(
+                system_prompt=system_prompt,
+                user_prompt=user_prompt,
+                model_name=prep_ctx['model_name'],
+                student_id=student_id,
+                practice_data=practice.to_dict(),
+                mastery_summary=mastery_summary,
+                tutoring_summary=actual_tutoring_used,
+                question_choices=question_choices
+            ))
+    
+    except Exception as e:
+        prepared['requests'] = []
+        prepared['error'] = str(e)
+        prepared['traceback'] = traceback.format_exc()
+        
+        # 🔥 记录辅导内容信息（如果有）
+        if use_tutoring and tutoring_dict:
+            debug_lines = [
+                f"\n--- 辅导内容信息 ---\n",
+                f"已加载知识点数: {len(tutoring_dict)}\n",
+                f"知识点列表: {list(tutoring_dict.keys())[:10]}...\n",
+            ]
+            
+            # 检查是否有非字符串类型的辅导内容
+            non_string_kcs = []
+            for kc, content in tutoring_dict.items():
+                if not isinstance(content, str):
+                    non_string_kcs.append({
+                        'kc': kc,
+                        'type': type(content).__name__,
+                        'is_nan': pd.isna(content) if hasattr(pd, 'isna') else False,
+                        'value_preview': str(content)[:100]
+                    })
+            
+            if non_string_kcs:
+                debug_lines.append(f"\n⚠️  发现 {len(non_string_kcs)} 个非字符串类型的辅导内容:\n")
+                for item in non_string_kcs[:5]:  # 只显示前5个
+                    debug_lines.append(f"  - 知识点: {item['kc']}\n")
+                    debug_lines.append(f"    类型: {item['type']}\n")
+                    debug_lines.append(f"    是否NaN: {item['is_nan']}\n")
+                    debug_lines.append(f"    值预览: {item['value_preview']}\n")
+            prepared['tutoring_debug'] = "".join(debug_lines)
+    
+    return prepared
+
+
+def _prepare_student_chunk(chunk):
+    """子进程入口：为一组 (student_id, student_records_df, split_positions) 准备请求"""
+    return [
+        _prepare_student_requests(student_id, student_records_df, _PREP_CTX, split_positions)
+        for student_id, student_records_df, split_positions in chunk
+    ]
+
+
+def _iter_prepared_students(student_ids, all_student_records, prep_ctx, prep_workers=None, split_cache=None):
+    """
+    按 student_ids 顺序逐个产出每个学生的准备结果。
+    
+    学生数较多时将学生分块交给 ProcessPoolExecutor 并行构建（只读输入通过 initializer 传入各子进程一次），
+    否则在当前进程串行构建。
+    """
+    workers = prep_workers or os.cpu_count() or 1
+    workers = min(workers, len(student_ids))
+    split_cache = split_cache or {}
+    if workers <= 1 or len(student_ids) < _PARALLEL_PREP_MIN_STUDENTS:
+        for student_id in student_ids:
+            yield _prepare_student_requests(student_id, all_student_records[student_id], prep_ctx, split_cache.get(student_id))
+        return
+    
+    # 每个进程分到若干个小块，既能均衡负载，又能让进度条持续推进
+    chunk_size = max(1, math.ceil(len(student_ids) / (workers * 4)))
+    chunks = [
+        [
+            (student_id, all_student_records[student_id], split_cache.get(student_id))
+            for student_id in student_ids[i:i + chunk_size]
+        ]
+        for i in range(0, len(student_ids), chunk_size)
+    ]
+    with _process_pool(workers, initializer=_init_prep_worker, initargs=(prep_ctx,)) as executor:
+        for chunk_results in executor.map(_prepare_student_chunk, chunks):
+            yield from chunk_results
+
+
+async def run_experiment(student_ids, all_student_records, concurrency_limit, prompt_log_path, all_kc_names, mastery_lookup=None, related_kc_map=None, kc_to_questions_map=None, question_text_map=None, recommendation_log_path=None, kc_descriptions=None, question_choices_df=None, use_mastery=True, use_tutoring=True, tutoring_lookup=None, spread_duration=0, on_student_complete=None, prep_workers=None, split_cache=None, response_cache=None, semantic_cache=None, limiter=None, exp_mode=None):
     """
     并发地对指定学生列表运行完整的 Agent 模拟实验。
     
@@ -1436,7 +2564,16 @@ async def run_experiment(student_ids, all_student_records, concurrency_limit, pr
         use_tutoring: 是否使用辅导输出
         tutoring_lookup: 预加载的辅导内容字典 {student_id: {kc_name: {...}}}
         spread_duration: 请求削峰填谷时间（秒），0表示禁用
-        on_student_complete: 回调函数，在每个学生完成时调用，签名: callback(student_id, student_results)
+        on_student_complete: 回调函数，在每个学生完成时调用，签名: callback(student_id, student_results)，
+            其中 student_results 为按列组织的字典 {列名: [值, ...]}，可直接传给 pd.DataFrame。
+            提供回调时，返回的 DataFrame 不再包含 _BULKY_RESULT_COLUMNS（提示词与原始响应），
+            由回调负责保存完整结果，避免整场实验的大文本在内存中再保留一份
+        prep_workers: 第1步准备请求的进程数，None 表示使用全部 CPU 核心，1 表示串行
+        split_cache: build_split_cache 生成的训练/测试集划分缓存，None 表示现场划分
+        response_cache: LLMResponseCache 实例，命中的请求不再调用 API；None 表示不使用缓存
+        semantic_cache: SemanticResponseCache 实例，近似命中的请求复用缓存响应；None 表示不启用
+        limiter: AdaptiveConcurrencyLimiter 实例，按延迟与限流信号动态调整实际并发；None 表示固定并发
+        exp_mode: 请求的实验模式名，用于失败日志文件名（各模式并行时互不冲突）；None 表示按 use_mastery/use_tutoring 推断
     """
     print("\n" + "="*80)
     print("🤖 阶段 2/3: 并发运行智能体模拟 (统一请求池架构)".center(80))
@@ -1453,7 +2590,7 @@ async def run_experiment(student_ids, all_student_records, concurrency_limit, pr
     
     # 失败日志文件（按模式与模型区分）
     model_suffix = MODEL_NAME.replace('/', '_').replace('.', '_')
-    exp_mode_label = 'mastery_only' if (use_mastery and not use_tutoring) else ('tutoring_only' if (use_tutoring and not use_mastery) else 'baseline')
+    exp_mode_label = exp_mode or ('mastery_only' if (use_mastery and not use_tutoring) else ('tutoring_only' if (use_tutoring and not use_mastery) else 'baseline'))
     error_log_path = os.path.join(os.path.dirname(prompt_log_path), f"experiment_errors_{exp_mode_label}_{model_suffix}.txt")
     print(f"   📝 失败日志: {error_log_path}")
     
@@ -1463,152 +2600,62 @@ async def run_experiment(student_ids, all_student_records, concurrency_limit, pr
     student_request_mapping = {}  # {student_id: [request_indices]}
     skipped_students = []  # 🔥 记录被跳过的学生
     
-    # 🔥 使用 tqdm 的 write 方法避免干扰进度条
-    pbar = tqdm(student_ids, desc="准备学生请求")
-    for student_id in pbar:
-        try:
-            student_records_df = all_student_records[student_id]
-            train_df, test_df = train_test_split(student_records_df, test_size=0.1, random_state=42, shuffle=True)
-            
-            # 构建 Profile
-            profile = Profile(student_id, train_df, len(all_kc_names))
-            
-            # 准备辅导内容（如果启用）
-            tutoring_dict = None
-            if use_tutoring:
-                # 🔥 只使用预加载的辅导内容，不支持实时生成
-                if tutoring_lookup and student_id in tutoring_lookup:
-                    # 从预加载的数据中提取辅导内容
-                    tutoring_dict = {}
-                    for kc_name, kc_data in tutoring_lookup[student_id].items():
-                        content = kc_data.get('tutoring_content', '')
-                        
-                        # 🔥 数据清洗：处理 NaN 和非字符串类型
-                        if content is None or (isinstance(content, float) and pd.isna(content)):
-                            content = ''  # NaN 或 None 转为空字符串
-                        elif not isinstance(content, str):
-                            try:
-                                content = str(content)  # 尝试转换为字符串
-                            except:
-                                content = ''  # 转换失败则使用空字符串
-                        
-                        tutoring_dict[kc_name] = content
-                    
-                    # 🔥 改进：检查测试集KC的完整性
-                    test_kcs = set(test_df['know_name'].dropna().unique()) if not test_df.empty else set()
-                    available_kcs = set(tutoring_dict.keys())
-                    missing_kcs = test_kcs - available_kcs
-                    
-                    if len(tutoring_dict) > 0:
-                        if missing_kcs:
-                            # 部分KC缺失
-                            pbar.write(f"   ⚠️  学生 {student_id}: 已加载 {len(tutoring_dict)} 个KC辅导，但缺少 {len(missing_kcs)} 个测试集KC: {list(missing_kcs)[:3]}...")
-                            skipped_students.append(student_id)  # 记录为不完整
-                        else:
-                            # 所有测试集KC都有辅导
-                            pbar.write(f"   ✅ 学生 {student_id}: 已加载 {len(tutoring_dict)} 个知识点的辅导内容（测试集完整覆盖）")
-                    else:
-                        # 有学生记录但没有任何辅导内容
-                        pbar.write(f"   ⚠️  学生 {student_id}: 辅导内容为空")
-                        skipped_students.append(student_id)
-                else:
-                    # 🔥 如果没有预加载数据，使用空字典（退化为 baseline）
-                    tutoring_dict = {}  # 空字典，不会添加辅导内容到 Prompt
-                    pbar.write(f"   ⚠️  学生 {student_id}: 未找到预加载的辅导内容，使用空辅导（退化为 baseline 模式）")
-                    skipped_students.append(student_id)  # 仍然记录，便于后续补充数据
-            
-            # 为该学生的每道测试题构建请求
-            student_request_indices = []
-            for _, practice in test_df.iterrows():
-                # 构建掌握度摘要（如果启用）
-                mastery_summary = None
-                if use_mastery and mastery_lookup and related_kc_map:
-                    mastery_summary = build_mastery_summary(
-                        student_id, practice['know_name'],
-                        related_kc_map, mastery_lookup, kc_descriptions
-                    )
-                
-                # 获取题目选项
-                question_choices = get_question_choices(practice['question_id'], question_choices_df)
-                
-                # 构建 Prompt
-                system_prompt = profile.build_prompt()
-                user_prompt = _build_agent_prompt(
-                    practice, all_kc_names, question_choices,
-                    mastery_summary=mastery_summary,
-                    tutoring_dict=tutoring_dict
-                )
-                
-                # 获取实际使用的辅导内容
-                actual_tutoring_used = tutoring_dict.get(practice['know_name'], None) if tutoring_dict else None
-                
-                # 添加到全局请求池
-                request_index = len(all_requests)
-                all_requests.append({
-                    "system_prompt": system_prompt,
-                    "user_prompt": user_prompt,
-                    "model_name": MODEL_NAME,
-                    "student_id": student_id,
-                    "practice_data": practice.to_dict(),
-                    "mastery_summary": mastery_summary,
-                    "tutoring_summary": actual_tutoring_used,
-                    "question_choices": question_choices
-                })
-                student_request_indices.append(request_index)
-            
-            student_request_mapping[student_id] = student_request_indices
-            
-        except Exception as e:
-            # 🔥 添加异常处理，避免单个学生失败导致整个流程卡住
-            pbar.write(f"   ❌ 学生 {student_id} 准备请求失败: {e}")
-            
-            # 🔥 记录详细错误信息到日志文件
-            import traceback
-            error_details = traceback.format_exc()
-            pbar.write(error_details)
+    prep_ctx = {
+        'all_kc_names': all_kc_names,
+        'question_choices_df': question_choices_df,
+        'kc_descriptions': kc_descriptions,
+        'related_kc_map': related_kc_map,
+        'mastery_lookup': mastery_lookup,
+        # 只传辅导文本（不含原始响应与提示词），子进程也只需序列化这一份
+        'tutoring_content_map': build_tutoring_content_map(tutoring_lookup),
+        'use_mastery': use_mastery,
+        'use_tutoring': use_tutoring,
+        'model_name': MODEL_NAME,
+        # 每个学生用独立的随机数生成器，结果与进程数、分块方式无关
+        'seed': random.getrandbits(32),
+    }
+    
+    # 准备阶段是同步的 CPU 工作（串行构建或等待进程池），放到线程中执行，不阻塞事件循环上其他模式的请求与日志协程
+    def collect_prepared_students():
+        # 🔥 使用 tqdm 的 write 方法避免干扰进度条
+        pbar = tqdm(total=len(student_ids), desc="准备学生请求")
+        for prepared in _iter_prepared_students(student_ids, all_student_records, prep_ctx, prep_workers, split_cache):
+            student_id = prepared['student_id']
+            pbar.update(1)
+            for message in prepared['messages']:
+                pbar.write(message)
+            if prepared['incomplete_tutoring']:
+                skipped_students.append(student_id)
             
-            # 写入详细调试信息到错误日志
-            try:
-                with open(error_log_path, 'a', encoding='utf-8') as f:
-                    f.write(f"\n{'='*80}\n")
-                    f.write(f"❌ 学生 {student_id} 准备请求失败\n")
-                    f.write(f"时间: {pd.Timestamp.now()}\n")
-                    f.write(f"错误: {e}\n")
-                    f.write(f"\n--- 堆栈跟踪 ---\n")
-                    f.write(error_details)
-                    
-                    # 🔥 记录辅导内容信息（如果有）
-                    if use_tutoring and tutoring_dict:
-                        f.write(f"\n--- 辅导内容信息 ---\n")
-                        f.write(f"已加载知识点数: {len(tutoring_dict)}\n")
-                        f.write(f"知识点列表: {list(tutoring_dict.keys())[:10]}...\n")
-                        
-                        # 检查是否有非字符串类型的辅导内容
-                        non_string_kcs = []
-                        for kc, content in tutoring_dict.items():
-                            if not isinstance(content, str):
-                                non_string_kcs.append({
-                                    'kc': kc,
-                                    'type': type(content).__name__,
-                                    'is_nan': pd.isna(content) if hasattr(pd, 'isna') else False,
-                                    'value_preview': str(content)[:100]
-                                })
-                        
-                        if non_string_kcs:
-                            f.write(f"\n⚠️  发现 {len(non_string_kcs)} 个非字符串类型的辅导内容:\n")
-                            for item in non_string_kcs[:5]:  # 只显示前5个
-                                f.write(f"  - 知识点: {item['kc']}\n")
-                                f.write(f"    类型: {item['type']}\n")
-                                f.write(f"    是否NaN: {item['is_nan']}\n")
-                                f.write(f"    值预览: {item['value_preview']}\n")
-                    
-                    f.write(f"{'='*80}\n\n")
-            except Exception as log_error:
-                pbar.write(f"   ⚠️  写入错误日志失败: {log_error}")
+            if prepared['error'] is not None:
+                # 🔥 添加异常处理，避免单个学生失败导致整个流程卡住
+                pbar.write(f"   ❌ 学生 {student_id} 准备请求失败: {prepared['error']}")
+                pbar.write(prepared['traceback'])
+                
+                # 写入详细调试信息到错误日志
+                try:
+                    with open(error_log_path, 'a', encoding='utf-8') as f:
+                        f.write(f"\n{'='*80}\n")
+                        f.write(f"❌ 学生 {student_id} 准备请求失败\n")
+                        f.write(f"时间: {pd.Timestamp.now()}\n")
+                        f.write(f"错误: {prepared['error']}\n")
+                        f.write(f"\n--- 堆栈跟踪 ---\n")
+                        f.write(prepared['traceback'])
+                        f.write(prepared['tutoring_debug'])
+                        f.write(f"{'='*80}\n\n")
+                except Exception as log_error:
+                    pbar.write(f"   ⚠️  写入错误日志失败: {log_error}")
+                
+                continue
             
-            continue
+            # 添加到全局请求池
+            first_index = len(all_requests)
+            all_requests.extend(prepared['requests'])
+            student_request_mapping[student_id] = list(range(first_index, len(all_requests)))
+        
+        pbar.close()
     
-    pbar.close()
+    await asyncio.to_thread(collect_prepared_students)
     
     total_requests = len(all_requests)
     successful_students = len(student_request_mapping)
@@ -1640,239 +2687,413 @@ async def run_experiment(student_ids, all_student_records, concurrency_limit, pr
     
     # 第二步：统一并发执行所有请求
     print(f"🚀 第2步: 并发执行所有请求（并发度: {concurrency_limit}）...")
-    llm_results = await create_concurrent_llm_requests(
-        all_requests,
+    
+    # 请求去重：(system, user, model) 完全相同的请求只调用一次 LLM，结果再分发给每个请求方
+    # （all_requests 保持不变，每个请求方仍使用自己的 practice_data 等信息）
+    unique_requests = []
+    dispatch_index = []  # all_requests[i] 对应 unique_requests[dispatch_index[i]]
+    unique_index_by_prompt = {}
+    for req in all_requests:
+        prompt_key = (req.system_prompt, req.user_prompt, req.model_name)
+        unique_idx = unique_index_by_prompt.get(prompt_key)
+        if unique_idx is None:
+            unique_idx = unique_index_by_prompt[prompt_key] = len(unique_requests)
+            unique_requests.append(req)
+        dispatch_index.append(unique_idx)
+    duplicate_count = total_requests - len(unique_requests)
+    if duplicate_count > 0:
+        print(f"   ♻️  请求去重: {total_requests} → {len(unique_requests)} 个（重复 {duplicate_count} 个，占 {duplicate_count/total_requests:.1%}）")
+    
+    unique_results = await dispatch_llm_requests(
+        unique_requests,
         concurrency_limit=concurrency_limit,
-        spread_duration=spread_duration
+        spread_duration=spread_duration,
+        response_cache=response_cache,
+        semantic_cache=semantic_cache,
+        limiter=limiter
     )
+    llm_results = [unique_results[unique_idx] for unique_idx in dispatch_index]
+    cached_result_count = sum(1 for result in llm_results if result.get('from_cache'))
     
     # 第三步：按学生分组结果并触发回调
     print(f"\n📊 第3步: 处理结果并保存...")
-    all_results = []
-    for student_id in tqdm(student_ids, desc="处理学生结果"):
-        # 🔥 跳过因异常未能成功准备请求的学生（注意：缺少辅导内容的学生已正常处理）
-        if student_id not in student_request_mapping:
+    exp_label = 'mastery_enhanced' if use_mastery else ('tutoring_enhanced' if use_tutoring else 'baseline')
+    retained_columns = [
+        column for column in _RESULT_COLUMNS
+        if on_student_complete is None or column not in _BULKY_RESULT_COLUMNS
+    ]
+    result_columns = {column: [] for column in retained_columns}
+    
+    # 正确答案和选项 JSON 字符串只取决于题目，按 question_id 预先计算一次
+    choice_info_by_qid = {}  # {question_id: (correct_choice_id, question_choices_json)}
+    for request in all_requests:
+        question_id = request.practice_data['question_id']
+        if question_id in choice_info_by_qid:
             continue
-        
-        student_results = []
-        request_indices = student_request_mapping[student_id]
-        
-        for req_idx in request_indices:
-            result = llm_results[req_idx]
-            request = all_requests[req_idx]
+        question_choices = request.question_choices
+        if question_choices:
+            correct_choice_id = next(
+                (choice.get('choice_id') for choice in question_choices if choice.get('is_correct')), None
+            )
+            choice_info_by_qid[question_id] = (correct_choice_id, _serialize_question_choices(question_choices))
+        else:
+            choice_info_by_qid[question_id] = (None, None)
+    
+    # 提示词日志与失败日志都交给后台协程批量写入（失败日志在首次出现失败时才创建文件）
+    prompt_log = AsyncLogWriter(prompt_log_path).start()
+    error_log = AsyncLogWriter(error_log_path).start()
+    try:
+        for student_id in tqdm(student_ids, desc="处理学生结果"):
+            # 🔥 跳过因异常未能成功准备请求的学生（注意：缺少辅导内容的学生已正常处理）
+            if student_id not in student_request_mapping:
+                continue
             
-            raw_resp = result.get('result')
-            error = result.get('error')
-            if error:
-                raw_resp = f"LLM_CALL_FAILED: {error}"
-                # 写入失败日志
-                try:
-                    with open(error_log_path, "a", encoding="utf-8") as ef:
-                        practice_data = request.get('practice_data', {})
-                        ef.write(f"--- FAILED REQUEST ---\n")
-                        ef.write(f"Student ID: {practice_data.get('student_id', 'Unknown')}\n")
-                        ef.write(f"Question ID: {practice_data.get('question_id', 'Unknown')}\n")
-                        ef.write(f"KC: {practice_data.get('know_name', '')}\n")
-                        ef.write(f"Error: {str(error)[:300]}\n")
-                        ef.write("--- SYSTEM PROMPT ---\n")
-                        ef.write(request.get('system_prompt', '') + "\n\n")
-                        ef.write("--- USER PROMPT (truncated) ---\n")
-                        user_p = request.get('user_prompt', '')
-                        ef.write((user_p[:2000] + ('...' if len(user_p) > 2000 else '')) + "\n")
-                        ef.write("="*80 + "\n\n")
-                except Exception as _:
-                    pass
+            student_results = {column: [] for column in _RESULT_COLUMNS}
+            request_indices = student_request_mapping[student_id]
             
-            # 解析响应
-            ans = _parse_llm_response(raw_resp)
-            practice_data = request['practice_data']
-            question_choices = request.get('question_choices')
+            for req_idx in request_indices:
+                result = llm_results[req_idx]
+                request = all_requests[req_idx]
+                
+                raw_resp = result.get('result')
+                error = result.get('error')
+                if error:
+                    raw_resp = f"LLM_CALL_FAILED: {error}"
+                    # 写入失败日志
+                    practice_data = request.practice_data
+                    user_p = request.user_prompt
+                    error_log.write(
+                        f"--- FAILED REQUEST ---\n"
+                        f"Student ID: {practice_data.get('student_id', 'Unknown')}\n"
+                        f"Question ID: {practice_data.get('question_id', 'Unknown')}\n"
+                        f"KC: {practice_data.get('know_name', '')}\n"
+                        f"Error: {str(error)[:300]}\n"
+                        "--- SYSTEM PROMPT ---\n"
+                        + request.system_prompt + "\n\n"
+                        "--- USER PROMPT (truncated) ---\n"
+                        + (user_p[:2000] + ('...' if len(user_p) > 2000 else '')) + "\n"
+                        + "="*80 + "\n\n"
+                    )
+                
+                # 解析响应
+                ans = _parse_llm_response(raw_resp)
+                practice_data = request.practice_data
+                
+                # 获取正确答案
+                correct_choice_id, question_choices_str = choice_info_by_qid[practice_data['question_id']]
+                
+                # 记录日志（交给后台写入协程，不阻塞结果处理）
+                prompt_log.write(_format_prompt_log_entry(
+                    student_id, practice_data['question_id'], exp_label,
+                    request.system_prompt, request.user_prompt, raw_resp
+                ))
+                
+                # 保存结果（按列追加）
+                student_results['student_id'].append(student_id)
+                student_results['question_id'].append(practice_data['question_id'])
+                student_results['true_know_name'].append(practice_data['know_name'])
+                student_results['true_score'].append(practice_data['score'])
+                student_results['true_answer_choice_id'].append(correct_choice_id)
+                student_results['true_answer_text'].append(practice_data.get('answer_text', ''))
+                student_results['predicted_task1_selfpredict'].append(ans.get('task1'))
+                student_results['predicted_task2_know_name'].append(ans.get('task2'))
+                student_results['predicted_task3_reasoning'].append(ans.get('task3'))
+                student_results['predicted_task4_answer_choice'].append(ans.get('task4'))
+                student_results['llm_raw_response'].append(raw_resp)
+                student_results['prompt_system'].append(request.system_prompt)
+                student_results['prompt_user'].append(request.user_prompt)
+                student_results['mastery_summary'].append(request.mastery_summary)
+                student_results['tutoring_summary'].append(request.tutoring_summary)
+                student_results['experiment_type'].append(exp_label)
+                student_results['question_choices'].append(question_choices_str)
             
-            # 获取正确答案
-            correct_choice_id = None
-            if question_choices:
-                for choice in question_choices:
-                    if choice.get('is_correct'):
-                        correct_choice_id = choice.get('choice_id')
-                        break
+            for column in retained_columns:
+                result_columns[column].extend(student_results[column])
             
-            # 记录日志
-            with open(prompt_log_path, "a", encoding="utf-8") as f:
-                exp_label = 'mastery_enhanced' if use_mastery else ('tutoring_enhanced' if use_tutoring else 'baseline')
-                f.write(f"--- PROMPT FOR STUDENT {student_id}, QUESTION {practice_data['question_id']} ({exp_label}) ---\n")
-                f.write("--- SYSTEM PROMPT ---\n" + request['system_prompt'] + "\n\n")
-                f.write("--- USER PROMPT ---\n" + request['user_prompt'] + "\n\n")
-                f.write("--- LLM RESPONSE ---\n" + str(raw_resp) + "\n" + "="*80 + "\n\n")
+            # 触发回调（增量保存）
+            if on_student_complete and request_indices:
+                on_student_complete(student_id, student_results)
             
-            # 保存结果
-            student_results.append({
-                'student_id': student_id,
-                'question_id': practice_data['question_id'],
-                'true_know_name': practice_data['know_name'],
-                'true_score': practice_data['score'],
-                'true_answer_choice_id': correct_choice_id,
-                'true_answer_text': practice_data.get('answer_text', ''),
-                'predicted_task1_selfpredict': ans.get('task1'),
-                'predicted_task2_know_name': ans.get('task2'),
-                'predicted_task3_reasoning': ans.get('task3'),
-                'predicted_task4_answer_choice': ans.get('task4'),
-                'llm_raw_response': raw_resp,
-                'prompt_system': request.get('system_prompt', ''),
-                'prompt_user': request.get('user_prompt', ''),
-                'mastery_summary': request.get('mastery_summary'),
-                'tutoring_summary': request.get('tutoring_summary'),
-                'experiment_type': 'mastery_enhanced' if use_mastery else ('tutoring_enhanced' if use_tutoring else 'baseline'),
-                'question_choices': str(question_choices) if question_choices else None
-            })
-        
-        all_results.extend(student_results)
-        
-        # 触发回调（增量保存）
-        if on_student_complete and student_results:
-            on_student_complete(student_id, student_results)
+            # 每个学生处理完让出一次事件循环，后台日志协程得以按时落盘
+            await asyncio.sleep(0)
+    finally:
+        # 两个日志分别关闭：一个关闭失败也要关闭另一个，且不能让日志问题中断已完成的实验
+        for log_writer in (error_log, prompt_log):
+            try:
+                await log_writer.close()
+            except Exception as e:
+                logger.warning("关闭日志 %s 出错: %s", log_writer.log_path, e)
     
-    print(f"✅ 所有结果处理完成\n")
-    return pd.DataFrame(all_results)
+    print(f"✅ 所有结果处理完成")
+    if response_cache is not None or semantic_cache is not None:
+        print(f"   ♻️  其中 {cached_result_count}/{total_requests} 个结果来自缓存（本次未调用模型）")
+    print("")
+    return pd.DataFrame(result_columns, copy=False)
 
 
 # --- 5. 结果评估 ---
-def generate_three_mode_comparison_report(df, output_dir):
+_ANSWER_CHOICE_LETTERS = 'ABCDEFGH'
+# 选项字母 → 选项下标（A → 0），替代逐行的 ord(letter) - ord('A') 与字符串成员检查
+_CHOICE_LETTER_TO_INDEX = {letter: i for i, letter in enumerate(_ANSWER_CHOICE_LETTERS)}
+
+
+def _int_if_complete(series):
+    """与逐行 apply 返回 1/0/None 时的 dtype 推断保持一致：没有缺失值时为 int，否则为 float（缺失为 NaN）"""
+    return series.astype(int) if series.notna().all() else series
+
+
+def _normalize_yes_no_series(series):
+    """向量化：将 Yes/No 转换为 1/0，其他值（含非字符串）为 NaN"""
+    try:
+        text = series.str.strip().str.lower().str.replace('.', '', regex=False)
+    except AttributeError:  # 整列没有任何字符串
+        return pd.Series(np.nan, index=series.index)
+    return _int_if_complete(text.map({'yes': 1, 'no': 0}))
+
+
+def _binary_to_prob(values, high_confidence=0.95, low_confidence=0.05):
+    """向量化：将 1/0 转换为概率值用于计算交叉熵，其他值（含缺失）返回中性概率 0.5"""
+    values = np.asarray(values)
+    return np.where(values == 1, high_confidence, np.where(values == 0, low_confidence, 0.5))
+
+
+def _parse_answer_choice_series(series):
+    """向量化：解析 Task4 的答案选择，返回首字母 (A-H)，无法解析时为 None"""
+    try:
+        first_char = series.str.strip().str.upper().str[0]
+    except AttributeError:  # 整列没有任何字符串
+        return pd.Series(None, index=series.index, dtype=object)
+    return first_char.where(first_char.isin(list(_CHOICE_LETTER_TO_INDEX)), None)
+
+
+# 选项列表中非字典元素的占位（无法取得 choice_id）
+_INVALID_CHOICE = object()
+
+
+def _parse_choice_ids(question_choices_str):
+    """
+    解析 question_choices 字符串，返回每个选项的 choice_id 列表（非字典的选项为 _INVALID_CHOICE）；
+    为空或无法解析时返回 None。
+    
+    新结果中为 JSON 字符串（json.loads）；旧结果文件中为 Python repr，回退到 ast.literal_eval。
+    """
+    if not isinstance(question_choices_str, str) or not question_choices_str or question_choices_str == 'None':
+        return None
+    try:
+        choices = json.loads(question_choices_str)
+    except ValueError:
+        try:
+            choices = ast.literal_eval(question_choices_str)
+        except Exception:
+            return None
+    if not isinstance(choices, list) or len(choices) == 0:
+        return None
+    return [choice.get('choice_id') if isinstance(choice, dict) else _INVALID_CHOICE for choice in choices]
+
+
+def _answer_correctness_series(question_keys, predicted_choice, true_choice_id, choice_ids_for_key=_parse_choice_ids):
+    """
+    向量化：判断 Task4 预测选项对应的 choice_id 是否等于正确答案（1/0，无法判断时为 NaN）。
+    
+    question_keys 为每行的题目标识：默认是 question_choices 字符串（用 _parse_choice_ids 解析），
+    也可以是 question_id 配合 build_choice_ids_by_question 的查表函数。同一道题在不同学生间大量重复：
+    先 factorize 得到每行的题目编码，每个去重后的题目只取一次选项，建成 (题目编码, 选项下标) → choice_id
+    的二维查找表，再用 numpy 花式索引一次取出每行预测的 choice_id。
+    """
+    codes, uniques = pd.factorize(question_keys)
+    n_letters = len(_ANSWER_CHOICE_LETTERS)
+    # 最后一行留给缺失的选项字符串（factorize 编码为 -1），整行不可匹配
+    choice_id_table = np.full((len(uniques) + 1, n_letters), None, dtype=object)
+    matched_table = np.zeros((len(uniques) + 1, n_letters), dtype=bool)
+    for code, question_key in enumerate(uniques):
+        choice_ids = choice_ids_for_key(question_key)
+        if not choice_ids:
+            continue
+        for choice_index, choice_id in enumerate(choice_ids[:n_letters]):
+            if choice_id is not _INVALID_CHOICE:
+                choice_id_table[code, choice_index] = choice_id
+                matched_table[code, choice_index] = True
+    
+    row_codes = np.where(codes < 0, len(uniques), codes)
+    choice_index = predicted_choice.map(_CHOICE_LETTER_TO_INDEX).fillna(-1).astype(int).to_numpy()
+    has_choice = choice_index >= 0
+    choice_index = np.where(has_choice, choice_index, 0)
+    
+    matched = has_choice & matched_table[row_codes, choice_index]
+    # 按对象逐个比较（与原先 Python == 语义一致）
+    is_correct = choice_id_table[row_codes, choice_index] == true_choice_id.to_numpy(dtype=object)
+    result = pd.Series(np.where(matched, is_correct.astype(float), np.nan), index=question_keys.index)
+    return _int_if_complete(result)
+
+
+def _binary_confusion_matrix(y_true, y_pred):
+    """0/1 标签的混淆矩阵 [[TN, FP], [FN, TP]]（等同 confusion_matrix(labels=[0, 1])），一次 bincount 完成"""
+    index = (np.asarray(y_true).astype(np.int64) << 1) | np.asarray(y_pred).astype(np.int64)
+    return np.bincount(index, minlength=4).reshape(2, 2)
+
+
+def _accuracy_and_weighted_f1(y_true, y_pred):
+    """
+    一次遍历同时得到准确率与加权 F1，定义与 f1_score(average='weighted') 相同：
+    各标签 F1 = 2·TP / (真实数 + 预测数)，再按真实样本数加权平均。
+    """
+    labels, codes = np.unique(np.concatenate([y_true, y_pred]), return_inverse=True)
+    true_codes, pred_codes = codes[:len(y_true)], codes[len(y_true):]
+    correct = true_codes == pred_codes
+    tp = np.bincount(true_codes[correct], minlength=len(labels))
+    true_sum = np.bincount(true_codes, minlength=len(labels))
+    pred_sum = np.bincount(pred_codes, minlength=len(labels))
+    f1_per_label = 2 * tp / (true_sum + pred_sum)  # 标签取自两者并集，分母恒大于 0
+    return correct.mean(), float(np.average(f1_per_label, weights=true_sum))
+
+
+# ROUGE 打分对数达到该值时才启用多进程（小样本不值得进程启动与序列化开销）
+_PARALLEL_ROUGE_MIN_PAIRS = 2000
+
+# 每个进程各自懒加载的 RougeScorer（stemmer 不跨进程共享）
+_ROUGE_SCORER = None
+
+
+def _score_rouge3_pair(pair):
+    """计算单个 (参考答案, 模型答案) 的 ROUGE-3 F 值"""
+    global _ROUGE_SCORER
+    if _ROUGE_SCORER is None:
+        _ROUGE_SCORER = rouge_scorer.RougeScorer(['rouge3'], use_stemmer=True)
+    reference_answer, model_answer = pair
+    return _ROUGE_SCORER.score(reference_answer, model_answer)['rouge3'].fmeasure
+
+
+def _rouge3_scores(pairs, workers=None):
+    """
+    按顺序返回每个 (参考答案, 模型答案) 的 ROUGE-3 F 值。
+    
+    相同的文本对（同一道题的参考答案 + 重复的模型输出）只打分一次；
+    去重后的对数较多时交给 ProcessPoolExecutor 并行计算。
+    """
+    unique_pairs = list(dict.fromkeys(pairs))
+    workers = min(workers or os.cpu_count() or 1, len(unique_pairs))
+    if workers <= 1 or len(unique_pairs) < _PARALLEL_ROUGE_MIN_PAIRS:
+        unique_scores = [_score_rouge3_pair(pair) for pair in unique_pairs]
+    else:
+        with _process_pool(workers) as executor:
+            unique_scores = list(executor.map(_score_rouge3_pair, unique_pairs, chunksize=64))
+    
+    if len(unique_pairs) == len(pairs):
+        return unique_scores
+    score_by_pair = dict(zip(unique_pairs, unique_scores))
+    return [score_by_pair[pair] for pair in pairs]
+
+
+def _task4_correctness(df, predicted_choice, choice_ids_by_qid=None):
+    """Task4 逐行判分：有 build_choice_ids_by_question 的选项表时按 question_id 查表，否则解析 question_choices 字符串"""
+    if choice_ids_by_qid is not None and 'question_id' in df.columns:
+        return _answer_correctness_series(
+            df['question_id'], predicted_choice, df['true_answer_choice_id'], choice_ids_for_key=choice_ids_by_qid.get
+        )
+    return _answer_correctness_series(df['question_choices'], predicted_choice, df['true_answer_choice_id'])
+
+
+def generate_three_mode_comparison_report(df, output_dir, choice_ids_by_qid=None):
     """
     生成四模式（Baseline, Mastery Only, Tutoring Only, Both）综合对比报告
     分别计算 Task1 和 Task4 的指标
+    
+    choice_ids_by_qid: build_choice_ids_by_question 的结果，提供时 Task4 按题目 ID 查选项
     """
     if df.empty:
         print("❌ 数据为空，无法生成对比报告")
         return
     
-    # 数据预处理函数
-    def normalize_yes_no(val):
-        """将 Yes/No 转换为 1/0"""
-        if isinstance(val, str):
-            val_lower = val.strip().lower().replace('.', '')
-            if val_lower == 'yes': return 1
-            if val_lower == 'no': return 0
-        return None
-    
-    def to_prob(val, high_confidence=0.95, low_confidence=0.05):
-        """将 1/0 转换为概率值用于计算交叉熵"""
-        if val == 1:
-            return high_confidence
-        elif val == 0:
-            return low_confidence
-        return 0.5
-    
-    def parse_answer_choice(val):
-        """解析Task4的答案选择 (A/B/C/D)"""
-        if not isinstance(val, str):
-            return None
-        val = val.strip().upper()
-        if val and val[0] in 'ABCDEFGH':
-            return val[0]
-        return None
+    # 预处理数据（向量化）：派生列放在独立的小表中，再与报告用到的原始列拼成精简视图，
+    # 避免整表复制（结果表含完整提示词与原始响应）
+    predicted_answer_choice = _parse_answer_choice_series(df['predicted_task4_answer_choice'])
+    derived = pd.DataFrame({
+        'task1_pred_normalized': _normalize_yes_no_series(df['predicted_task1_selfpredict']),
+        'task4_correct': _task4_correctness(df, predicted_answer_choice, choice_ids_by_qid),
+    }, index=df.index)
+    report_columns = [
+        column for column in ('student_id', 'experiment_mode', 'true_score', 'true_know_name', 'predicted_task2_know_name')
+        if column in df.columns
+    ]
+    df = pd.concat([df[report_columns], derived], axis=1, copy=False)
     
-    def check_answer_correctness(row):
-        """检查Task4答案是否正确"""
-        predicted_choice = row.get('predicted_answer_choice')
-        if predicted_choice is None:
-            return None
-        
-        question_choices_str = row.get('question_choices')
-        if not question_choices_str or question_choices_str == 'None':
-            return None
-        
-        try:
-            import ast
-            choices = ast.literal_eval(question_choices_str)
-            if not isinstance(choices, list) or len(choices) == 0:
-                return None
-            
-            choice_index = ord(predicted_choice) - ord('A')
-            if 0 <= choice_index < len(choices):
-                predicted_choice_id = choices[choice_index].get('choice_id')
-                correct_choice_id = row.get('true_answer_choice_id')
-                return 1 if predicted_choice_id == correct_choice_id else 0
-        except:
-            pass
-        
-        return None
+    report_buf = io.StringIO()
     
-    # 预处理数据
-    df = df.copy()
-    df['task1_pred_normalized'] = df['predicted_task1_selfpredict'].apply(normalize_yes_no)
-    df['predicted_answer_choice'] = df['predicted_task4_answer_choice'].apply(parse_answer_choice)
-    df['task4_correct'] = df.apply(check_answer_correctness, axis=1)
+    def emit(line=""):
+        """向报告缓冲区写入一行"""
+        report_buf.write(line)
+        report_buf.write("\n")
     
-    report_lines = []
-    report_lines.append("=" * 80)
-    report_lines.append("📊 四模式综合对比报告 (Task1 & Task4 分离评估)".center(80))
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit("=" * 80)
+    emit("📊 四模式综合对比报告 (Task1 & Task4 分离评估)".center(80))
+    emit("=" * 80)
+    emit()
     
     # 基本信息
-    report_lines.append("📋 基本信息")
-    report_lines.append(f"   • 使用模型: {MODEL_NAME}")
-    report_lines.append(f"   • 总测试样本数: {len(df)}")
-    report_lines.append(f"   • 测试学生数: {df['student_id'].nunique() if 'student_id' in df.columns else 'N/A'}")
-    report_lines.append("")
+    emit("📋 基本信息")
+    emit(f"   • 使用模型: {MODEL_NAME}")
+    emit(f"   • 总测试样本数: {len(df)}")
+    emit(f"   • 测试学生数: {df['student_id'].nunique() if 'student_id' in df.columns else 'N/A'}")
+    emit()
     
     if 'experiment_mode' not in df.columns:
         print("❌ 缺少 experiment_mode 列，无法生成对比报告")
         return
     
-    modes = df['experiment_mode'].unique()
+    # 按模式一次性分组，后续各节共用每个模式的 numpy 数组
+    mode_groups = dict(list(df.groupby('experiment_mode', sort=True, observed=True)))
     mode_results = {}
     
     # 为每个模式计算 Task1 和 Task4 指标
-    for mode in sorted(modes):
-        mode_df = df[df['experiment_mode'] == mode].copy()
+    for mode, mode_df in mode_groups.items():
+        true_score = mode_df['true_score'].to_numpy()
         
         # ========== Task1 指标计算 (自我预测 Yes/No) ==========
-        task1_df = mode_df[mode_df['task1_pred_normalized'].notna()].copy()
+        task1_pred_all = mode_df['task1_pred_normalized'].to_numpy()
+        task1_mask = mode_df['task1_pred_normalized'].notna().to_numpy()
+        task1_true = true_score[task1_mask]
+        task1_pred = task1_pred_all[task1_mask]
         
-        if len(task1_df) > 0:
+        if len(task1_true) > 0:
             # Task1 ACC
-            task1_acc = (task1_df['task1_pred_normalized'] == task1_df['true_score']).mean()
+            task1_acc = (task1_pred == task1_true).mean()
             
             # Task1 F1
-            task1_f1 = f1_score(task1_df['true_score'], task1_df['task1_pred_normalized'], average='weighted')
+            task1_f1 = f1_score(task1_true, task1_pred, average='weighted')
             
             # Task1 Cross Entropy
-            task1_df['task1_prob'] = task1_df['task1_pred_normalized'].apply(to_prob)
-            task1_ce = log_loss(task1_df['true_score'], task1_df['task1_prob'])
+            task1_prob = _binary_to_prob(task1_pred)
+            task1_ce = log_loss(task1_true, task1_prob)
             
             # Task1 混淆矩阵
-            task1_tp = ((task1_df['true_score'] == 1) & (task1_df['task1_pred_normalized'] == 1)).sum()
-            task1_fp = ((task1_df['true_score'] == 0) & (task1_df['task1_pred_normalized'] == 1)).sum()
-            task1_tn = ((task1_df['true_score'] == 0) & (task1_df['task1_pred_normalized'] == 0)).sum()
-            task1_fn = ((task1_df['true_score'] == 1) & (task1_df['task1_pred_normalized'] == 0)).sum()
+            task1_tn, task1_fp, task1_fn, task1_tp = _binary_confusion_matrix(task1_true, task1_pred).ravel()
         else:
             task1_acc = task1_f1 = task1_ce = 0
             task1_tp = task1_fp = task1_tn = task1_fn = 0
         
         # ========== Task4 指标计算 (答案选择 A/B/C/D) ==========
-        task4_df = mode_df[mode_df['task4_correct'].notna()].copy()
+        task4_mask = mode_df['task4_correct'].notna().to_numpy()
+        task4_true = true_score[task4_mask]
+        task4_pred = mode_df['task4_correct'].to_numpy()[task4_mask]
         
-        if len(task4_df) > 0:
+        if len(task4_true) > 0:
             # Task4 ACC
-            task4_acc = task4_df['task4_correct'].mean()
+            task4_acc = task4_pred.mean()
             
             # Task4 F1
-            task4_f1 = f1_score(task4_df['true_score'], task4_df['task4_correct'], average='weighted')
+            task4_f1 = f1_score(task4_true, task4_pred, average='weighted')
             
             # Task4 混淆矩阵
-            task4_tp = ((task4_df['true_score'] == 1) & (task4_df['task4_correct'] == 1)).sum()
-            task4_fp = ((task4_df['true_score'] == 0) & (task4_df['task4_correct'] == 1)).sum()
-            task4_tn = ((task4_df['true_score'] == 0) & (task4_df['task4_correct'] == 0)).sum()
-            task4_fn = ((task4_df['true_score'] == 1) & (task4_df['task4_correct'] == 0)).sum()
+            task4_tn, task4_fp, task4_fn, task4_tp = _binary_confusion_matrix(task4_true, task4_pred).ravel()
         else:
             task4_acc = task4_f1 = 0
             task4_tp = task4_fp = task4_tn = task4_fn = 0
         
         # ========== Task2 指标计算 (知识点识别) ==========
-        task2_df = mode_df[mode_df['predicted_task2_know_name'].notna()].copy()
-        if len(task2_df) > 0:
-            task2_acc = (task2_df['predicted_task2_know_name'] == task2_df['true_know_name']).mean()
+        task2_mask = mode_df['predicted_task2_know_name'].notna().to_numpy()
+        if task2_mask.any():
+            task2_pred = mode_df['predicted_task2_know_name'].to_numpy()[task2_mask]
+            task2_acc = (task2_pred == mode_df['true_know_name'].to_numpy()[task2_mask]).mean()
         else:
             task2_acc = 0
         
@@ -1882,31 +3103,33 @@ def generate_three_mode_comparison_report(df, output_dir):
             'task1_acc': task1_acc,
             'task1_f1': task1_f1,
             'task1_ce': task1_ce,
-            'task1_total': len(task1_df),
+            'task1_total': len(task1_true),
             'task1_tp': task1_tp,
             'task1_fp': task1_fp,
             'task1_tn': task1_tn,
             'task1_fn': task1_fn,
-            'task1_df': task1_df,  # 保存 DataFrame 用于生成分类报告
+            'task1_true': task1_true,  # 保存数组用于生成分类报告
+            'task1_pred': task1_pred,
             
             # Task4 指标
             'task4_acc': task4_acc,
             'task4_f1': task4_f1,
-            'task4_total': len(task4_df),
+            'task4_total': len(task4_true),
             'task4_tp': task4_tp,
             'task4_fp': task4_fp,
             'task4_tn': task4_tn,
             'task4_fn': task4_fn,
-            'task4_df': task4_df,  # 保存 DataFrame 用于生成分类报告
+            'task4_true': task4_true,  # 保存数组用于生成分类报告
+            'task4_pred': task4_pred,
             
             # Task2 指标
             'task2_acc': task2_acc,
         }
     
     # ========== 输出详细报告 ==========
-    report_lines.append("🎯 三模式指标对比")
-    report_lines.append("-" * 80)
-    report_lines.append("")
+    emit("🎯 三模式指标对比")
+    emit("-" * 80)
+    emit()
     
     # 获取 baseline 的指标用于对比
     baseline_task1_acc = mode_results.get('baseline', {}).get('task1_acc', 0)
@@ -1932,56 +3155,55 @@ def generate_three_mode_comparison_report(df, output_dir):
             icon = "🟣"
             label = "BOTH (有掌握度 + 有辅导)"
         
-        report_lines.append(f"{icon} {label}")
-        report_lines.append("=" * 80)
-        report_lines.append("")
+        emit(f"{icon} {label}")
+        emit("=" * 80)
+        emit()
         
         # ========== Task1 指标 (自我预测) ==========
-        report_lines.append(f"   📝 Task1: 自我预测 (Self-Prediction) - 学生预测能否答对 (Yes/No)")
-        report_lines.append(f"      • 准确率 (ACC):        {result['task1_acc']:.2%}")
+        emit(f"   📝 Task1: 自我预测 (Self-Prediction) - 学生预测能否答对 (Yes/No)")
+        emit(f"      • 准确率 (ACC):        {result['task1_acc']:.2%}")
         
         # 与baseline对比
         if mode != 'baseline' and baseline_task1_acc > 0:
             diff = result['task1_acc'] - baseline_task1_acc
             arrow = "⬆️" if diff > 0 else "⬇️" if diff < 0 else "➡️"
-            report_lines.append(f"        相比Baseline:       {diff:+.2%} {arrow}")
+            emit(f"        相比Baseline:       {diff:+.2%} {arrow}")
         
-        report_lines.append(f"      • F1-Score:            {result['task1_f1']:.4f}")
-        report_lines.append(f"      • 交叉熵 (Cross Entropy): {result['task1_ce']:.4f}")
-        report_lines.append(f"      • 有效样本数:          {result['task1_total']}")
-        report_lines.append("")
+        emit(f"      • F1-Score:            {result['task1_f1']:.4f}")
+        emit(f"      • 交叉熵 (Cross Entropy): {result['task1_ce']:.4f}")
+        emit(f"      • 有效样本数:          {result['task1_total']}")
+        emit()
         
         # ========== Task4 指标 (答案选择) ==========
-        report_lines.append(f"   ✏️  Task4: 答案选择 (Answer Choice) - 最终选择的答案 (A/B/C/D)")
-        report_lines.append(f"      • 准确率 (ACC):        {result['task4_acc']:.2%}")
+        emit(f"   ✏️  Task4: 答案选择 (Answer Choice) - 最终选择的答案 (A/B/C/D)")
+        emit(f"      • 准确率 (ACC):        {result['task4_acc']:.2%}")
         
         # 与baseline对比
         if mode != 'baseline' and baseline_task4_acc > 0:
             diff = result['task4_acc'] - baseline_task4_acc
             arrow = "⬆️" if diff > 0 else "⬇️" if diff < 0 else "➡️"
-            report_lines.append(f"        相比Baseline:       {diff:+.2%} {arrow}")
+            emit(f"        相比Baseline:       {diff:+.2%} {arrow}")
         
-        report_lines.append(f"      • F1-Score:            {result['task4_f1']:.4f}")
-        report_lines.append(f"      • 有效样本数:          {result['task4_total']}")
-        report_lines.append("")
+        emit(f"      • F1-Score:            {result['task4_f1']:.4f}")
+        emit(f"      • 有效样本数:          {result['task4_total']}")
+        emit()
         
         # ========== Task2 指标 (知识点识别) ==========
-        report_lines.append(f"   🎯 Task2: 知识点识别 (KC Recognition)")
-        report_lines.append(f"      • 准确率 (ACC):        {result['task2_acc']:.2%}")
-        report_lines.append("")
-        report_lines.append("")
+        emit(f"   🎯 Task2: 知识点识别 (KC Recognition)")
+        emit(f"      • 准确率 (ACC):        {result['task2_acc']:.2%}")
+        emit()
+        emit()
     
     # ========== Task1 详细分类报告 ==========
-    report_lines.append("📊 Task1 详细分类报告 (自我预测)")
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit("📊 Task1 详细分类报告 (自我预测)")
+    emit("=" * 80)
+    emit()
     
     for mode in ['baseline', 'mastery_only', 'tutoring_only', 'both']:
         if mode not in mode_results:
             continue
         
         result = mode_results[mode]
-        task1_df = result.get('task1_df')
         
         if mode == 'baseline':
             label = "BASELINE"
@@ -1996,31 +3218,30 @@ def generate_three_mode_comparison_report(df, output_dir):
             label = "BOTH"
             icon = "🟣"
         
-        report_lines.append(f"{icon} {label}")
-        report_lines.append("-" * 80)
+        emit(f"{icon} {label}")
+        emit("-" * 80)
         
-        if task1_df is not None and len(task1_df) > 0:
-            report_lines.append(classification_report(
-                task1_df['true_score'], 
-                task1_df['task1_pred_normalized'], 
+        if result['task1_total'] > 0:
+            emit(classification_report(
+                result['task1_true'], 
+                result['task1_pred'], 
                 target_names=['预测错误', '预测正确']
             ))
         else:
-            report_lines.append("   ⚠️  无可用的 Task1 数据")
+            emit("   ⚠️  无可用的 Task1 数据")
         
-        report_lines.append("")
+        emit()
     
     # ========== Task4 详细分类报告 ==========
-    report_lines.append("📊 Task4 详细分类报告 (答案选择)")
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit("📊 Task4 详细分类报告 (答案选择)")
+    emit("=" * 80)
+    emit()
     
     for mode in ['baseline', 'mastery_only', 'tutoring_only', 'both']:
         if mode not in mode_results:
             continue
         
         result = mode_results[mode]
-        task4_df = result.get('task4_df')
         
         if mode == 'baseline':
             label = "BASELINE"
@@ -2035,24 +3256,24 @@ def generate_three_mode_comparison_report(df, output_dir):
             label = "BOTH"
             icon = "🟣"
         
-        report_lines.append(f"{icon} {label}")
-        report_lines.append("-" * 80)
+        emit(f"{icon} {label}")
+        emit("-" * 80)
         
-        if task4_df is not None and len(task4_df) > 0:
-            report_lines.append(classification_report(
-                task4_df['true_score'], 
-                task4_df['task4_correct'], 
+        if result['task4_total'] > 0:
+            emit(classification_report(
+                result['task4_true'], 
+                result['task4_pred'], 
                 target_names=['预测错误', '预测正确']
             ))
         else:
-            report_lines.append("   ⚠️  无可用的 Task4 数据")
+            emit("   ⚠️  无可用的 Task4 数据")
         
-        report_lines.append("")
+        emit()
     
     # ========== 详细混淆矩阵 ==========
-    report_lines.append("📊 详细混淆矩阵 (Confusion Matrix)")
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit("📊 详细混淆矩阵 (Confusion Matrix)")
+    emit("=" * 80)
+    emit()
     
     for mode in ['baseline', 'mastery_only', 'tutoring_only', 'both']:
         if mode not in mode_results:
@@ -2073,29 +3294,29 @@ def generate_three_mode_comparison_report(df, output_dir):
             label = "BOTH"
             icon = "🟣"
         
-        report_lines.append(f"{icon} {label}")
-        report_lines.append("-" * 80)
+        emit(f"{icon} {label}")
+        emit("-" * 80)
         
         # Task1 混淆矩阵
-        report_lines.append(f"   Task1 (自我预测):")
-        report_lines.append(f"                预测正确(Yes)  预测错误(No)")
-        report_lines.append(f"   实际正确:       {result['task1_tp']:6d}         {result['task1_fn']:6d}")
-        report_lines.append(f"   实际错误:       {result['task1_fp']:6d}         {result['task1_tn']:6d}")
-        report_lines.append("")
+        emit(f"   Task1 (自我预测):")
+        emit(f"                预测正确(Yes)  预测错误(No)")
+        emit(f"   实际正确:       {result['task1_tp']:6d}         {result['task1_fn']:6d}")
+        emit(f"   实际错误:       {result['task1_fp']:6d}         {result['task1_tn']:6d}")
+        emit()
         
         # Task4 混淆矩阵
-        report_lines.append(f"   Task4 (答案选择):")
-        report_lines.append(f"                选对答案       选错答案")
-        report_lines.append(f"   实际正确:       {result['task4_tp']:6d}         {result['task4_fn']:6d}")
-        report_lines.append(f"   实际错误:       {result['task4_fp']:6d}         {result['task4_tn']:6d}")
-        report_lines.append("")
-        report_lines.append("")
+        emit(f"   Task4 (答案选择):")
+        emit(f"                选对答案       选错答案")
+        emit(f"   实际正确:       {result['task4_tp']:6d}         {result['task4_fn']:6d}")
+        emit(f"   实际错误:       {result['task4_fp']:6d}         {result['task4_tn']:6d}")
+        emit()
+        emit()
     
     # ========== 结论与分析 ==========
-    report_lines.append("=" * 80)
-    report_lines.append("💡 结论与分析".center(80))
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit("=" * 80)
+    emit("💡 结论与分析".center(80))
+    emit("=" * 80)
+    emit()
     
     # 找出最佳模式
     if mode_results:
@@ -2110,10 +3331,10 @@ def generate_three_mode_comparison_report(df, output_dir):
             'both': 'Both（掌握度+辅导）'
         }
         
-        report_lines.append(f"🏆 最佳模式统计:")
-        report_lines.append(f"   • Task1 (自我预测): {mode_name_map.get(best_task1_mode[0], best_task1_mode[0])} - ACC: {best_task1_mode[1]['task1_acc']:.2%}")
-        report_lines.append(f"   • Task4 (答案选择): {mode_name_map.get(best_task4_mode[0], best_task4_mode[0])} - ACC: {best_task4_mode[1]['task4_acc']:.2%}")
-        report_lines.append("")
+        emit(f"🏆 最佳模式统计:")
+        emit(f"   • Task1 (自我预测): {mode_name_map.get(best_task1_mode[0], best_task1_mode[0])} - ACC: {best_task1_mode[1]['task1_acc']:.2%}")
+        emit(f"   • Task4 (答案选择): {mode_name_map.get(best_task4_mode[0], best_task4_mode[0])} - ACC: {best_task4_mode[1]['task4_acc']:.2%}")
+        emit()
         
         # 详细分析
         if 'mastery_only' in mode_results and 'tutoring_only' in mode_results:
@@ -2121,71 +3342,71 @@ def generate_three_mode_comparison_report(df, output_dir):
             mastery_res = mode_results['mastery_only']
             tutoring_res = mode_results['tutoring_only']
             
-            report_lines.append("📈 关键发现:")
-            report_lines.append("")
+            emit("📈 关键发现:")
+            emit()
             
             # Task1 分析
-            report_lines.append("   【Task1: 自我预测能力】")
+            emit("   【Task1: 自我预测能力】")
             if mastery_res['task1_acc'] > baseline_res.get('task1_acc', 0):
                 diff = mastery_res['task1_acc'] - baseline_res.get('task1_acc', 0)
-                report_lines.append(f"   ✅ Mastery模式相比Baseline提升了 {diff:.2%}")
-                report_lines.append(f"      → 掌握度增强显著提升了学生的自我认知准确性")
+                emit(f"   ✅ Mastery模式相比Baseline提升了 {diff:.2%}")
+                emit(f"      → 掌握度增强显著提升了学生的自我认知准确性")
             else:
                 diff = mastery_res['task1_acc'] - baseline_res.get('task1_acc', 0)
-                report_lines.append(f"   ⚠️  Mastery模式相比Baseline变化 {diff:+.2%}")
+                emit(f"   ⚠️  Mastery模式相比Baseline变化 {diff:+.2%}")
             
             if tutoring_res['task1_acc'] > baseline_res.get('task1_acc', 0):
                 diff = tutoring_res['task1_acc'] - baseline_res.get('task1_acc', 0)
-                report_lines.append(f"   ✅ Tutoring模式相比Baseline提升了 {diff:.2%}")
-                report_lines.append(f"      → 辅导输出帮助学生更准确地评估自己的能力")
+                emit(f"   ✅ Tutoring模式相比Baseline提升了 {diff:.2%}")
+                emit(f"      → 辅导输出帮助学生更准确地评估自己的能力")
             else:
                 diff = tutoring_res['task1_acc'] - baseline_res.get('task1_acc', 0)
-                report_lines.append(f"   ⚠️  Tutoring模式相比Baseline变化 {diff:+.2%}")
+                emit(f"   ⚠️  Tutoring模式相比Baseline变化 {diff:+.2%}")
             
-            report_lines.append("")
+            emit()
             
             # Task4 分析
-            report_lines.append("   【Task4: 实际做题能力】")
+            emit("   【Task4: 实际做题能力】")
             if mastery_res['task4_acc'] > baseline_res.get('task4_acc', 0):
                 diff = mastery_res['task4_acc'] - baseline_res.get('task4_acc', 0)
-                report_lines.append(f"   ✅ Mastery模式相比Baseline提升了 {diff:.2%}")
-                report_lines.append(f"      → 掌握度评估有助于提升实际做题正确率")
+                emit(f"   ✅ Mastery模式相比Baseline提升了 {diff:.2%}")
+                emit(f"      → 掌握度评估有助于提升实际做题正确率")
             else:
                 diff = mastery_res['task4_acc'] - baseline_res.get('task4_acc', 0)
-                report_lines.append(f"   ⚠️  Mastery模式相比Baseline变化 {diff:+.2%}")
+                emit(f"   ⚠️  Mastery模式相比Baseline变化 {diff:+.2%}")
             
             if tutoring_res['task4_acc'] > baseline_res.get('task4_acc', 0):
                 diff = tutoring_res['task4_acc'] - baseline_res.get('task4_acc', 0)
-                report_lines.append(f"   ✅ Tutoring模式相比Baseline提升了 {diff:.2%}")
-                report_lines.append(f"      → 辅导输出直接提升了做题正确率")
+                emit(f"   ✅ Tutoring模式相比Baseline提升了 {diff:.2%}")
+                emit(f"      → 辅导输出直接提升了做题正确率")
             else:
                 diff = tutoring_res['task4_acc'] - baseline_res.get('task4_acc', 0)
-                report_lines.append(f"   ⚠️  Tutoring模式相比Baseline变化 {diff:+.2%}")
+                emit(f"   ⚠️  Tutoring模式相比Baseline变化 {diff:+.2%}")
             
-            report_lines.append("")
+            emit()
             
             # 模式对比
             if mastery_res['task4_acc'] > tutoring_res['task4_acc']:
                 diff = mastery_res['task4_acc'] - tutoring_res['task4_acc']
-                report_lines.append(f"   📊 Mastery模式比Tutoring模式在做题准确率上高 {diff:.2%}")
-                report_lines.append(f"      → 掌握度评估对提升做题正确率的效果更明显")
+                emit(f"   📊 Mastery模式比Tutoring模式在做题准确率上高 {diff:.2%}")
+                emit(f"      → 掌握度评估对提升做题正确率的效果更明显")
             elif tutoring_res['task4_acc'] > mastery_res['task4_acc']:
                 diff = tutoring_res['task4_acc'] - mastery_res['task4_acc']
-                report_lines.append(f"   📊 Tutoring模式比Mastery模式在做题准确率上高 {diff:.2%}")
-                report_lines.append(f"      → 辅导输出对提升做题正确率的效果更明显")
+                emit(f"   📊 Tutoring模式比Mastery模式在做题准确率上高 {diff:.2%}")
+                emit(f"      → 辅导输出对提升做题正确率的效果更明显")
     
-    report_lines.append("")
-    report_lines.append("=" * 80)
+    emit()
+    emit("=" * 80)
     
     # ========== 添加汇总对比表 ==========
-    report_lines.append("")
-    report_lines.append("📋 指标汇总对比表")
-    report_lines.append("=" * 80)
-    report_lines.append("")
+    emit()
+    emit("📋 指标汇总对比表")
+    emit("=" * 80)
+    emit()
     
     # 表头
-    report_lines.append("模式              | Task1 ACC | Task1 F1  | Task1 CE  | Task4 ACC | Task4 F1  | Task2 ACC")
-    report_lines.append("-" * 95)
+    emit("模式              | Task1 ACC | Task1 F1  | Task1 CE  | Task4 ACC | Task4 F1  | Task2 ACC")
+    emit("-" * 95)
     
     # 每个模式的数据行
     for mode in ['baseline', 'mastery_only', 'tutoring_only', 'both']:
@@ -2210,25 +3431,23 @@ def generate_three_mode_comparison_report(df, output_dir):
                 f"{result['task4_acc']:8.2%} | "
                 f"{result['task4_f1']:8.4f} | "
                 f"{result['task2_acc']:8.2%}")
-        report_lines.append(line)
-    
-    report_lines.append("")
-    report_lines.append("说明:")
-    report_lines.append("  • Task1: 自我预测准确性 (学生预测能否答对)")
-    report_lines.append("  • Task4: 实际答题准确性 (最终答案是否正确)")
-    report_lines.append("  • Task2: 知识点识别准确性")
-    report_lines.append("  • ACC: 准确率, F1: F1分数, CE: 交叉熵 (越低越好)")
-    report_lines.append("")
-    report_lines.append("=" * 80)
-    
-    # 保存报告
+        emit(line)
+    
+    emit()
+    emit("说明:")
+    emit("  • Task1: 自我预测准确性 (学生预测能否答对)")
+    emit("  • Task4: 实际答题准确性 (最终答案是否正确)")
+    emit("  • Task2: 知识点识别准确性")
+    emit("  • ACC: 准确率, F1: F1分数, CE: 交叉熵 (越低越好)")
+    emit()
+    emit("=" * 80)
+    
+    # 保存报告并一次性打印到控制台
+    report_text = report_buf.getvalue()
     report_path = os.path.join(output_dir, 'three_mode_comparison_report.txt')
     with open(report_path, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(report_lines))
-    
-    # 打印到控制台
-    for line in report_lines:
-        print(line)
+        f.write(report_text)
+    sys.stdout.write(report_text)
     
     print("")
     print(f"✅ 三模式综合对比报告已保存至: {report_path}")
@@ -2236,7 +3455,7 @@ def generate_three_mode_comparison_report(df, output_dir):
 
 def save_in_out_cases(combined_df, output_dir, all_student_records, kcs_df, kc_relationships_df, 
                       kc_to_questions_map, question_text_map, kc_descriptions, question_choices_df,
-                      mastery_lookup, tutoring_lookup, related_kc_map, all_kc_names):
+                      mastery_lookup, tutoring_lookup, related_kc_map, all_kc_names, split_cache=None, verbose=None):
     """
     找到3个同时拥有掌握度和辅导内容的学生，保存他们的完整输入输出案例。
     
@@ -2244,6 +3463,8 @@ def save_in_out_cases(combined_df, output_dir, all_student_records, kcs_df, kc_r
     1. 掌握度评估的输入输出
     2. 辅导内容生成的输入输出
     3. 评测智能体的输入输出
+    
+    verbose: 是否在控制台打印案例详情；None 表示仅在交互式终端打印
     """
     print("\n" + "="*80)
     print("📝 收集输入输出案例".center(80))
@@ -2269,188 +3490,254 @@ def save_in_out_cases(combined_df, output_dir, all_student_records, kcs_df, kc_r
     
     print(f"✅ 找到 {len(student_ids)} 个符合条件的学生: {student_ids}")
     
-    cases = []
+    # verbose 为 None 时仅在交互式终端打印详情，重定向输出时只打印数量
+    if verbose is None:
+        verbose = sys.stdout.isatty()
     
-    for student_id in student_ids:
-        print(f"\n📋 处理学生 {student_id}...")
-        
-        student_df = filtered_df[filtered_df['student_id'] == student_id].iloc[0]
-        student_records_df = all_student_records[student_id]
+    tutoring_content_map = build_tutoring_content_map(tutoring_lookup)
+    case_details = []
+    # 提示词按内容哈希只存一份，案例中以 *_prompt_ref 引用
+    prompt_store = {}
+    
+    # 逐个案例流式写入 JSON 数组，避免把所有案例（含长提示词和原始响应）同时留在内存里；
+    # prompt_store 要等所有案例写完才完整，因此放在文件末尾
+    case_json_path = os.path.join(output_dir, 'in_out_cases.json')
+    with open(case_json_path, 'wb') as case_json_file:
+        case_json_file.write(b'{\n"cases": [\n')
         
-        # 获取训练集和测试集
-        from sklearn.model_selection import train_test_split
-        train_df, test_df = train_test_split(student_records_df, test_size=0.1, random_state=42, shuffle=True)
+        # 逐个学生查表生成案例骨架和提示词构建参数（惰性生成，只有正在构建提示词的案例留在内存里）
+        # 知识点选项的随机抽样按 (seed, student_id) 派生，串行与多进程构建结果一致
+        seed = random.getrandbits(32)
         
-        case = {
-            'student_id': int(student_id),
-            'mastery_assessment': {},
-            'tutoring_generation': {},
-            'agent_evaluation': {}
-        }
+        def iter_pending_cases():
+            for student_id in student_ids:
+                print(f"\n📋 处理学生 {student_id}...")
+                
+                student_df = filtered_df[filtered_df['student_id'] == student_id].iloc[0]
+                student_records_df = all_student_records[student_id]
+                
+                # 获取训练集和测试集
+                train_df, test_df = split_student_records(student_records_df, split_cache.get(student_id) if split_cache else None)
+                
+                case = {
+                    'student_id': int(student_id),
+                    'mastery_assessment': {},
+                    'tutoring_generation': {},
+                    'agent_evaluation': {}
+                }
+                
+                # ===== 1. 掌握度评估案例 =====
+                # 需要从 mastery_lookup 重建输入
+                if mastery_lookup and student_id in mastery_lookup:
+                    kc_name = student_df['true_know_name']
+                
+                    # 重建掌握度评估的输入（从 assess_mastery.py 中提取逻辑）
+                    # 这里简化处理，直接从 mastery_lookup 获取结果
+                    mastery_info = mastery_lookup[student_id].get(kc_name, {})
+                
+                    case['mastery_assessment'] = {
+                        'input': {
+                            'student_id': student_id,
+                            'kc_name': kc_name,
+                            'note': '掌握度评估的完整输入需要查看 mastery_assessment_results.csv 或日志文件'
+                        },
+                        'output': {
+                            'mastery_level': mastery_info.get('mastery_level', 'N/A'),
+                            'rationale': mastery_info.get('rationale', ''),
+                            'suggestions': mastery_info.get('suggestions', '')
+                        },
+                        'full_summary': student_df['mastery_summary']
+                    }
+                
+                # ===== 2. 辅导内容生成案例 =====
+                if tutoring_lookup and student_id in tutoring_lookup:
+                    kc_name = student_df['true_know_name']
+                    tutoring_info = tutoring_lookup[student_id].get(kc_name, {})
+                
+                    case['tutoring_generation'] = {
+                        'input': {
+                            'system_prompt_ref': _intern_prompt(prompt_store, tutoring_info.get('prompt_system', '')),
+                            'user_prompt_ref': _intern_prompt(prompt_store, tutoring_info.get('prompt_user', '')),
+                        },
+                        'output': {
+                            'tutoring_content': tutoring_info.get('tutoring_content', ''),
+                            'llm_raw_response': tutoring_info.get('llm_raw_response', ''),
+                            'example_question_ids': tutoring_info.get('example_question_ids', [])
+                        },
+                        'full_summary': student_df['tutoring_summary']
+                    }
+                
+                # ===== 3. 评测智能体案例 =====
+                # 重建 Agent Prompt 所需的输入（提示词本身在第二阶段构建）
+                # question_id → 题目内容的哈希索引（同一题多次作答时取第一条记录）
+                exer_content_by_qid = student_records_df.drop_duplicates('question_id').set_index('question_id')['exer_content']
+                practice = {
+                    'question_id': student_df['question_id'],
+                    'exer_content': exer_content_by_qid.at[student_df['question_id']],
+                    'know_name': student_df['true_know_name']
+                }
+                
+                question_choices = get_question_choices(student_df['question_id'], question_choices_df)
+                
+                mastery_summary = build_mastery_summary(
+                    student_id, 
+                    student_df['true_know_name'],
+                    related_kc_map,
+                    mastery_lookup,
+                    kc_descriptions
+                )
+                
+                # 构建辅导字典
+                tutoring_dict = tutoring_content_map.get(student_id, {})
+                
+                case['agent_evaluation'] = {
+                    'input': {
+                        'system_prompt_ref': None,
+                        'user_prompt_ref': None,
+                        'question_id': student_df['question_id'],
+                        'kc_name': student_df['true_know_name']
+                    },
+                    'output': {
+                        'llm_raw_response': student_df['llm_raw_response'],
+                        'task1_selfpredict': student_df['predicted_task1_selfpredict'],
+                        'task2_know_name': student_df['predicted_task2_know_name'],
+                        'task3_reasoning': student_df['predicted_task3_reasoning'],
+                        'task4_answer_choice': student_df['predicted_task4_answer_choice']
+                    },
+                    'ground_truth': {
+                        'true_score': student_df['true_score'],
+                        'true_know_name': student_df['true_know_name'],
+                        'true_answer_choice_id': student_df.get('true_answer_choice_id', None)
+                    }
+                }
+                yield case, (student_id, train_df, practice, all_kc_names, question_choices,
+                             mastery_summary, tutoring_dict, seed)
         
-        # ===== 1. 掌握度评估案例 =====
-        # 需要从 mastery_lookup 重建输入
-        if mastery_lookup and student_id in mastery_lookup:
-            kc_name = student_df['true_know_name']
-            
-            # 重建掌握度评估的输入（从 assess_mastery.py 中提取逻辑）
-            # 这里简化处理，直接从 mastery_lookup 获取结果
-            mastery_info = mastery_lookup[student_id].get(kc_name, {})
-            
-            case['mastery_assessment'] = {
-                'input': {
-                    'student_id': student_id,
-                    'kc_name': kc_name,
-                    'note': '掌握度评估的完整输入需要查看 mastery_assessment_results.csv 或日志文件'
-                },
-                'output': {
-                    'mastery_level': mastery_info.get('mastery_level', 'N/A'),
-                    'rationale': mastery_info.get('rationale', ''),
-                    'suggestions': mastery_info.get('suggestions', '')
-                },
-                'full_summary': student_df['mastery_summary']
-            }
-        
-        # ===== 2. 辅导内容生成案例 =====
-        if tutoring_lookup and student_id in tutoring_lookup:
-            kc_name = student_df['true_know_name']
-            tutoring_info = tutoring_lookup[student_id].get(kc_name, {})
+        # 按学生构建 Agent 提示词（纯 CPU 模板拼接，学生多时并行），每个案例的提示词一返回就写出
+        assembled = _iter_assembled_cases(iter_pending_cases(), len(student_ids))
+        for case_index, (case, prompts) in enumerate(assembled):
+            # 画像相同的学生系统提示词完全一致，引用同一条 prompt_store 记录（也对应服务端的前缀缓存命中）
+            agent_input = case['agent_evaluation']['input']
+            agent_input['system_prompt_ref'] = _intern_prompt(prompt_store, prompts['system_prompt'])
+            agent_input['user_prompt_ref'] = _intern_prompt(prompt_store, prompts['user_prompt'])
             
-            case['tutoring_generation'] = {
-                'input': {
-                    'system_prompt': tutoring_info.get('prompt_system', ''),
-                    'user_prompt': tutoring_info.get('prompt_user', ''),
-                },
-                'output': {
-                    'tutoring_content': tutoring_info.get('tutoring_content', ''),
-                    'llm_raw_response': tutoring_info.get('llm_raw_response', ''),
-                    'example_question_ids': tutoring_info.get('example_question_ids', [])
-                },
-                'full_summary': student_df['tutoring_summary']
-            }
-        
-        # ===== 3. 评测智能体案例 =====
-        # 重建 Agent Prompt
-        profile = Profile(student_id, train_df, len(all_kc_names))
-        
-        practice = {
-            'question_id': student_df['question_id'],
-            'exer_content': student_records_df[student_records_df['question_id'] == student_df['question_id']].iloc[0]['exer_content'],
-            'know_name': student_df['true_know_name']
-        }
-        
-        question_choices = get_question_choices(student_df['question_id'], question_choices_df)
-        
-        mastery_summary = build_mastery_summary(
-            student_id, 
-            student_df['true_know_name'],
-            related_kc_map,
-            mastery_lookup,
-            kc_descriptions
-        )
-        
-        # 构建辅导字典
-        tutoring_dict = {}
-        if tutoring_lookup and student_id in tutoring_lookup:
-            for kc, info in tutoring_lookup[student_id].items():
-                tutoring_dict[kc] = info.get('tutoring_content', '')
-        
-        system_prompt = profile.build_prompt()
-        user_prompt = _build_agent_prompt(
-            practice,
-            all_kc_names,
-            question_choices,
-            mastery_summary=mastery_summary,
-            tutoring_dict=tutoring_dict
-        )
-        
-        case['agent_evaluation'] = {
-            'input': {
-                'system_prompt': system_prompt,
-                'user_prompt': user_prompt,
-                'question_id': student_df['question_id'],
-                'kc_name': student_df['true_know_name']
-            },
-            'output': {
-                'llm_raw_response': student_df['llm_raw_response'],
-                'task1_selfpredict': student_df['predicted_task1_selfpredict'],
-                'task2_know_name': student_df['predicted_task2_know_name'],
-                'task3_reasoning': student_df['predicted_task3_reasoning'],
-                'task4_answer_choice': student_df['predicted_task4_answer_choice']
-            },
-            'ground_truth': {
-                'true_score': student_df['true_score'],
-                'true_know_name': student_df['true_know_name'],
-                'true_answer_choice_id': student_df.get('true_answer_choice_id', None)
-            }
-        }
+            if case_index:
+                case_json_file.write(b',\n')
+            case_json_file.write(orjson.dumps(case, option=_ORJSON_OPTIONS | orjson.OPT_INDENT_2, default=_orjson_default))
+            if verbose:
+                case_details.append(_format_case_details(case_index + 1, case, prompt_store))
         
-        cases.append(case)
-    
-    # 保存案例到 JSON 文件
-    import json
-    import numpy as np
-    
-    # 定义自定义 JSON 编码器，处理 numpy 类型
-    class NumpyEncoder(json.JSONEncoder):
-        def default(self, obj):
-            if isinstance(obj, np.integer):
-                return int(obj)
-            elif isinstance(obj, np.floating):
-                return float(obj)
-            elif isinstance(obj, np.ndarray):
-                return obj.tolist()
-            elif isinstance(obj, np.bool_):
-                return bool(obj)
-            elif pd.isna(obj):
-                return None
-            return super(NumpyEncoder, self).default(obj)
-    
-    case_json_path = os.path.join(output_dir, 'in_out_cases.json')
-    with open(case_json_path, 'w', encoding='utf-8') as f:
-        json.dump(cases, f, ensure_ascii=False, indent=2, cls=NumpyEncoder)
+        case_json_file.write(b'\n],\n"prompt_store": ')
+        case_json_file.write(orjson.dumps(prompt_store, option=orjson.OPT_INDENT_2))
+        case_json_file.write(b'\n}')
     
     print(f"\n✅ 案例已保存至: {case_json_path}")
     
     # 同时打印到控制台
+    if not verbose:
+        print(f"   共 {len(student_ids)} 个案例（详情见 JSON 文件）")
+        return case_json_path
+    
     print("\n" + "="*80)
     print("📄 输入输出案例详情".center(80))
     print("="*80)
     
-    for i, case in enumerate(cases, 1):
-        print(f"\n{'='*80}")
-        print(f"案例 {i}: 学生 {case['student_id']}")
-        print(f"{'='*80}")
-        
-        # 掌握度评估
-        print(f"\n【1. 掌握度评估】")
-        print(f"输入: 知识点 = {case['mastery_assessment']['input']['kc_name']}")
-        print(f"输出: 掌握等级 = {case['mastery_assessment']['output']['mastery_level']}")
-        print(f"理由: {case['mastery_assessment']['output']['rationale'][:200]}...")
-        
-        # 辅导内容生成
-        print(f"\n【2. 辅导内容生成】")
-        print(f"系统提示词长度: {len(case['tutoring_generation']['input']['system_prompt'])} 字符")
-        print(f"用户提示词长度: {len(case['tutoring_generation']['input']['user_prompt'])} 字符")
-        print(f"输出内容长度: {len(case['tutoring_generation']['output']['tutoring_content'])} 字符")
-        print(f"示例题目ID: {case['tutoring_generation']['output']['example_question_ids']}")
-        
-        # 评测智能体
-        print(f"\n【3. 评测智能体】")
-        print(f"题目ID: {case['agent_evaluation']['input']['question_id']}")
-        print(f"知识点: {case['agent_evaluation']['input']['kc_name']}")
-        print(f"系统提示词长度: {len(case['agent_evaluation']['input']['system_prompt'])} 字符")
-        print(f"用户提示词长度: {len(case['agent_evaluation']['input']['user_prompt'])} 字符")
-        print(f"预测: Task1={case['agent_evaluation']['output']['task1_selfpredict']}, Task4={case['agent_evaluation']['output']['task4_answer_choice']}")
-        print(f"真实: 成绩={case['agent_evaluation']['ground_truth']['true_score']}")
+    for details in case_details:
+        sys.stdout.write(details)
     
     print("\n" + "="*80)
     return case_json_path
 
 
-def evaluate_results(df):
+# 案例数达到该值时才用多进程构建提示词（当前只取 3 个学生，一般走串行）
+_PARALLEL_CASE_MIN_STUDENTS = 32
+
+
+def _assemble_case(student_id, train_df, practice, all_kc_names, question_choices, mastery_summary, tutoring_dict, seed):
+    """重建单个学生的评测智能体提示词，返回 {'system_prompt', 'user_prompt'}（无共享可变状态，可在子进程执行）"""
+    profile = Profile(student_id, train_df, len(all_kc_names))
+    return {
+        'system_prompt': profile.build_prompt(),
+        'user_prompt': _build_agent_prompt(
+            practice,
+            all_kc_names,
+            question_choices,
+            mastery_summary=mastery_summary,
+            tutoring_dict=tutoring_dict,
+            rng=random.Random(f"{seed}:{student_id}")
+        ),
+    }
+
+
+def _iter_assembled_cases(case_items, total, workers=None):
+    """
+    按输入顺序逐个产出 (case, _assemble_case 的结果)；case_items 为惰性的 (case, args) 序列，total 为其长度。
+    
+    案例较多时交给 ProcessPoolExecutor 并行构建，但只预取每个进程 2 个案例，
+    不会一次把所有案例及其构建参数提交出去留在内存里。
+    """
+    workers = min(workers or os.cpu_count() or 1, total)
+    if workers <= 1 or total < _PARALLEL_CASE_MIN_STUDENTS:
+        for case, args in case_items:
+            yield case, _assemble_case(*args)
+        return
+    with _process_pool(workers) as executor:
+        in_flight = deque()
+        for case, args in case_items:
+            in_flight.append((case, executor.submit(_assemble_case, *args)))
+            if len(in_flight) >= workers * 2:
+                case, future = in_flight.popleft()
+                yield case, future.result()
+        while in_flight:
+            case, future = in_flight.popleft()
+            yield case, future.result()
+
+
+def _intern_prompt(prompt_store, text):
+    """把提示词按内容哈希存入 prompt_store（相同内容只存一份），返回引用键"""
+    if not isinstance(text, str):  # CSV 中缺失的提示词读出来是 NaN
+        text = ''
+    key = hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+    prompt_store.setdefault(key, text)
+    return key
+
+
+def _format_case_details(i, case, prompt_store):
+    """把单个输入输出案例格式化为控制台展示文本（提示词通过 prompt_store 解引用）"""
+    mastery_case = case['mastery_assessment']
+    tutoring_case = case['tutoring_generation']
+    agent_case = case['agent_evaluation']
+    return (
+        f"\n{'='*80}\n"
+        f"案例 {i}: 学生 {case['student_id']}\n"
+        f"{'='*80}\n"
+        # 掌握度评估
+        f"\n【1. 掌握度评估】\n"
+        f"输入: 知识点 = {mastery_case['input']['kc_name']}\n"
+        f"输出: 掌握等级 = {mastery_case['output']['mastery_level']}\n"
+        f"理由: {mastery_case['output']['rationale'][:200]}...\n"
+        # 辅导内容生成
+        f"\n【2. 辅导内容生成】\n"
+        f"系统提示词长度: {len(prompt_store[tutoring_case['input']['system_prompt_ref']])} 字符\n"
+        f"用户提示词长度: {len(prompt_store[tutoring_case['input']['user_prompt_ref']])} 字符\n"
+        f"输出内容长度: {len(tutoring_case['output']['tutoring_content'])} 字符\n"
+        f"示例题目ID: {tutoring_case['output']['example_question_ids']}\n"
+        # 评测智能体
+        f"\n【3. 评测智能体】\n"
+        f"题目ID: {agent_case['input']['question_id']}\n"
+        f"知识点: {agent_case['input']['kc_name']}\n"
+        f"系统提示词长度: {len(prompt_store[agent_case['input']['system_prompt_ref']])} 字符\n"
+        f"用户提示词长度: {len(prompt_store[agent_case['input']['user_prompt_ref']])} 字符\n"
+        f"预测: Task1={agent_case['output']['task1_selfpredict']}, Task4={agent_case['output']['task4_answer_choice']}\n"
+        f"真实: 成绩={agent_case['ground_truth']['true_score']}\n"
+    )
+
+
+def evaluate_results(df, choice_ids_by_qid=None):
     """
     计算并展示各项评估指标, 包括 ACC, F1-score, ROUGE-3。
+    
+    choice_ids_by_qid: build_choice_ids_by_question 的结果，提供时 Task4 按题目 ID 查选项
     """
     print("\n" + "="*80)
     print("📊 阶段 3/3: 结果评估与分析".center(80))
@@ -2459,72 +3746,29 @@ def evaluate_results(df):
         print("结果DataFrame为空，无法评估。")
         return
 
-    eval_df = df.copy()
-
-    # --- 数据清洗和规范化 ---
-    def normalize_yes_no(val):
-        if isinstance(val, str):
-            val_lower = val.strip().lower().replace('.', '')
-            if val_lower == 'yes': return 1
-            if val_lower == 'no': return 0
-        return np.nan
-    
-    def normalize_to_prob(val, high_confidence=0.95, low_confidence=0.05):
-        """将 Yes/No 转换为概率值"""
-        if isinstance(val, str):
-            val_lower = val.strip().lower().replace('.', '')
-            if val_lower == 'yes': return high_confidence
-            if val_lower == 'no': return low_confidence
-        return 0.5 # 对于无法解析的值，返回中性概率
-
-    # 新的评估逻辑：基于答案选项进行比对
-    def parse_answer_choice(val):
-        """解析Task4的答案选项 (A/B/C/D) 转换为choice_id"""
-        if not isinstance(val, str):
-            return None
-        val = val.strip().upper()
-        # 提取第一个字母作为选项
-        if val and val[0] in 'ABCDEFGH':
-            return val[0]
-        return None
-    
-    eval_df['predicted_answer_choice'] = eval_df['predicted_task4_answer_choice'].apply(parse_answer_choice)
+    # --- 数据清洗和规范化（向量化） ---
+    # assign 返回与 df 共享数据的新表（Copy-on-Write），不复制原始结果
+    eval_df = df.assign(
+        # 新的评估逻辑：基于答案选项进行比对（Task4 的答案选项 A/B/C/D）
+        predicted_answer_choice=_parse_answer_choice_series(df['predicted_task4_answer_choice']),
+        # Task1的自我预测 (Yes/No)
+        pred_t1_selfpredict=_normalize_yes_no_series(df['predicted_task1_selfpredict']),
+    )
     
-    # Task1的自我预测 (Yes/No)
-    eval_df['pred_t1_selfpredict'] = eval_df['predicted_task1_selfpredict'].apply(normalize_yes_no)
+    # 分组与比较用到的字符串列转为 category（按整数编码分组/比较）；
+    # 两个知识点列共用同一组类别，才能直接逐行比较
+    know_name_dtype = pd.CategoricalDtype(
+        pd.unique(pd.concat([eval_df['true_know_name'], eval_df['predicted_task2_know_name']]).dropna())
+    )
+    eval_df = eval_df.astype({
+        **{column: 'category' for column in ('experiment_mode', 'experiment_type') if column in eval_df.columns},
+        'true_know_name': know_name_dtype,
+        'predicted_task2_know_name': know_name_dtype,
+    })
     
     # --- 核心评估逻辑 ---
-    # 基于答案选项计算准确率
-    def check_answer_correctness(row):
-        """检查答案是否正确：将预测的选项字母转换为choice_id并比对"""
-        predicted_choice = row.get('predicted_answer_choice')
-        if predicted_choice is None:
-            return None
-        
-        # 从question_choices字符串中解析选项
-        question_choices_str = row.get('question_choices')
-        if not question_choices_str or question_choices_str == 'None':
-            # 如果没有选项，回退到使用true_score
-            return row.get('true_score')
-        
-        try:
-            import ast
-            choices = ast.literal_eval(question_choices_str)
-            if not isinstance(choices, list) or len(choices) == 0:
-                return row.get('true_score')
-            
-            # 找到预测选项对应的choice_id
-            choice_index = ord(predicted_choice) - ord('A')
-            if 0 <= choice_index < len(choices):
-                predicted_choice_id = choices[choice_index].get('choice_id')
-                correct_choice_id = row.get('true_answer_choice_id')
-                return 1 if predicted_choice_id == correct_choice_id else 0
-        except:
-            pass
-        
-        return None
-    
-    eval_df['effective_prediction'] = eval_df.apply(check_answer_correctness, axis=1)
+    # 基于答案选项计算准确率：每道题只取一次选项（见 _answer_correctness_series）
+    eval_df['effective_prediction'] = _task4_correctness(eval_df, eval_df['predicted_answer_choice'], choice_ids_by_qid)
     
     # 对于没有有效预测的行，使用true_score作为后备
     eval_df['effective_prediction'] = eval_df['effective_prediction'].fillna(eval_df['true_score'])
@@ -2534,10 +3778,7 @@ def evaluate_results(df):
     meta_results = {}
     if not meta_df.empty:
         meta_results['overall'] = (meta_df['pred_t1_selfpredict'] == meta_df['true_score']).mean()
-        for exp_type in meta_df['experiment_type'].unique():
-            subset = meta_df[meta_df['experiment_type'] == exp_type]
-            if subset.empty:
-                continue
+        for exp_type, subset in meta_df.groupby('experiment_type', sort=False, observed=True):
             meta_results[exp_type] = (subset['pred_t1_selfpredict'] == subset['true_score']).mean()
 
     # 3. 任务2 (知识点识别) 准确率
@@ -2581,101 +3822,74 @@ def evaluate_results(df):
     consistency_f1_results = {}
     consistency_ce_results = {}
 
+    # 分组统一用 groupby(sort=False) 一次切分（保持各组首次出现的顺序），ACC 与加权 F1 由 numpy 一次算出
     # 如果有 experiment_mode 列，则按 experiment_mode 分组
     if 'experiment_mode' in report_df.columns:
-        for mode in report_df['experiment_mode'].unique():
-            mode_subset = report_df[report_df['experiment_mode'] == mode]
-            if mode_subset.empty:
-                continue
-            for exp_type in mode_subset['experiment_type'].unique():
-                subset = mode_subset[mode_subset['experiment_type'] == exp_type]
-                if subset.empty:
-                    continue
+        for mode, mode_subset in report_df.groupby('experiment_mode', sort=False, observed=True):
+            for exp_type, subset in mode_subset.groupby('experiment_type', sort=False, observed=True):
                 key = f"{mode}_{exp_type}" if mode != 'baseline' else mode
-                acc_results[key] = (subset['effective_prediction'] == subset['true_score']).mean()
-                f1_results[key] = f1_score(subset['true_score'], subset['effective_prediction'], average='weighted')
+                acc_results[key], f1_results[key] = _accuracy_and_weighted_f1(
+                    subset['true_score'].to_numpy(), subset['effective_prediction'].to_numpy()
+                )
         
         # 选择题评估简化：不计算交叉熵（无概率输入），移除 log_loss_df 相关逻辑
         
         # 计算知识点识别准确率
         kc_df = eval_df[['predicted_task2_know_name', 'true_know_name', 'experiment_mode', 'experiment_type']].dropna()
         if not kc_df.empty:
-            for mode in kc_df['experiment_mode'].unique():
-                mode_subset = kc_df[kc_df['experiment_mode'] == mode]
-                if mode_subset.empty:
-                    continue
-                for exp_type in mode_subset['experiment_type'].unique():
-                    subset = mode_subset[mode_subset['experiment_type'] == exp_type]
-                    if subset.empty:
-                        continue
+            for mode, mode_subset in kc_df.groupby('experiment_mode', sort=False, observed=True):
+                for exp_type, subset in mode_subset.groupby('experiment_type', sort=False, observed=True):
                     key = f"{mode}_{exp_type}" if mode != 'baseline' else mode
                     kc_recognition_results[key] = (subset['predicted_task2_know_name'] == subset['true_know_name']).mean()
         
         # 计算自我预测一致性指标
         if not consistency_df.empty and 'experiment_mode' in consistency_df.columns:
-            for mode in consistency_df['experiment_mode'].unique():
-                mode_subset = consistency_df[consistency_df['experiment_mode'] == mode]
-                if mode_subset.empty:
-                    continue
-                for exp_type in mode_subset['experiment_type'].unique():
-                    subset = mode_subset[mode_subset['experiment_type'] == exp_type]
-                    if subset.empty:
-                        continue
+            for mode, mode_subset in consistency_df.groupby('experiment_mode', sort=False, observed=True):
+                for exp_type, subset in mode_subset.groupby('experiment_type', sort=False, observed=True):
                     key = f"{mode}_{exp_type}" if mode != 'baseline' else mode
-                    # ACC: 预测与实际的一致性（使用Task1的自我预测）
-                    consistency_acc_results[key] = (subset['pred_t1_selfpredict'] == subset['true_score']).mean()
-                    # F1-Score
-                    consistency_f1_results[key] = f1_score(subset['true_score'], subset['pred_t1_selfpredict'], average='weighted')
+                    # ACC: 预测与实际的一致性（使用Task1的自我预测）与 F1-Score
+                    consistency_acc_results[key], consistency_f1_results[key] = _accuracy_and_weighted_f1(
+                        subset['true_score'].to_numpy(), subset['pred_t1_selfpredict'].to_numpy()
+                    )
                     # Cross Entropy
-                    subset_with_prob = subset.copy()
-                    subset_with_prob['consistency_prob'] = subset_with_prob['pred_t1_selfpredict'].apply(normalize_to_prob)
-                    consistency_ce_results[key] = log_loss(subset_with_prob['true_score'], subset_with_prob['consistency_prob'])
+                    consistency_ce_results[key] = log_loss(subset['true_score'], _binary_to_prob(subset['pred_t1_selfpredict'].to_numpy()))
     else:
         # 原有逻辑（向后兼容）
-        for exp_type in report_df['experiment_type'].unique():
-            subset = report_df[report_df['experiment_type'] == exp_type]
-            if subset.empty:
-                continue
-            acc_results[exp_type] = (subset['effective_prediction'] == subset['true_score']).mean()
-            f1_results[exp_type] = f1_score(subset['true_score'], subset['effective_prediction'], average='weighted')
+        for exp_type, subset in report_df.groupby('experiment_type', sort=False, observed=True):
+            acc_results[exp_type], f1_results[exp_type] = _accuracy_and_weighted_f1(
+                subset['true_score'].to_numpy(), subset['effective_prediction'].to_numpy()
+            )
 
         # 选择题评估简化：不计算交叉熵（无概率输入），移除 log_loss_df 相关逻辑
         
         # 知识点识别准确率
         kc_df = eval_df[['predicted_task2_know_name', 'true_know_name', 'experiment_type']].dropna()
         if not kc_df.empty:
-            for exp_type in kc_df['experiment_type'].unique():
-                subset = kc_df[kc_df['experiment_type'] == exp_type]
-                if subset.empty:
-                    continue
+            for exp_type, subset in kc_df.groupby('experiment_type', sort=False, observed=True):
                 kc_recognition_results[exp_type] = (subset['predicted_task2_know_name'] == subset['true_know_name']).mean()
         
         # 自我预测一致性（使用Task1的自我预测）
         if not consistency_df.empty:
-            for exp_type in consistency_df['experiment_type'].unique():
-                subset = consistency_df[consistency_df['experiment_type'] == exp_type]
-                if subset.empty:
-                    continue
-                consistency_acc_results[exp_type] = (subset['pred_t1_selfpredict'] == subset['true_score']).mean()
-                consistency_f1_results[exp_type] = f1_score(subset['true_score'], subset['pred_t1_selfpredict'], average='weighted')
-                subset_with_prob = subset.copy()
-                subset_with_prob['consistency_prob'] = subset_with_prob['pred_t1_selfpredict'].apply(normalize_to_prob)
-                consistency_ce_results[exp_type] = log_loss(subset_with_prob['true_score'], subset_with_prob['consistency_prob'])
+            for exp_type, subset in consistency_df.groupby('experiment_type', sort=False, observed=True):
+                consistency_acc_results[exp_type], consistency_f1_results[exp_type] = _accuracy_and_weighted_f1(
+                    subset['true_score'].to_numpy(), subset['pred_t1_selfpredict'].to_numpy()
+                )
+                consistency_ce_results[exp_type] = log_loss(subset['true_score'], _binary_to_prob(subset['pred_t1_selfpredict'].to_numpy()))
     
     # 4. ROUGE-3 分数 (任务3 - 答案文本相似度)
     # 注意: Transaction.csv 中 'answer_text' 为空, 无法直接对比。
     # 这里我们做一个简化示范：将模型输出的Task3与一个假设的"标准答案"对比。
     # 在真实场景中，您需要有可对比的参考答案文本。
-    scorer = rouge_scorer.RougeScorer(['rouge3'], use_stemmer=True)
-    rouge_scores = []
-    for index, row in eval_df.iterrows():
-        # 简化：此处我们没有真实的学生答案文本，所以无法计算ROUGE。
-        # 仅为演示逻辑，我们将模型输出与自身对比，真实场景需要替换为参考答案。
-        reference_answer = str(row['true_answer_text']) # 应该是真实的学生答案
-        model_answer = str(row['predicted_task3_reasoning'])
-        if reference_answer and model_answer:
-            scores = scorer.score(reference_answer, model_answer)
-            rouge_scores.append(scores['rouge3'].fmeasure)
+    # 简化：此处我们没有真实的学生答案文本，所以无法计算ROUGE。
+    # 仅为演示逻辑，我们将模型输出与自身对比，真实场景需要替换为参考答案。
+    rouge_pairs = [
+        (reference_answer, model_answer)  # reference_answer 应该是真实的学生答案
+        for reference_answer, model_answer in zip(
+            eval_df['true_answer_text'].astype(str), eval_df['predicted_task3_reasoning'].astype(str)
+        )
+        if reference_answer and model_answer
+    ]
+    rouge_scores = _rouge3_scores(rouge_pairs)
     
     avg_rouge3 = np.mean(rouge_scores) if rouge_scores else 0
 
@@ -2779,13 +3993,13 @@ def evaluate_results(df):
         fig, axes = plt.subplots(1, 2, figsize=(14, 5))
         
         # Task1 混淆矩阵
-        cm_t1 = confusion_matrix(consistency_df['true_score'], consistency_df['pred_t1_selfpredict'])
+        cm_t1 = _binary_confusion_matrix(consistency_df['true_score'], consistency_df['pred_t1_selfpredict'])
         disp_t1 = ConfusionMatrixDisplay(confusion_matrix=cm_t1, display_labels=['错误', '正确'])
         disp_t1.plot(cmap='Blues', ax=axes[0])
         axes[0].set_title('Task1: 自我预测混淆矩阵')
         
         # Task4 混淆矩阵
-        cm_t4 = confusion_matrix(report_df['true_score'], report_df['effective_prediction'])
+        cm_t4 = _binary_confusion_matrix(report_df['true_score'], report_df['effective_prediction'])
         disp_t4 = ConfusionMatrixDisplay(confusion_matrix=cm_t4, display_labels=['错误', '正确'])
         disp_t4.plot(cmap='Greens', ax=axes[1])
         axes[1].set_title('Task4: 答案选择混淆矩阵')
@@ -2796,7 +4010,7 @@ def evaluate_results(df):
         plt.close()
     else:
         # 如果没有 Task1 数据，只保存 Task4 混淆矩阵
-        cm = confusion_matrix(report_df['true_score'], report_df['effective_prediction'])
+        cm = _binary_confusion_matrix(report_df['true_score'], report_df['effective_prediction'])
         disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=['错误', '正确'])
         disp.plot(cmap='Blues')
         plt.title('Task4: 答案选择混淆矩阵')
@@ -2825,14 +4039,43 @@ async def main():
                        help="指定使用的LLM模型名称（如 gpt-3.5-turbo, qwen-plus, doubao-pro-32k等）。若不指定则使用代码中的默认值。")
     parser.add_argument("--save-interval", type=int, default=20,
                        help="每完成多少个学生保存一次结果。默认20。")
+    parser.add_argument("--save-max-seconds", type=float, default=30,
+                       help="距上次增量保存超过多少秒且有新结果时，即使未达到 --save-interval 也保存一次。默认30。")
     parser.add_argument("--no-resume", action="store_true",
                        help="禁用断点续跑：不加载已有结果，从头开始运行所有学生。")
     parser.add_argument("--test-kcs-only", action="store_true", default=True,
                        help="辅导内容生成优化：仅为测试集涉及的知识点生成辅导（默认启用，节省LLM调用）。")
     parser.add_argument("--all-weak-kcs", action="store_true",
                        help="辅导内容生成：为所有薄弱知识点生成辅导（禁用优化，生成全部）。")
+    parser.add_argument("--prep-workers", type=int, default=None,
+                       help="准备请求阶段使用的进程数。默认使用全部CPU核心；设置为1则串行准备。配合 --parallel-modes 时由各模式平分。")
+    parser.add_argument("--cache", action="store_true",
+                       help="启用 LLM 响应缓存：提示词与模型完全相同的请求复用已缓存的响应（默认关闭，每次运行都重新采样模型）。"
+                            "与 --no-resume 同时使用时只写入缓存、不读取。")
+    parser.add_argument("--no-cache", action="store_true",
+                       help="禁用 LLM 响应缓存（默认已禁用，保留以兼容旧命令；优先于 --cache）。")
+    parser.add_argument("--cache-ttl-hours", type=float, default=168,
+                       help="LLM 响应缓存有效期（小时）。默认168（7天）；设置为0则永不过期。")
+    parser.add_argument("--semantic-cache", action="store_true",
+                       help="启用语义缓存：对相似度足够高且题目、知识点、学生画像一致的提示词复用已有响应（需要安装 sentence-transformers 与 faiss-cpu）。")
+    parser.add_argument("--semantic-threshold", type=float, default=0.97,
+                       help="语义缓存命中所需的最小余弦相似度。默认0.97。")
+    parser.add_argument("--adaptive-concurrency", action="store_true",
+                       help="启用 AIMD 自适应并发：延迟正常时逐步增加并发（上限为 --concurrency），遇到限流/超时或延迟过高时减半。")
+    parser.add_argument("--latency-target", type=float, default=20.0,
+                       help="自适应并发的目标平均延迟（秒）。默认20。")
+    parser.add_argument("--rpm-limit", type=int, default=0,
+                       help="每分钟最多发出的请求数（滑动窗口）。默认0表示不限制。")
+    parser.add_argument("--parallel-modes", action="store_true",
+                       help="同时运行所有实验模式（共享 --concurrency 并发上限），适合单个模式用不满并发额度的情况。")
+    parser.add_argument("--check-chunksize", type=int, default=100_000,
+                       help="辅导内容完整性检查每批扫描的记录数。默认100000；设置为0则一次扫描全部。")
     args = parser.parse_args()
     
+    # 输出重定向到文件/管道时（如容器、CI 日志）改为块缓冲，避免 PYTHONUNBUFFERED 下每次 print 都触发一次系统调用
+    if not sys.stdout.isatty():
+        sys.stdout.reconfigure(line_buffering=False, write_through=False)
+    
     # 如果用户指定了模型名称，覆盖默认值
     global MODEL_NAME
     if args.model_name:
@@ -2864,6 +4107,8 @@ async def main():
         kc_descriptions,
         question_choices_df
     ) = load_and_preprocess_data(PROJECT_ROOT)
+    # 题目 → 选项 choice_id 列表（评估时按题目 ID 判分）
+    choice_ids_by_qid = build_choice_ids_by_question(question_choices_df)
 
     # 准备KCG和所有知识点列表
     know_name_map = kcs_df.set_index('id')['name'].to_dict()
@@ -2881,6 +4126,11 @@ async def main():
         random.shuffle(student_ids)  # 打乱顺序
         student_ids = student_ids[:min(args.students, len(student_ids))]
         student_ids = sorted(student_ids)  # 重新排序以便于日志查看
+    # 成员判断与按学生过滤统一使用这一份集合，不再在各处重复 set(student_ids)
+    student_ids_set = set(student_ids)
+
+    # 一次性计算所选学生的训练/测试集划分，供辅导完整性检查和各模式实验复用
+    split_cache = build_split_cache(student_ids, all_student_records)
 
     # 准备日志文件
     output_dir = os.path.join(os.path.dirname(__file__), '../results')
@@ -2911,7 +4161,11 @@ async def main():
     
     # 增量保存相关变量
     completed_students_count = {}  # {exp_mode: count}
-    accumulated_results = {}  # {exp_mode: DataFrame}
+    accumulated_results = {}  # {exp_mode: [DataFrame, ...]}，保存时才合并，避免每个学生都整表 concat
+    accumulated_rows = {}  # {exp_mode: 已累积的数据行数}
+    persisted_frames = {}  # {exp_mode: accumulated_results 中已写入结果文件的 DataFrame 数量}
+    last_save_ts = {}  # {exp_mode: 上次增量保存的 time.monotonic()}
+    last_saved_count = {}  # {exp_mode: 上次增量保存时的已完成学生数}
     
     # 🔹 只有在需要 mastery_only 或 both 模式时才加载/生成掌握度评估数据
     # 🔥 优化：tutoring_only 模式也尝试加载掌握度数据（如果存在）
@@ -2937,11 +4191,10 @@ async def main():
             try:
                 mastery_df = pd.read_csv(mode_path)
                 mastery_student_ids = set(mastery_df['student_id'].unique())
-                current_student_ids = set(student_ids)
-                if not current_student_ids.issubset(mastery_student_ids):
-                    missing_students = current_student_ids - mastery_student_ids
+                if not student_ids_set.issubset(mastery_student_ids):
+                    missing_students = student_ids_set - mastery_student_ids
                     print(f"\n⚠️  掌握度数据不包含当前采样的所有学生")
-                    print(f"   当前实验学生: {len(current_student_ids)} 个")
+                    print(f"   当前实验学生: {len(student_ids_set)} 个")
                     print(f"   掌握度数据学生: {len(mastery_student_ids)} 个")
                     print(f"   缺失学生数: {len(missing_students)} 个")
                     mastery_students_mismatch = True
@@ -2990,7 +4243,7 @@ async def main():
         
         # 加载掌握度评估数据（mastery_only、tutoring_only、both 都尝试加载）
         if os.path.exists(mode_path):
-            mastery_lookup = load_mastery_assessment_results(mode_path, set(student_ids))
+            mastery_lookup = load_mastery_assessment_results(mode_path, student_ids_set)
             if not mastery_lookup:
                 if "mastery_only" in experiment_modes:
                     print("⚠️  无法加载掌握度数据，mastery_only 实验将被跳过。")
@@ -3035,74 +4288,89 @@ async def main():
             # 🔥 优化：按"学生 + 知识点"维度检查辅导内容数据的完整性
             tutoring_students_mismatch = False
             missing_pairs = set()  # 缺失的 (student_id, kc_name) 对
+            tutoring_df = None  # 检查时读入的辅导内容表，数据无需重新生成时直接复用于加载
+            check_cache_path = tutoring_path + '.check_cache.json'
             
             if os.path.exists(tutoring_path) and not needs_rerun:
                 try:
-                    # 使用 pickle 读取
-                    tutoring_df = pd.read_pickle(tutoring_path)
-                    print(f"✅ 已加载辅导内容数据: {len(tutoring_df)} 条记录")
-                    
                     # 🔥 新逻辑：计算期望的辅导对
                     print(f"\n🔍 正在计算期望的辅导内容...")
                     expected_result = calculate_expected_tutoring_pairs(
                         student_ids, 
                         all_student_records, 
                         mastery_lookup,
-                        enable_test_kcs_optimization
+                        enable_test_kcs_optimization,
+                        split_cache=split_cache
                     )
                     expected_pairs = expected_result['expected_pairs']
                     student_weak_kcs_map = expected_result['student_weak_kcs']
                     
-                    # 构建现有的辅导对
-                    existing_pairs = set()
-                    for _, row in tutoring_df.iterrows():
-                        sid = row['student_id']
-                        kc = row['kc_name']
-                        # 只统计当前实验涉及的学生
-                        if sid in student_ids:
-                            existing_pairs.add((sid, kc))
-                    
-                    # 计算缺失的辅导对
-                    missing_pairs = expected_pairs - existing_pairs
-                    
-                    # 详细报告
-                    print(f"\n📊 辅导内容完整性检查报告")
-                    print(f"{'='*80}")
-                    print(f"   • 期望辅导对数量: {len(expected_pairs)}")
-                    print(f"   • 已有辅导对数量: {len(existing_pairs)}")
-                    print(f"   • 缺失辅导对数量: {len(missing_pairs)}")
-                    
-                    if missing_pairs:
-                        tutoring_students_mismatch = True
+                    # 辅导内容文件、学生和期望辅导对都未变化时，直接复用上次的检查结论，不再读取和扫描辅导内容
+                    check_key = tutoring_check_cache_key(tutoring_path, student_ids, expected_pairs)
+                    cached_check = _load_tutoring_check_cache(check_cache_path, check_key)
+                    if cached_check is not None:
+                        tutoring_students_mismatch = cached_check['mismatch']
+                        _emit_lines([
+                            f"\n📊 辅导内容完整性检查报告（沿用缓存结果）",
+                            f"{'='*80}",
+                            f"   • 期望辅导对数量: {cached_check['expected_count']}",
+                            f"   • 已有辅导对数量: {cached_check['existing_count']}",
+                            f"   • 缺失辅导对数量: {cached_check['missing_count']}",
+                        ])
+                    else:
+                        # 使用 pickle 读取（pickle 无法只读部分列，因此整表只读这一次）
+                        tutoring_df = pd.read_pickle(tutoring_path)
+                        print(f"✅ 已加载辅导内容数据: {len(tutoring_df)} 条记录")
                         
-                        # 按学生统计缺失情况
-                        missing_by_student = defaultdict(list)
-                        for sid, kc in missing_pairs:
-                            missing_by_student[sid].append(kc)
+                        # 计算缺失的辅导对
+                        completeness = check_tutoring_completeness(tutoring_df, expected_pairs, chunksize=args.check_chunksize)
+                        missing_pairs = completeness['missing_pairs']
+                        missing_by_student = completeness['missing_by_student']
                         
-                        print(f"\n⚠️  检测到 {len(missing_by_student)} 个学生的辅导内容不完整")
-                        print(f"   缺失详情（前10个学生）:")
-                        for i, (sid, kcs) in enumerate(sorted(missing_by_student.items())[:10]):
-                            expected_kcs = student_weak_kcs_map.get(sid, [])
-                            print(f"   • 学生 {sid}: 缺失 {len(kcs)}/{len(expected_kcs)} 个知识点")
-                            if len(kcs) <= 5:
-                                print(f"     缺失知识点: {', '.join(kcs)}")
-                            else:
-                                print(f"     缺失知识点: {', '.join(kcs[:5])} ... (共{len(kcs)}个)")
+                        # 详细报告
+                        report_lines = [
+                            f"\n📊 辅导内容完整性检查报告",
+                            f"{'='*80}",
+                            f"   • 期望辅导对数量: {len(expected_pairs)}",
+                            f"   • 已有辅导对数量: {completeness['existing_count']}",
+                            f"   • 缺失辅导对数量: {len(missing_pairs)}",
+                        ]
                         
-                        if len(missing_by_student) > 10:
-                            print(f"   ... 还有 {len(missing_by_student) - 10} 个学生未显示")
-                    else:
-                        print(f"\n✅ 辅导内容数据完整性检查通过！")
-                        print(f"   所有学生的所有薄弱知识点都已生成辅导内容")
+                        if missing_pairs:
+                            tutoring_students_mismatch = True
+                        
+                            report_lines.append(f"\n⚠️  检测到 {len(missing_by_student)} 个学生的辅导内容不完整")
+                            report_lines.append(f"   缺失详情（前10个学生）:")
+                            for i, (sid, kcs) in enumerate(list(missing_by_student.items())[:10]):
+                                expected_kcs = student_weak_kcs_map.get(sid, [])
+                                report_lines.append(f"   • 学生 {sid}: 缺失 {len(kcs)}/{len(expected_kcs)} 个知识点")
+                                if len(kcs) <= 5:
+                                    report_lines.append(f"     缺失知识点: {', '.join(kcs)}")
+                                else:
+                                    report_lines.append(f"     缺失知识点: {', '.join(kcs[:5])} ... (共{len(kcs)}个)")
+                        
+                            if len(missing_by_student) > 10:
+                                report_lines.append(f"   ... 还有 {len(missing_by_student) - 10} 个学生未显示")
+                        else:
+                            report_lines.append(f"\n✅ 辅导内容数据完整性检查通过！")
+                            report_lines.append(f"   所有学生的所有薄弱知识点都已生成辅导内容")
+                        _emit_lines(report_lines)
+                        _save_tutoring_check_cache(check_cache_path, check_key, {
+                            'mismatch': tutoring_students_mismatch,
+                            'expected_count': len(expected_pairs),
+                            'existing_count': completeness['existing_count'],
+                            'missing_count': len(missing_pairs),
+                        })
                             
                 except Exception as e:
                     print(f"⚠️  检查辅导内容数据时出错: {e}")
-                    import traceback
                     traceback.print_exc()
                     tutoring_students_mismatch = True
             
             if needs_rerun or not os.path.exists(tutoring_path) or tutoring_students_mismatch:
+                tutoring_df = None  # 文件将被重新生成，检查时读入的数据和检查缓存都已过期
+                if os.path.exists(check_cache_path):
+                    os.remove(check_cache_path)
                 print("\n" + "="*80)
                 print("🔍 辅导内容数据检查".center(80))
                 print("="*80)
@@ -3144,6 +4412,7 @@ async def main():
                 
                 try:
                     # 🔥 使用异步子进程，实时输出日志（与 mastery_only 保持一致）
+                    sys.stdout.flush()  # 子进程直接写同一个 stdout，先把本进程缓冲的输出写出以保持顺序
                     proc = await asyncio.create_subprocess_exec(*cmd)
                     await proc.wait()
                     if proc.returncode != 0:
@@ -3167,7 +4436,7 @@ async def main():
             
             # 加载辅导内容数据
             if "tutoring_only" in experiment_modes or "both" in experiment_modes:  # 如果还在实验列表中（没有因生成失败被移除）
-                tutoring_lookup = load_tutoring_content_results(tutoring_path, set(student_ids))
+                tutoring_lookup = load_tutoring_content_results(tutoring_path, student_ids_set, tutoring_df=tutoring_df)
                 if not tutoring_lookup:
                     if "tutoring_only" in experiment_modes:
                         print("⚠️  无法加载辅导内容数据，tutoring_only 实验将被跳过。")
@@ -3176,78 +4445,81 @@ async def main():
                         print("⚠️  Both 模式无法加载辅导内容，将降级为 Mastery Only 模式")
                         # Both 模式降级为 mastery_only（不移除 both，稍后在配置中处理）
     
+    # LLM 响应缓存（按 prompt + 模型哈希，跨模式、跨运行复用；需 --cache 显式开启）
+    # --no-resume 表示重新采样模型，此时缓存只写不读，不会回放旧的响应
+    cache_read_enabled = not args.no_resume
+    response_cache = None
+    if args.cache and not args.no_cache:
+        cache_path = os.path.join(output_dir, 'llm_response_cache.sqlite')
+        response_cache = LLMResponseCache(cache_path, ttl_seconds=args.cache_ttl_hours * 3600, read_enabled=cache_read_enabled)
+        print(f"\n💾 LLM 响应缓存: {cache_path}（有效期: {f'{args.cache_ttl_hours:g} 小时' if args.cache_ttl_hours else '永久'}"
+              f"{'' if cache_read_enabled else '；--no-resume：只写入，不复用已缓存的响应'}）")
+    
+    semantic_cache = None
+    if args.semantic_cache:
+        try:
+            semantic_cache = SemanticResponseCache(output_dir, threshold=args.semantic_threshold, read_enabled=cache_read_enabled)
+            print(f"🧭 语义缓存: 已启用（相似度阈值: {args.semantic_threshold}{'' if cache_read_enabled else '；--no-resume：只写入'}）")
+        except ImportError as e:
+            print(f"⚠️  语义缓存不可用，已跳过（需要安装 sentence-transformers 与 faiss-cpu）: {e}")
+    
+    limiter = None
+    if args.adaptive_concurrency or args.rpm_limit > 0:
+        limiter = AdaptiveConcurrencyLimiter(
+            max_limit=args.concurrency,
+            latency_target=args.latency_target,
+            rpm_limit=args.rpm_limit,
+            adaptive=args.adaptive_concurrency
+        )
+        print(f"🎚️  自适应并发: {'已启用' if args.adaptive_concurrency else '未启用'}（目标延迟: {args.latency_target:g}s，RPM 上限: {args.rpm_limit or '不限'}）")
+    
     # 运行各组实验
-    for exp_mode in experiment_modes:
+    # 掌握度/辅导数据在各模式运行期间不再变化，Both 模式的降级结果提前一次算好
+    has_mastery = bool(mastery_lookup)
+    has_tutoring = bool(tutoring_lookup)
+    actual_modes = {exp_mode: _downgrade(exp_mode, has_mastery, has_tutoring) for exp_mode in experiment_modes}
+    
+    # 一次 scandir 列出输出目录中已有的文件，各模式按文件名查表，不再逐个 stat（各模式的文件名互不重叠）
+    with os.scandir(output_dir) as entries:
+        existing_output_files = {entry.name for entry in entries if entry.is_file()}
+    
+    # --parallel-modes 时各模式会同时启动各自的准备进程池（每个进程都持有一份只读查表数据），
+    # 因此把准备进程数在并行的模式之间平分，总进程数仍不超过 --prep-workers（默认 CPU 核心数）
+    mode_prep_workers = args.prep_workers
+    if args.parallel_modes and len(experiment_modes) > 1:
+        mode_prep_workers = max(1, (args.prep_workers or os.cpu_count() or 1) // len(experiment_modes))
+    
+    async def run_mode(exp_mode):
+        """运行单个实验模式（含断点续跑与增量保存），返回该模式的完整结果；没有结果时返回 None"""
         # 断点续跑（默认开启）：加载已有结果并过滤学生
         # 文件名包含模型名称，避免不同模型结果互相覆盖
-        # 配置实验参数（包含 Both 模式降级逻辑）- 必须先执行以确定 actual_mode
-        if exp_mode == "baseline":
-            use_mastery = False
-            use_tutoring = False
-            label = "BASELINE (无掌握度 + 无辅导)"
-            icon = "🔵"
-            actual_mode = "baseline"
-        elif exp_mode == "mastery_only":
-            use_mastery = True
-            use_tutoring = False
-            label = "MASTERY ONLY (有掌握度 + 无辅导)"
-            icon = "🟢"
-            actual_mode = "mastery_only"
-        elif exp_mode == "tutoring_only":
-            use_mastery = False
-            use_tutoring = True
-            label = "TUTORING ONLY (无掌握度 + 有辅导)"
-            icon = "🟡"
-            actual_mode = "tutoring_only"
-        elif exp_mode == "both":
-            # Both 模式降级逻辑
-            has_mastery = mastery_lookup is not None and len(mastery_lookup) > 0
-            has_tutoring = tutoring_lookup is not None and len(tutoring_lookup) > 0
-            
-            if not has_mastery and not has_tutoring:
-                # 降级为 Baseline
-                use_mastery = False
-                use_tutoring = False
-                label = "BOTH (降级为 Baseline - 无掌握度 + 无辅导)"
-                icon = "🔵⬅️🟣"
-                actual_mode = "baseline"  # 实际等同于 baseline
-            elif has_mastery and not has_tutoring:
-                # 降级为 Mastery Only
-                use_mastery = True
-                use_tutoring = False
-                label = "BOTH (降级为 Mastery Only - 有掌握度 + 无辅导)"
-                icon = "🟢⬅️🟣"
-                actual_mode = "mastery_only"  # 实际等同于 mastery_only
-            elif not has_mastery and has_tutoring:
-                # 理论上不应该出现（辅导依赖掌握度），但仍处理
-                use_mastery = False
-                use_tutoring = True
-                label = "BOTH (降级为 Tutoring Only - 无掌握度 + 有辅导)"
-                icon = "🟡⬅️🟣"
-                actual_mode = "tutoring_only"  # 实际等同于 tutoring_only
-            else:
-                # 正常 Both 模式
-                use_mastery = True
-                use_tutoring = True
-                label = "BOTH (有掌握度 + 有辅导)"
-                icon = "🟣"
-                actual_mode = "both"  # 完整的 both 模式
-        else:
-            actual_mode = exp_mode  # 其他模式保持不变
+        # 配置实验参数（Both 模式的降级已在进入各模式之前确定）- 必须先执行以确定 actual_mode
+        actual_mode = actual_modes[exp_mode]
+        use_mastery, use_tutoring, label, icon = _EXPERIMENT_MODE_CONFIGS[actual_mode]
+        if actual_mode != exp_mode:
+            label, icon = _BOTH_DOWNGRADE_LABELS[actual_mode]
         
         # 断点续跑逻辑（在确定 actual_mode 之后）
-        # 注意：safe_model_name 已在上面定义，这里复用即可
-        if 'safe_model_name' not in locals():
-            safe_model_name = MODEL_NAME.replace('/', '_').replace('.', '_')  # 处理特殊字符
-        results_pkl_path = os.path.join(output_dir, f'experiment_results_{exp_mode}_{safe_model_name}.pkl')
+        safe_model_name = MODEL_NAME.replace('/', '_').replace('.', '_')  # 处理特殊字符
+        results_pkl_name = f'experiment_results_{exp_mode}_{safe_model_name}.pkl'
+        results_pkl_path = os.path.join(output_dir, results_pkl_name)
+        journal_name = results_pkl_name + '.journal'
+        journal_path = os.path.join(output_dir, journal_name)
+        completed_sidecar_path = results_pkl_path + '.completed.json'
         completed_student_ids = set()
         existing_results_df = None
         
         # 默认启用断点续跑，除非用户指定 --no-resume
-        if not args.no_resume and os.path.exists(results_pkl_path):
+        if not args.no_resume and (results_pkl_name in existing_output_files or journal_name in existing_output_files):
             try:
-                existing_results_df = pd.read_pickle(results_pkl_path)
-                completed_student_ids = set(existing_results_df['student_id'].unique())
+                existing_results_df = load_results_with_journal(results_pkl_path, journal_path)
+                if existing_results_df is None:
+                    raise EOFError(f"结果文件为空: {results_pkl_path}")
+                if 'experiment_mode' in existing_results_df.columns:
+                    existing_results_df['experiment_mode'] = existing_results_df['experiment_mode'].astype(_EXPERIMENT_MODE_DTYPE)
+                completed_student_ids = read_completed_students(completed_sidecar_path, (results_pkl_path, journal_path))
+                if completed_student_ids is None:
+                    completed_student_ids = set(existing_results_df['student_id'].unique())
                 print(f"\n📂 检测到已有结果，启用断点续跑")
                 print(f"   📁 文件路径: {results_pkl_path}")
                 print(f"   ✅ 已完成学生数: {len(completed_student_ids)}")
@@ -3262,66 +4534,103 @@ async def main():
         if not remaining_student_ids:
             print(f"\n✅ {exp_mode.upper()} 实验已全部完成，跳过")
             if existing_results_df is not None:
-                existing_results_df['experiment_mode'] = actual_mode  # 🔥 使用实际模式标签
-                all_experiments_results.append(existing_results_df)
-            continue
+                existing_results_df['experiment_mode'] = pd.Categorical([actual_mode] * len(existing_results_df), dtype=_EXPERIMENT_MODE_DTYPE)  # 🔥 使用实际模式标签
+                if journal_name in existing_output_files:
+                    # 上次运行在最终保存前中断：把追加日志合并进结果文件
+                    try:
+                        compact_results_pickle(results_pkl_path, journal_path, existing_results_df)
+                        write_completed_students(completed_sidecar_path, (results_pkl_path, journal_path), completed_student_ids)
+                    except Exception as e:
+                        print(f"\n⚠️  合并追加日志失败: {e}")
+            return existing_results_df
         
-        print(f"\n📋 {exp_mode.upper()} 实验进度:")
-        print(f"   • 已完成: {len(completed_student_ids)} 个学生")
-        print(f"   • 待运行: {len(remaining_student_ids)} 个学生")
-        print(f"   • 总计: {len(student_ids)} 个学生")
-        
-        print("\n" + "="*80)
-        print(f"{icon} 运行 {exp_mode.upper()} 实验".center(80))
-        print("="*80)
-        print(f"   📋 配置: {label}")
-        print(f"   🤖 使用模型: {MODEL_NAME}")
-        print(f"   🎯 掌握度增强: {'✅ 开启' if use_mastery else '❌ 关闭'}")
-        print(f"   📚 辅导输出: {'✅ 开启' if use_tutoring else '❌ 关闭'}")
+        banner_lines = [
+            f"\n📋 {exp_mode.upper()} 实验进度:",
+            f"   • 已完成: {len(completed_student_ids)} 个学生",
+            f"   • 待运行: {len(remaining_student_ids)} 个学生",
+            f"   • 总计: {len(student_ids)} 个学生",
+            "\n" + "="*80,
+            f"{icon} 运行 {exp_mode.upper()} 实验".center(80),
+            "="*80,
+            f"   📋 配置: {label}",
+            f"   🤖 使用模型: {MODEL_NAME}",
+            f"   🎯 掌握度增强: {'✅ 开启' if use_mastery else '❌ 关闭'}",
+            f"   📚 辅导输出: {'✅ 开启' if use_tutoring else '❌ 关闭'}",
+        ]
         if exp_mode == "both" and actual_mode != "both":
-            print(f"   ⚠️  实际运行模式: {actual_mode.upper()} (降级)")
-        print("-"*80)
+            banner_lines.append(f"   ⚠️  实际运行模式: {actual_mode.upper()} (降级)")
+        banner_lines.append("-"*80)
+        _emit_lines(banner_lines)
         
         # 准备日志文件（断点续跑模式下追加，否则清空）
-        prompt_log_path = os.path.join(output_dir, f'prompt_logs_{exp_mode}.txt')
-        if args.no_resume and os.path.exists(prompt_log_path):
+        prompt_log_name = f'prompt_logs_{exp_mode}.txt'
+        prompt_log_path = os.path.join(output_dir, prompt_log_name)
+        if args.no_resume and prompt_log_name in existing_output_files:
             os.remove(prompt_log_path)
             print(f"   🗑️  已清空日志文件（--no-resume模式）")
         
-        recommendation_log_path = os.path.join(output_dir, f'recommendation_logs_{exp_mode}.txt') if use_tutoring else None
-        if recommendation_log_path and args.no_resume and os.path.exists(recommendation_log_path):
+        recommendation_log_name = f'recommendation_logs_{exp_mode}.txt'
+        recommendation_log_path = os.path.join(output_dir, recommendation_log_name) if use_tutoring else None
+        if recommendation_log_path and args.no_resume and recommendation_log_name in existing_output_files:
             os.remove(recommendation_log_path)
         
         # 初始化增量保存
         completed_students_count[exp_mode] = len(completed_student_ids)
-        if existing_results_df is not None:
-            accumulated_results[exp_mode] = existing_results_df
+        last_save_ts[exp_mode] = time.monotonic()
+        last_saved_count[exp_mode] = len(completed_student_ids)
+        if existing_results_df is not None and not existing_results_df.empty:
+            accumulated_results[exp_mode] = [existing_results_df]
+            accumulated_rows[exp_mode] = len(existing_results_df)
+            persisted_frames[exp_mode] = 1  # 已有结果本就来自结果文件，之后只追加新学生
+            completed_with_results = set(completed_student_ids)
         else:
-            accumulated_results[exp_mode] = pd.DataFrame()
+            accumulated_results[exp_mode] = []
+            accumulated_rows[exp_mode] = 0
+            persisted_frames[exp_mode] = 0  # 第一次保存时清空旧文件与旧日志（如 --no-resume 或旧文件损坏）
+            completed_with_results = set()
+        
+        def persist_pending_results():
+            """把尚未保存的 DataFrame 追加到追加日志末尾，并同步已完成学生列表"""
+            pending = accumulated_results[exp_mode][persisted_frames[exp_mode]:]
+            if pending:
+                if persisted_frames[exp_mode] == 0 and os.path.exists(results_pkl_path):
+                    os.remove(results_pkl_path)  # 从头开始时旧的结果文件作废，避免续跑时与新日志混在一起
+                append_results_pickle(journal_path, pending, truncate=persisted_frames[exp_mode] == 0)
+                persisted_frames[exp_mode] = len(accumulated_results[exp_mode])
+                write_completed_students(completed_sidecar_path, (results_pkl_path, journal_path), completed_with_results)
         
         # 定义增量保存回调
         def save_incremental_results(student_id, student_results):
-            nonlocal accumulated_results, completed_students_count
+            nonlocal accumulated_results, accumulated_rows, completed_students_count
             
-            # 添加新结果
+            # 添加新结果（只追加到缓冲列表，不复制已累积的数据）
             new_df = pd.DataFrame(student_results)
-            new_df['experiment_mode'] = actual_mode  # 🔥 使用实际模式标签
+            new_df['experiment_mode'] = pd.Categorical([actual_mode] * len(new_df), dtype=_EXPERIMENT_MODE_DTYPE)  # 🔥 使用实际模式标签
             
-            if accumulated_results[exp_mode].empty:
-                accumulated_results[exp_mode] = new_df
-            else:
-                accumulated_results[exp_mode] = pd.concat([accumulated_results[exp_mode], new_df], ignore_index=True)
+            if not new_df.empty:
+                accumulated_results[exp_mode].append(new_df)
+                accumulated_rows[exp_mode] += len(new_df)
+                completed_with_results.add(student_id)
             
             completed_students_count[exp_mode] += 1
             
-            # 每 save_interval 个学生保存一次
-            if completed_students_count[exp_mode] % args.save_interval == 0:
+            # 累计新增 save_interval 个学生、或距上次保存超过 save_max_seconds 时保存；缓冲区没有新结果则跳过
+            has_pending = len(accumulated_results[exp_mode]) > persisted_frames[exp_mode]
+            should_save = (
+                completed_students_count[exp_mode] - last_saved_count[exp_mode] >= args.save_interval
+                or time.monotonic() - last_save_ts[exp_mode] > args.save_max_seconds
+            )
+            if has_pending and should_save:
                 try:
-                    accumulated_results[exp_mode].to_pickle(results_pkl_path)
-                    non_empty_rows = len(accumulated_results[exp_mode])
-                    print(f"\n💾 增量保存 ({exp_mode}): 已完成 {completed_students_count[exp_mode]} 个学生")
-                    print(f"   📊 当前数据行数: {non_empty_rows}")
-                    print(f"   📁 保存路径: {results_pkl_path}")
+                    persist_pending_results()
+                    last_save_ts[exp_mode] = time.monotonic()
+                    last_saved_count[exp_mode] = completed_students_count[exp_mode]
+                    non_empty_rows = accumulated_rows[exp_mode]
+                    _emit_lines([
+                        f"\n💾 增量保存 ({exp_mode}): 已完成 {completed_students_count[exp_mode]} 个学生",
+                        f"   📊 当前数据行数: {non_empty_rows}",
+                        f"   📁 保存路径: {journal_path}",
+                    ])
                 except Exception as e:
                     print(f"\n⚠️  增量保存失败: {e}")
         
@@ -3343,19 +4652,27 @@ async def main():
             use_tutoring,
             tutoring_lookup if use_tutoring else None,  # 🔥 传递预加载的辅导内容
             args.spread_duration,
-            on_student_complete=save_incremental_results
+            on_student_complete=save_incremental_results,
+            prep_workers=mode_prep_workers,
+            split_cache=split_cache,
+            response_cache=response_cache,
+            semantic_cache=semantic_cache,
+            limiter=limiter,
+            exp_mode=exp_mode
         )
         
-        # 合并新旧结果
-        results['experiment_mode'] = actual_mode  # 🔥 使用实际模式标签
-        if existing_results_df is not None:
-            final_results = pd.concat([existing_results_df, results], ignore_index=True)
+        # 合并新旧结果：回调中已累积了"已有结果 + 本次结果"的完整数据（含提示词与原始响应），
+        # run_experiment 本身只返回精简列
+        if accumulated_results[exp_mode]:
+            final_results = pd.concat(accumulated_results[exp_mode], ignore_index=True)
         else:
+            results['experiment_mode'] = pd.Categorical([actual_mode] * len(results), dtype=_EXPERIMENT_MODE_DTYPE)  # 🔥 使用实际模式标签
             final_results = results
         
-        # 最终保存
+        # 最终保存：把完整结果合并写成单个 DataFrame 的结果文件，并删除追加日志
         try:
-            final_results.to_pickle(results_pkl_path)
+            compact_results_pickle(results_pkl_path, journal_path, final_results)
+            write_completed_students(completed_sidecar_path, (results_pkl_path, journal_path), final_results['student_id'].unique())
             non_empty_rows = len(final_results)
             print(f"\n💾 最终保存 ({exp_mode}):")
             print(f"   ✅ 总完成学生数: {len(final_results['student_id'].unique())}")
@@ -3364,15 +4681,33 @@ async def main():
         except Exception as e:
             print(f"\n⚠️  最终保存失败: {e}")
         
-        all_experiments_results.append(final_results)
+        return final_results
+    
+    # 各模式相互独立（结果文件、日志按模式区分），瓶颈在 LLM I/O；
+    # --parallel-modes 时同时运行所有模式，共用一个并发控制器，总并发仍不超过 --concurrency
+    if args.parallel_modes and len(experiment_modes) > 1:
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter(max_limit=args.concurrency, adaptive=False)
+        print(f"\n⚡ 并行运行 {len(experiment_modes)} 个实验模式（总并发上限: {limiter.max_limit}，每个模式准备进程数: {mode_prep_workers}）")
+        mode_results = await asyncio.gather(*(run_mode(exp_mode) for exp_mode in experiment_modes))
+    else:
+        mode_results = [await run_mode(exp_mode) for exp_mode in experiment_modes]
+    all_experiments_results.extend(result for result in mode_results if result is not None)
     
-    # 合并所有实验结果
-    combined_results_df = pd.concat(all_experiments_results, ignore_index=True)
+    if response_cache is not None:
+        response_cache.close()
     
     # 仅保存 CSV 格式的综合对比结果（方便查看）
     # 注意：不保存 pickle 格式，因为各模式的 pickle 已单独保存
+    # 逐模式追加写出，不必先把所有模式的结果合并成一张表再整体序列化；
+    # 各模式统一按所有列的并集（与 pd.concat 相同的列顺序）对齐，缺失列留空
     results_csv_path = os.path.join(output_dir, 'experiment_results_comparison.csv')
-    combined_results_df.to_csv(results_csv_path, index=False)
+    csv_columns = list(dict.fromkeys(column for result in all_experiments_results for column in result.columns))
+    for i, result in enumerate(all_experiments_results):
+        _write_csv(result.reindex(columns=csv_columns), results_csv_path, append=i > 0)
+    
+    # 合并所有实验结果（评估与对比报告需要完整结果表）
+    combined_results_df = pd.concat(all_experiments_results, ignore_index=True)
     print(f"\n💾 综合实验结果已保存至:")
     print(f"   📄 CSV格式: {results_csv_path}")
     print(f"   📈 总数据行数: {len(combined_results_df)}")
@@ -3382,13 +4717,13 @@ async def main():
     print("\n" + "="*80)
     print("📊 综合评估报告（对比所有模式）".center(80))
     print("="*80)
-    evaluate_results(combined_results_df)
+    evaluate_results(combined_results_df, choice_ids_by_qid)
 
     # 4. 生成三模式综合对比报告
     print("\n" + "="*80)
     print("📊 生成三模式综合对比报告".center(80))
     print("="*80)
-    generate_three_mode_comparison_report(combined_results_df, output_dir)
+    generate_three_mode_comparison_report(combined_results_df, output_dir, choice_ids_by_qid)
 
     # 5. 保存输入输出案例（暂时禁用）
     # if mastery_lookup and tutoring_lookup:
@@ -3406,11 +4741,11 @@ async def main():
     #             mastery_lookup,
     #             tutoring_lookup,
     #             related_kc_map,
-    #             all_kc_names
+    #             all_kc_names,
+    #             split_cache=split_cache
     #         )
     #     except Exception as e:
     #         print(f"\n⚠️  保存输入输出案例失败: {e}")
-    #         import traceback
     #         traceback.print_exc()
     # else:
     #     print("\n⚠️  跳过案例保存：缺少掌握度或辅导内容数据")
@@ -3418,11 +4753,21 @@ async def main():
     # 输出上下文快照，便于对比掌握度与辅导摘要（仅保存 CSV）
     summary_columns = ['student_id', 'question_id', 'true_know_name', 'experiment_type', 'experiment_mode', 'mastery_summary', 'tutoring_summary']
     available_columns = [col for col in summary_columns if col in combined_results_df.columns]
-    context_snapshot_df = combined_results_df[available_columns].drop_duplicates()
+    # 去重只按键列哈希：同一 (学生, 题目, 知识点, 模式) 下实验类型和两段摘要完全相同，不必对长文本列逐行哈希
+    key_columns = [col for col in ['student_id', 'question_id', 'true_know_name', 'experiment_mode'] if col in available_columns]
+    value_columns = [col for col in available_columns if col not in key_columns]
+    if key_columns and value_columns:
+        context_snapshot_df = (
+            combined_results_df
+            .groupby(key_columns, as_index=False, sort=False, dropna=False, observed=True)[value_columns]
+            .first()[available_columns]
+        )
+    else:
+        context_snapshot_df = combined_results_df[available_columns].drop_duplicates()
     
     # 仅保存 CSV 格式（方便查看）
     context_snapshot_csv_path = os.path.join(output_dir, 'context_snapshot_comparison.csv')
-    context_snapshot_df.to_csv(context_snapshot_csv_path, index=False)
+    _write_csv(context_snapshot_df, context_snapshot_csv_path)
     print(f"   📸 上下文快照: {context_snapshot_csv_path}")
     print("="*80)
     print("\n🎉 实验完成！".center(80))